@@ -3,12 +3,26 @@
 # BAP.py - main for the KCRI CGE Bacterial Analysis Pipeline
 #
 
-import sys, os, argparse, gzip, io, json, re
+import sys, os, argparse, gzip, itertools, json, re, shlex, threading, zlib
 from pico.workflow.logic import Workflow
-from pico.workflow.executor import Executor
 from pico.jobcontrol.subproc import SubprocessScheduler
 from .data import BAPBlackboard
 from .services import SERVICES
+from .scheduler import FairShareScheduler, EventScheduler, MemoryMonitor, psutil
+from .executor import BatchExecutor, SampleScheduler
+from .batch import read_sample_sheet, options_to_argv
+from .inbox import InboxWatcher, ILLUMINA_FQ_RE
+from .server import JobQueue, JobServer
+from .cache import RunCache, forget_db_fingerprints
+from .profiles import ProfileStore
+from .cgroups import CgroupScheduler
+from .placement import PlacementScheduler, POLICIES
+from .slurm import SlurmScheduler
+from .workers import WorkerScheduler, parse_address, SECRET_VAR
+from .validate import validate_samples
+from .checkpoint import CHECKPOINT_FILE, load_checkpoint, remove_checkpoint, resume_run
+from .reanalyse import load_results, recorded_args, recorded_inputs, completed_services, replayable_services
+from .shims.base import UserException
 from .workflow import DEPENDENCIES
 from .workflow import UserTargets, Services, Params
 from . import __version__
@@ -21,40 +35,371 @@ def err_exit(msg, *args):
     print(('BAP: %s' % msg) % args, file=sys.stderr)
     sys.exit(1)
 
-# Helper to detect whether file is (gzipped) fasta or fastq
-def detect_filetype(fname):
-    with open(fname, 'rb') as f:
-        b = f.peek(2)
-        if b[:2] == b'\x1f\x8b':
-            b = gzip.GzipFile(fileobj=f).peek(2)[:2]
-        c = chr(b[0]) if len(b) > 0 else '\x00'
-    return 'fasta' if c == '>' else 'fastq' if c == '@' else 'other'
-
-# Helper to test first line against re patter
-def first_line_matches(fname, regex):
-    pat = re.compile(regex)
-    with open(fname, 'rb') as f:
-        b = f.peek(2)
-        buf = io.TextIOWrapper(gzip.GzipFile(fileobj=f) if b[:2] == b'\x1f\x8b' else f)
-        return re.match(pat, buf.readline())
-
-# Helper to detect whether fastq file has Illumina reads
-def is_illumina_reads(fname):
-    return first_line_matches(fname, r'^@[^:]+:\d+:[^:]+:\d+:\d+:\d+:\d+ [12]:[YN]:\d+:[^: ]+( .*)?$')
+# Patterns for the first line of fastq files with Illumina and Nanopore reads
+ILLUMINA_HEADER_RE = re.compile(r'^@[^:]+:\d+:[^:]+:\d+:\d+:\d+:\d+ [12]:[YN]:\d+:[^: ]+( .*)?$')
+#@3ea0b1a6-309d-4fa6-acf7-81318583eea3 runid=e78b393cae8ec468269f5fcfa954c3ff8bbb1344 sampleid=C2020 read=39660 ch=389 start_time=2021-03-10T21:50:19Z barcode=barcode01
+NANOPORE_HEADER_RE = re.compile(r'^@[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}.*$')
 
-# Helper to detect whether fastq file has Illumina reads
-def is_nanopore_reads(fname):
-    #@3ea0b1a6-309d-4fa6-acf7-81318583eea3 runid=e78b393cae8ec468269f5fcfa954c3ff8bbb1344 sampleid=C2020 read=39660 ch=389 start_time=2021-03-10T21:50:19Z barcode=barcode01
-    return first_line_matches(fname, r'^@[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}.*$')
+# Helper to detect from its first line whether (gzipped) file is fasta, Illumina or
+# Nanopore fastq, other fastq, or other, opening and decompressing it only once
+def sniff_file(fname):
+    with open(fname, 'rb') as f:
+        gzipped = f.peek(2)[:2] == b'\x1f\x8b'
+        line = (gzip.GzipFile(fileobj=f) if gzipped else f).readline().decode('latin-1').rstrip('\r\n')
+    if line.startswith('>'):
+        return 'fasta'
+    elif not line.startswith('@'):
+        return 'other'
+    elif ILLUMINA_HEADER_RE.match(line):
+        return 'illumina'
+    elif NANOPORE_HEADER_RE.match(line):
+        return 'nanopore'
+    return 'fastq'
+
+# Helper to check the inputs of the samples in full if args.validate, raising
+# UserException with all that is wrong, prefixed by the ids if given
+def validate_inputs(args, inputs, ids=None):
+    if not args.validate:
+        return
+    errors = validate_samples(inputs, args.max_cpus)
+    if ids:
+        errors = [ list(map(lambda e: 'sample %s: %s' % (i, e), es)) for i, es in zip(ids, errors) ]
+    errors = sum(errors, [])
+    if errors:
+        raise UserException('invalid input:%s', '\n  '.join([ '' ] + errors) if len(errors) > 1 else ' ' + errors[0])
 
 # Helper to parse string ts which may be UserTarget or Service
 def UserTargetOrService(s):
     try: return UserTargets(s)
     except: return Services(s)
 
+# Helper to parse the targets and excludes strings into lists of enums
+def parse_targets(targets_str, excludes_str):
+    targets = []
+    try:
+        targets = list(map(lambda t: UserTargets(t.strip()), targets_str.split(',') if targets_str else []))
+    except ValueError as ve:
+        raise UserException('invalid target: %s (try --list-available)', ve)
 
-def main():
-    '''BAP main program.'''
+    excludes = []
+    try:
+        excludes = list(map(lambda t_or_s: UserTargetOrService(t_or_s.strip()), excludes_str.split(',') if excludes_str else []))
+    except ValueError as ve:
+        raise UserException('invalid exclude: %s (try --list-available)', ve)
+
+    return targets, excludes
+
+# Helper to classify the input files into contigs, Illumina and Nanopore fastqs
+def classify_inputs(files):
+    contigs = None
+    illufqs = list()
+    nanofq = None
+    for f in files:
+        if not os.path.isfile(f):
+            raise UserException('no such file: %s', f)
+        try:
+            kind = sniff_file(f)
+        except (OSError, EOFError, zlib.error) as e:
+            raise UserException('cannot read file %s: %s', f, str(e))
+        if kind == 'fasta':
+            if contigs:
+                raise UserException('more than one FASTA file passed: %s', f)
+            contigs = os.path.abspath(f)
+        elif kind == 'illumina':
+            illufqs.append(os.path.abspath(f))
+        elif kind == 'nanopore':
+            if nanofq:
+                raise UserException('more than one Nanopore fastq file passed: %s', f)
+            nanofq = os.path.abspath(f)
+        elif kind == 'fastq':
+            raise UserException('cannot detect whether file has Illumina or Nanopore reads: %s', f)
+        else:
+            raise UserException("file is neither FASTA not fastq: %s", f)
+
+    if len(illufqs) > 2:
+        raise UserException('more than two Illumina fastq files passed: %s', f)
+    if illufqs and nanofq:
+        raise UserException('pass either Illumina or Nanopore reads, not both')
+    if contigs and (illufqs or nanofq):
+        raise UserException('pass either FASTQ or FASTA files, not both')
+
+    return contigs, illufqs, nanofq
+
+# Helper to generate a sample id from the input file names
+def make_sample_id(contigs, illufqs, nanofq):
+    sample_id = None
+    if contigs:
+        _, fname = os.path.split(contigs)
+        sample_id, ext = os.path.splitext(fname)
+        if ext == '.gz':
+            sample_id, _ = os.path.splitext(sample_id)
+    elif illufqs:
+        # Try if it is pure Illumina
+        _, fname = os.path.split(illufqs[0])
+        mat = ILLUMINA_FQ_RE.fullmatch(fname)
+        if mat:
+            sample_id = mat.group(1)
+        else: # no illumina, try to fudge something from common part
+            common = os.path.commonprefix(illufqs)
+            _, sample_id = os.path.split(common)
+            # sample_id now is the common part, chop any _ or _R
+            if sample_id[-2:] == "_R" or sample_id[-2:] == "_r":
+                sample_id = sample_id[:-2]
+            elif sample_id[-1:] == "_":
+                sample_id = sample_id[:-1]
+    elif nanofq:
+        _, fname = os.path.split(nanofq)
+        sample_id, ext = os.path.splitext(fname)
+        if ext == '.gz':
+            sample_id, _ = os.path.splitext(sample_id)
+    return sample_id if sample_id else "SAMPLE"
+
+# Helper to set up the blackboard and workflow for a single run
+def make_workflow(args, sample_id, db_root, contigs, illufqs, nanofq):
+    targets, excludes = parse_targets(args.targets, args.exclude)
+
+    blackboard = BAPBlackboard(args.verbose)
+    blackboard.start_run(SERVICE, VERSION, vars(args))
+    blackboard.put_db_root(db_root)
+    blackboard.put_sample_id(sample_id)
+
+    # Set the workflow params based on user inputs present
+    params = list()
+    if contigs:
+        params.append(Params.CONTIGS)
+        blackboard.put_user_contigs_path(contigs)
+    if illufqs:
+        params.append(Params.ILLUREADS)
+        blackboard.put_illufq_paths(illufqs)
+        if args.max_depth:
+            params.append(Params.MAXDEPTH)
+    if args.stage_dir and (illufqs or nanofq):
+        params.append(Params.STAGING)
+    if nanofq:
+        params.append(Params.NANOREADS)
+        blackboard.put_nanofq_path(nanofq)
+    if args.species:
+        params.append(Params.SPECIES)
+        blackboard.put_user_species(list(filter(None, map(lambda x: x.strip(), args.species.split(',')))))
+    if args.plasmids:
+        params.append(Params.PLASMIDS)
+        blackboard.put_user_plasmids(list(filter(None, map(lambda x: x.strip(), args.plasmids.split(',')))))
+
+    return Workflow(DEPENDENCIES, params, targets, excludes), blackboard
+
+# Helper to produce the dict of summary fields from the blackboard
+def summary_dict(b):
+    commasep = lambda l: ','.join(l) if l else ''
+
+    # For computing cross-service metrics
+    nt_ctgs = int(b.get('services/ContigsMetrics/results/tot_len', 0))
+    nt_read = int(b.get('services/ReadsMetrics/results/bases', 0))
+    pct_q30 = float(b.get('services/ReadsMetrics/results/pct_q30', 0))
+
+    return dict({
+        's_id': b.get_sample_id(),
+        'n_reads': b.get('services/ReadsMetrics/results/reads', 'NA'),
+        'nt_read': nt_read if nt_read else 'NA',
+        'pct_q30': pct_q30 if pct_q30 else 'NA',
+        'n_ctgs': b.get('services/ContigsMetrics/results/n_seqs', 'NA'),
+        'nt_ctgs': nt_ctgs if nt_ctgs else 'NA',
+        'n1': b.get('services/ContigsMetrics/results/n1', 'NA'),
+        'n50': b.get('services/ContigsMetrics/results/n50', 'NA'),
+        'l50': b.get('services/ContigsMetrics/results/l50', 'NA'),
+        'avg_dp': int(0.5 + nt_read / nt_ctgs) if nt_ctgs and nt_read else 'NA',
+        'q30_dp': int(0.5 + pct_q30 / 100 * nt_read / nt_ctgs) if nt_ctgs and nt_read and pct_q30 else 'NA',
+        'ref_len': b.get_closest_reference_length('NA'),
+        'pct_gc': b.get('services/ContigsMetrics/results/pct_gc', b.get('services/ReadsMetrics/results/pct_gc', 'NA')),
+        'species': commasep(b.get_detected_species([])),
+        'mlst': commasep(b.get_mlsts()),
+        'amr_cls': commasep(b.get_amr_classes()),
+        'amr_res': commasep(b.get_amr_antibiotics()),
+        'dis_res': commasep(b.get_dis_resistances()),
+        'vir_gen': commasep(b.get_virulence_genes()),
+        'plasmid': commasep(b.get_detected_plasmids([])),
+        'pmlsts': commasep(b.get_pmlsts()),
+        'cgst': commasep(b.get_cgmlsts()),
+        'amr_gen': commasep(b.get_amr_genes()),
+        'amr_mut': commasep(b.get_amr_mutations()),
+        'dis_gen': commasep(b.get_dis_genes())
+        })
+
+# Helper to write the TSV summary for one or more blackboards
+def write_summary(fname, blackboards):
+    with open(fname, 'w') as f_tsv:
+        for i, b in enumerate(blackboards):
+            d = summary_dict(b)
+            if i == 0:
+                print('#', '\t'.join(d.keys()), file=f_tsv)
+            print('\t'.join(map(lambda v: str(v) if v else '', d.values())), file=f_tsv)
+
+# Helper to write the JSON results and TSV summary files to out_dir
+def write_outputs(blackboard, out_dir, verbose):
+    with open(os.path.join(out_dir, 'bap-results.json'), 'w') as f_json:
+        json.dump(blackboard.as_dict(verbose), f_json)
+    write_summary(os.path.join(out_dir, 'bap-summary.tsv'), [ blackboard ])
+    remove_checkpoint(out_dir)
+
+# Helper to return the set of input files of the earlier run in out_dir, or None
+# if it has no (valid) results
+def recorded_files(out_dir):
+    try:
+        inputs = recorded_inputs(load_results(out_dir))
+    except UserException:
+        return None
+    return set(filter(None, [ inputs[0], inputs[2] ] + (inputs[1] or [])))
+
+# Helper to append the summary line for blackboard to an existing TSV summary
+def append_summary(fname, blackboard):
+    if not os.path.exists(fname):
+        write_summary(fname, [ blackboard ])
+    else:
+        with open(fname, 'a') as f_tsv:
+            d = summary_dict(blackboard)
+            print('\t'.join(map(lambda v: str(v) if v else '', d.values())), file=f_tsv)
+
+# Helper to parse per-sample options and files on top of the command line
+def sample_args(parser, options, files):
+    try:
+        a = parser.parse_args(sys.argv[1:] + options_to_argv(parser, options) + list(files))
+    except SystemExit:
+        raise UserException('invalid options: %s', ' '.join(options_to_argv(parser, options)))
+    a.batch = a.serve_dir = a.serve_http = None
+    return a
+
+# Helper to open the run cache if one was configured, else return None
+def open_cache(args):
+    if not args.cache_dir:
+        return None
+    try:
+        return RunCache(args.cache_dir, args.cache_size)
+    except Exception as e:
+        err_exit('cannot open --cache-dir %s: %s', args.cache_dir, str(e))
+
+# Helper to complete the run on blackboard from the cache, returns True if done
+def complete_from_cache(cache, blackboard, out_dir):
+    if not cache:
+        return False
+    key = cache.run_key(blackboard)
+    status = None if blackboard.get_user_input('no_cache', False) else cache.materialise(key, blackboard, out_dir)
+    if status is None:
+        blackboard.put('bap/run_info/cache', { 'key': key, 'hit': False })
+        return False
+    blackboard.end_run(status)
+    write_outputs(blackboard, out_dir, blackboard.get_user_input('verbose', False))
+    return True
+
+# Helper to open the profile store if args has a profile_dir, raises UserException on error
+def open_profiles(args):
+    if not args.profile_dir:
+        return None
+    try:
+        return ProfileStore(args.profile_dir)
+    except Exception as e:
+        raise UserException('cannot open --profile-dir %s: %s', args.profile_dir, str(e))
+
+# Helper to end a run, store it in the cache if it fully succeeded, and write its outputs;
+# runs with cancelled services are not cached, as what got cancelled depends on timing
+def finish_run(cache, blackboard, status, out_dir, job_dirs):
+    blackboard.end_run(status)
+    key = blackboard.get('bap/run_info/cache/key')
+    failed = any(s.get('run_info', {}).get('status') in [ 'FAILED', 'CANCELLED' ] for s in blackboard.get('services', {}).values())
+    if cache and key and status == Workflow.Status.COMPLETED.value and not failed:
+        try:
+            cache.store(key, blackboard, status, out_dir, job_dirs)
+        except Exception as e:
+            blackboard.add_warning('failed to store results in cache: %s' % str(e))
+    write_outputs(blackboard, out_dir, blackboard.get_user_input('verbose', False))
+
+# Helper to return a new run id for sample_id, unique in this process.  It owns the run's
+# jobs on the shared scheduler, so that runs of samples with the same id (in different
+# output dirs, or submitted twice) get their own shares and wait statistics; as the
+# owner is what precedes the ':' in the job names, it has no ':' in it
+_run_ids = itertools.count(1)
+def make_run_id(sample_id):
+    return '%s#%d' % (sample_id.replace(':', '_'), next(_run_ids))
+
+# Helper to record on the blackboard how long the run's jobs waited for the shared scheduler
+def record_waits(scheduler, blackboard, owner):
+    if isinstance(scheduler, FairShareScheduler):
+        blackboard.put('bap/run_info/scheduling', scheduler.wait_stats(owner))
+        scheduler.forget(owner)
+
+# Helper to make the run checkpoint to out_dir, and resume from its checkpoint if asked
+def checkpoint_run(workflow, blackboard, out_dir):
+    if blackboard.get_user_input('resume', False):
+        checkpoint = load_checkpoint(out_dir)
+        if not checkpoint:
+            blackboard.add_warning('no checkpoint to resume from in %s' % out_dir)
+        else:
+            blackboard.put('bap/run_info/resumed', resume_run(workflow, blackboard, checkpoint))
+    blackboard.set_checkpoint_file(os.path.join(out_dir, CHECKPOINT_FILE))
+
+# Helper to set up the run for one sample, and either complete it from the cache,
+# or add it to the BatchExecutor.  Calls on_done(blackboard) once it is done.
+# Its jobs are owned by a new run id on the shared scheduler (see make_run_id).
+def start_sample(executor, scheduler, cache, args, sample_id, inputs, on_done=None):
+    workflow, blackboard = make_workflow(args, sample_id, os.path.abspath(args.db_root), *inputs)
+
+    if complete_from_cache(cache, blackboard, args.out_dir):
+        if on_done:
+            on_done(blackboard)
+    else:
+        checkpoint_run(workflow, blackboard, args.out_dir)
+        owner = make_run_id(sample_id)
+        if isinstance(scheduler, FairShareScheduler):
+            scheduler.set_weight(owner, args.weight)
+        def run_done(run):
+            record_waits(scheduler, run.blackboard, owner)
+            finish_run(cache, run.blackboard, run.workflow.status.value, args.out_dir, run.scheduler.job_dirs)
+            if on_done:
+                on_done(run.blackboard)
+        executor.add_run(workflow, blackboard, SampleScheduler(scheduler, owner, args.out_dir, cache, profiles=open_profiles(args)), run_done)
+
+    return blackboard
+
+
+# Helper to make the scheduler that runs the backend jobs: on Slurm if args.slurm, on
+# the workers that connect to args.workers, else locally, waiting for them to exit rather
+# than polling every args.poll seconds, confining them if args.cgroup, and pinning them
+# to CPUs and NUMA nodes as args.numa says
+def make_backend_scheduler(args):
+    if args.slurm or args.workers:
+        if args.slurm and args.workers:
+            err_exit('options --slurm and --workers cannot be used together')
+        if args.cgroup or args.numa != 'off':
+            err_exit('options --cgroup and --numa cannot be used with --slurm or --workers')
+        if args.stage_dir:
+            err_exit('option --stage-dir (or BAP_STAGE_DIR) cannot be used with --slurm or --workers, as the jobs run on other hosts')
+        try:
+            if args.slurm:
+                return SlurmScheduler(args.max_cpus, args.max_mem, args.poll, shlex.split(args.sbatch_opts or ''))
+            scheduler = WorkerScheduler(parse_address(args.workers), args.poll, os.environ.get(SECRET_VAR))
+        except UserException as e:
+            err_exit(str(e))
+        print('BAP: waiting for workers on %s:%d' % scheduler.address, file=sys.stderr)
+        scheduler.wait_for_workers(args.min_workers)
+        return scheduler
+
+    scheduler = EventScheduler(SubprocessScheduler(args.max_cpus, args.max_mem, args.max_time, 0, not args.verbose), args.poll)
+    if args.cgroup:
+        try:
+            scheduler = CgroupScheduler(scheduler, args.cgroup)
+        except UserException as e:
+            err_exit(str(e))
+    if args.numa != 'off':
+        scheduler = PlacementScheduler(scheduler, args.numa)
+    return scheduler
+
+# Helper to make the scheduler that queues jobs by priority, and shares resources
+# fairly between the samples in batch and daemon modes
+def make_scheduler(args):
+    monitor = MemoryMonitor(args.mem_margin) if psutil and not (args.slurm or args.workers) else None
+    return FairShareScheduler(make_backend_scheduler(args), monitor, args.max_readers)
+
+
+def make_parser():
+    '''Return the parser for the BAP command line.'''
 
     parser = argparse.ArgumentParser(
         description="""\
@@ -72,6 +417,28 @@ Use -l/--list-available to see the available targets and services.  Use
 
 If a requested service depends on the output of another service, then the
 dependency will be automatically added.
+
+Use -b/--batch to process many isolates in one go.  The sample sheet is a
+TSV file with a header line naming its columns: 'id', 'files' (comma-separated
+paths relative to the sheet), and optionally any option (e.g. 'species',
+'targets', 'rf-i') to set for that sample.  All samples share the resources
+set by --max-cpus and --max-mem, in proportion to their --weight.  Each
+sample's output goes in a subdirectory of --out-dir, which also gets a
+combined bap-summary.tsv.
+
+Use --serve-dir to run as a daemon that watches an inbox directory (and its
+subdirectories) for incoming samples.  Illumina reads files are paired on
+their SAMPLE_S1_L001_R[12]_001.fastq.gz names, and FASTA files are taken as
+single samples.  Each sample starts as soon as its files have been written,
+and its output goes in a subdirectory of --out-dir like in batch mode.  As the
+samples are named after their files, a sample whose name is already taken by
+files elsewhere in the inbox is skipped.
+
+Use --serve-http to run as a service that accepts jobs over HTTP: POST to
+/jobs a JSON object with "files" (list of paths), optional "id", and optional
+"options" (e.g. {"species": "...", "rf-i": "0.95"}).  GET /jobs/ID returns the
+job's state, and /jobs/ID/results its bap-results.json.  Jobs are queued in
+--out-dir/queue and survive a restart.  All jobs share one resource budget.
 """,
         epilog="""\
 Instead of passing arguments on the command-line, you can put them, one
@@ -91,6 +458,13 @@ per line, in a text file and pass this file with @FILENAME.
     group.add_argument('-l', '--list-available', action='store_true', help="list the available targets and services")
     group.add_argument('-d', '--db-root',  metavar='PATH', default='/databases', help="base path to service databases (leave default when dockerised)")
     group.add_argument('-v', '--verbose',  action='store_true', help="write verbose output to stderr")
+    group.add_argument('-b', '--batch',    metavar='SHEET', help="run on all samples in SHEET, a TSV with columns id, files, and optional per-sample options")
+    group.add_argument('--serve-dir',      metavar='INBOX', help="run as daemon, processing samples as their files appear in INBOX")
+    group.add_argument('--serve-http',     metavar='[HOST:]PORT', help="run as HTTP job submission service on PORT (default HOST: localhost)")
+    group.add_argument('--resume',         action='store_true', help="resume an interrupted run in the output directory, rerunning only services that did not complete")
+    group.add_argument('--reanalyse',      action='store_true', help="reanalyse earlier runs whose output directories are given as FILEs, rerunning only outdated services")
+    group.add_argument('--replay',         action='store_true', help="regenerate the results of earlier runs whose output directories are given as FILEs, without running any backend")
+    group.add_argument('--validate',       action='store_true', help="read all input files in full and check them (in parallel) before starting")
     group.add_argument('files', metavar='FILE', nargs='*', default=[], help="input file(s) in optionally gzipped FASTA or fastq format")
 
     # Resource management arguments
@@ -98,9 +472,29 @@ per line, in a text file and pass this file with @FILENAME.
     group.add_argument('--max-cpus',      metavar='N',   type=int, default=None, help="number of CPUs to allocate (default: all)")
     group.add_argument('--max-mem',       metavar='GB',  type=int, default=None, help="total memory to allocate (default: all)")
     group.add_argument('--max-time',      metavar='SEC', type=int, default=None, help="maximum overall run time (default: unlimited)")
-    group.add_argument('--poll', metavar='SEC', type=int, default=5, help="seconds between backend polls [5]")
+    group.add_argument('--mem-margin', metavar='GB', type=float, default=None, help="hold back jobs when less than GB memory is available (default: 5%% of total, at least 1)")
+    group.add_argument('--max-readers', metavar='N', type=int, default=4, help="maximum number of large input files to read at once from each disk or file server, 0 for no limit [4]")
+    group.add_argument('--cgroup',   metavar='PATH', help="run each job in a cgroup v2 below PATH, limited to the CPUs and memory it was given")
+    group.add_argument('--numa',     metavar='POLICY', choices=POLICIES, default='off', help="run jobs on CPUs of their own, on one NUMA node where they fit ('pin'), and with their memory bound to that node ('bind') [off]")
+    group.add_argument('--slurm',    action='store_true', help="run the jobs on a Slurm cluster, with --max-cpus and --max-mem capping what is submitted at once")
+    group.add_argument('--sbatch-opts', metavar='OPTS', help="options to pass to sbatch, e.g. '--partition=long --account=bap'")
+    group.add_argument('--workers',  metavar='[HOST:]PORT', help="run the jobs on BAP-worker daemons that connect on PORT (default HOST: localhost)")
+    group.add_argument('--min-workers', metavar='N', type=int, default=1, help="number of workers to wait for before starting [1]")
+    group.add_argument('--poll', metavar='SEC', type=int, default=5, help="seconds between backend polls, if job exits cannot be signalled [5]")
+    group.add_argument('--elastic',  metavar='SVC=CPUS[:GB]', action='append', default=None, help="bounds on the CPUs and memory granted to SKESA, Flye or GFAConnector, each a number or MIN-MAX (e.g. SKESA=4-16:8-32)")
+    group.add_argument('--weight',   metavar='W', type=float, default=1, help="share of CPU and memory for a sample relative to other samples in batch and daemon modes [1]")
+
+    # Cache arguments
+    group = parser.add_argument_group('Cache parameters')
+    group.add_argument('--cache-dir',  metavar='PATH', default=os.environ.get('BAP_CACHE_DIR'), help="reuse the results of identical earlier runs and jobs, cached in PATH (default: $BAP_CACHE_DIR if set, else no caching)")
+    group.add_argument('--cache-size', metavar='GB', type=float, default=100, help="maximum size of the cache, evicting least recently used runs [100]")
+    group.add_argument('--no-cache',   action='store_true', help="do not reuse cached results (but do cache the results of this run)")
+    group.add_argument('--stage-dir', metavar='PATH', default=os.environ.get('BAP_STAGE_DIR'), help="decompress the reads once into PATH (ideally a fast local disk) for all services to read, removing them when done (default: $BAP_STAGE_DIR if set, else no staging)")
+    group.add_argument('--profile-dir', metavar='PATH', default=os.environ.get('BAP_PROFILE_DIR'), help="record the resources that jobs use in PATH, and reserve what they are likely to need based on this (default: $BAP_PROFILE_DIR if set, else use the fixed estimates)")
 
     # Service specific arguments
+    group = parser.add_argument_group('Downsampler parameters')
+    group.add_argument('--max-depth', metavar='X', type=float, default=None, help="downsample Illumina reads to at most X-fold coverage of the genome (default: no downsampling)")
     group = parser.add_argument_group('ContigMetrics parameters')
     group.add_argument('--cm-l', metavar='NT', type=int, default=200, help="Minimum contig length to include in counts [200]")
     group = parser.add_argument_group('KmerFinder parameters')
@@ -141,58 +535,54 @@ per line, in a text file and pass this file with @FILENAME.
     group = parser.add_argument_group('Flye assembly parameters')
     group.add_argument('--fl-h', action='store_true', help='Nanopore reads are from HQ (sup, Q20) basecaller')
 
-    # Perform the parsing
-    args = parser.parse_args()
+    return parser
 
-    # Parse targets and translate to workflow arguments
-    targets = []
-    try:
-        targets = list(map(lambda t: UserTargets(t.strip()), args.targets.split(',') if args.targets else []))
-    except ValueError as ve:
-        err_exit('invalid target: %s (try --list-available)', ve)
 
-    # Parse excludes and translate to workflow arguments
-    excludes = []
-    try:
-        excludes = list(map(lambda t_or_s: UserTargetOrService(t_or_s.strip()), args.exclude.split(',') if args.exclude else []))
-    except ValueError as ve:
-        err_exit('invalid exclude: %s (try --list-available)', ve)
-
-    # Parse and validate files into contigs and fastqs list
-    contigs = None
-    illufqs = list()
-    nanofq = None
-    for f in args.files:
-        if not os.path.isfile(f):
-            err_exit('no such file: %s', f)
-        if detect_filetype(f) == 'fasta':
-            if contigs:
-                err_exit('more than one FASTA file passed: %s', f)
-            contigs = os.path.abspath(f)
-        elif detect_filetype(f) == 'fastq':
-            if is_illumina_reads(f):
-                illufqs.append(os.path.abspath(f))
-            elif is_nanopore_reads(f):
-                if nanofq:
-                    err_exit('more than one Nanopore fastq file passed: %s', f)
-                nanofq = os.path.abspath(f)
-            else:
-                err_exit('cannot detect whether file has Illumina or Nanopore reads: %s', f)
-        else:
-            err_exit("file is neither FASTA not fastq: %s" % f)
+def main():
+    '''BAP main program.'''
 
-    if len(illufqs) > 2:
-        err_exit('more than two Illumina fastq files passed: %s', f)
-    if illufqs and nanofq:
-        err_exit('pass either Illumina or Nanopore reads, not both')
-    if contigs and (illufqs or nanofq):
-        err_exit('pass either FASTQ or FASTA files, not both')
+    # Perform the parsing
+    parser = make_parser()
+    args = parser.parse_args()
 
     # Parse the --list_available
     if args.list_available:
         print('targets:', ','.join(t.value for t in UserTargets))
         print('services:', ','.join(s.value for s in Services))
 
+    # The stage dir must exist, as we create a directory per run below it
+    if args.stage_dir:
+        if not os.path.isdir(args.stage_dir):
+            err_exit('no such directory for --stage-dir: %s', args.stage_dir)
+        args.stage_dir = os.path.abspath(args.stage_dir)
+
+    # The cache dir may be relative, and we change to out-dir below
+    if args.cache_dir:
+        args.cache_dir = os.path.abspath(args.cache_dir)
+
+    # Hand off to batch or service mode if a sample sheet, inbox, or port was given
+    if len(list(filter(None, [args.batch, args.serve_dir, args.serve_http, args.reanalyse, args.replay]))) > 1:
+        err_exit('pass only one of --batch, --serve-dir, --serve-http, --reanalyse, --replay')
+    elif args.reanalyse or args.replay:
+        return run_reanalyse(parser, args)
+    elif args.batch or args.serve_dir or args.serve_http:
+        if args.files:
+            err_exit('pass either input files or --batch/--serve-dir/--serve-http, not both')
+        if args.batch:
+            return run_batch(parser, args)
+        elif args.serve_dir:
+            return run_serve(parser, args)
+        else:
+            return run_http(parser, args)
+
+    # Parse targets and excludes, and validate files into contigs and fastqs
+    try:
+        parse_targets(args.targets, args.exclude)
+        contigs, illufqs, nanofq = classify_inputs(args.files)
+        validate_inputs(args, [ (contigs, illufqs, nanofq) ])
+    except UserException as e:
+        err_exit(str(e))
+
     # Exit when no contigs and/or fastqs were provided
     if not contigs and not illufqs and not nanofq:
         if not args.list_available:
@@ -205,6 +595,12 @@ per line, in a text file and pass this file with @FILENAME.
         err_exit('no such directory for --db-root: %s', args.db_root)
     db_root = os.path.abspath(args.db_root)
 
+    # Open the profile store before changing directory, it may be relative
+    try:
+        profiles = open_profiles(args)
+    except UserException as e:
+        err_exit(str(e))
+
     # Now that path handling has been done, and all file references made,
     # we can safely change the base working directory to out-dir.
     try:
@@ -214,114 +610,320 @@ per line, in a text file and pass this file with @FILENAME.
         err_exit('error creating or changing to --out-dir %s: %s', args.out_dir, str(e))
 
     # Generate sample id if not given
-    sample_id = args.id
-    if not sample_id:
-        if contigs:
-            _, fname = os.path.split(contigs)
-            sample_id, ext = os.path.splitext(fname)
-            if ext == '.gz':
-                sample_id, _ = os.path.splitext(sample_id)
-        elif illufqs:
-            # Try if it is pure Illumina
-            pat = re.compile(r'^(.*)_S[0-9]+_L[0-9]+_R[12]_[0-9]+\.fastq\.gz$')
-            _, fname = os.path.split(illufqs[0])
-            mat = pat.fullmatch(fname)
-            if mat:
-                sample_id = mat.group(1)
-            else: # no illumina, try to fudge something from common part
-                common = os.path.commonprefix(illufqs)
-                _, sample_id = os.path.split(common)
-                # sample_id now is the common part, chop any _ or _R
-                if sample_id[-2:] == "_R" or sample_id[-2:] == "_r":
-                    sample_id = sample_id[:-2]
-                elif sample_id[-1] == "_":
-                    sample_id = sample_id[:-1]
-        elif nanofq:
-            _, fname = os.path.split(nanofq)
-            sample_id, ext = os.path.splitext(fname)
-            if ext == '.gz':
-                sample_id, _ = os.path.splitext(sample_id)
-        if not sample_id:
-            sample_id = "SAMPLE"
+    sample_id = args.id if args.id else make_sample_id(contigs, illufqs, nanofq)
 
     # Set up the Workflow execution
-    blackboard = BAPBlackboard(args.verbose)
-    blackboard.start_run(SERVICE, VERSION, vars(args))
-    blackboard.put_db_root(db_root)
-    blackboard.put_sample_id(sample_id)
+    workflow, blackboard = make_workflow(args, sample_id, db_root, contigs, illufqs, nanofq)
 
-    # Set the workflow params based on user inputs present
-    params = list()
-    if contigs:
-        params.append(Params.CONTIGS)
-        blackboard.put_user_contigs_path(contigs)
-    if illufqs:
-        params.append(Params.ILLUREADS)
-        blackboard.put_illufq_paths(illufqs)
-    if nanofq:
-        params.append(Params.NANOREADS)
-        blackboard.put_nanofq_path(nanofq)
-    if args.species:
-        params.append(Params.SPECIES)
-        blackboard.put_user_species(list(filter(None, map(lambda x: x.strip(), args.species.split(',')))))
-    if args.plasmids:
-        params.append(Params.PLASMIDS)
-        blackboard.put_user_plasmids(list(filter(None, map(lambda x: x.strip(), args.plasmids.split(',')))))
+    # Use the cached results of an identical earlier run if there is one
+    cache = open_cache(args)
+    if complete_from_cache(cache, blackboard, '.'):
+        return 0
+
+    # Resume from the checkpoint if asked, and checkpoint from here on
+    try:
+        checkpoint_run(workflow, blackboard, '.')
+    except UserException as e:
+        err_exit(str(e))
 
-    # Pass the actual data via the blackboard
-    scheduler = SubprocessScheduler(args.max_cpus, args.max_mem, args.max_time, args.poll, not args.verbose)
-    executor = Executor(SERVICES, scheduler)
-    workflow = Workflow(DEPENDENCIES, params, targets, excludes)
-    executor.execute(workflow, blackboard)
-    blackboard.end_run(workflow.status.value)
-
-    # Write the JSON results file
-    with open('bap-results.json', 'w') as f_json:
-        json.dump(blackboard.as_dict(args.verbose), f_json)
-
-    # Write the TSV summary results file
-    with open('bap-summary.tsv', 'w') as f_tsv:
-        commasep = lambda l: ','.join(l) if l else ''
-        b = blackboard
-
-        # For computing cross-service metrics
-        nt_ctgs = int(b.get('services/ContigsMetrics/results/tot_len', 0))
-        nt_read = int(b.get('services/ReadsMetrics/results/bases', 0))
-        pct_q30 = float(b.get('services/ReadsMetrics/results/pct_q30', 0))
-
-        d = dict({
-            's_id': b.get_sample_id(),
-            'n_reads': b.get('services/ReadsMetrics/results/reads', 'NA'),
-            'nt_read': nt_read if nt_read else 'NA',
-            'pct_q30': pct_q30 if pct_q30 else 'NA',
-            'n_ctgs': b.get('services/ContigsMetrics/results/n_seqs', 'NA'),
-            'nt_ctgs': nt_ctgs if nt_ctgs else 'NA',
-            'n1': b.get('services/ContigsMetrics/results/n1', 'NA'),
-            'n50': b.get('services/ContigsMetrics/results/n50', 'NA'),
-            'l50': b.get('services/ContigsMetrics/results/l50', 'NA'),
-            'avg_dp': int(0.5 + nt_read / nt_ctgs) if nt_ctgs and nt_read else 'NA',
-            'q30_dp': int(0.5 + pct_q30 / 100 * nt_read / nt_ctgs) if nt_ctgs and nt_read and pct_q30 else 'NA',
-            'ref_len': b.get_closest_reference_length('NA'),
-            'pct_gc': b.get('services/ContigsMetrics/results/pct_gc', b.get('services/ReadsMetrics/results/pct_gc', 'NA')),
-            'species': commasep(b.get_detected_species([])),
-            'mlst': commasep(b.get_mlsts()),
-            'amr_cls': commasep(b.get_amr_classes()),
-            'amr_res': commasep(b.get_amr_antibiotics()),
-            'dis_res': commasep(b.get_dis_resistances()),
-            'vir_gen': commasep(b.get_virulence_genes()),
-            'plasmid': commasep(b.get_detected_plasmids([])),
-            'pmlsts': commasep(b.get_pmlsts()),
-            'cgst': commasep(b.get_cgmlsts()),
-            'amr_gen': commasep(b.get_amr_genes()),
-            'amr_mut': commasep(b.get_amr_mutations()),
-            'dis_gen': commasep(b.get_dis_genes())
-            })
-        print('#', '\t'.join(d.keys()), file=f_tsv)
-        print('\t'.join(map(lambda v: str(v) if v else '', d.values())), file=f_tsv)
+    # Pass the actual data via the blackboard; the BatchExecutor and queueing
+    # scheduler make the services on the critical path go first
+    scheduler = SampleScheduler(make_scheduler(args), sample_id, '.', cache, profiles=profiles)
+    executor = BatchExecutor(SERVICES, scheduler)
+    executor.add_run(workflow, blackboard)
+    executor.execute()
+
+    # Write the JSON results and TSV summary files
+    finish_run(cache, blackboard, workflow.status.value, '.', scheduler.job_dirs)
 
     # Done done
     return 0
 
 
+def run_batch(parser, args):
+    '''Run the BAP on every sample in the args.batch sample sheet, using a single
+       scheduler that shares the --max-cpus/--max-mem budget among all samples.'''
+
+    # Parse the sample sheet and the command-line options for each sample,
+    # layering the sample's options on top of the command-line defaults
+    try:
+        samples = read_sample_sheet(args.batch)
+        for s in samples:
+            s['args'] = sample_args(parser, s['options'], s['files'])
+            s['args'].id = s['id']
+            parse_targets(s['args'].targets, s['args'].exclude)
+            s['inputs'] = classify_inputs(s['args'].files)
+        validate_inputs(args, [ s['inputs'] for s in samples ], [ s['id'] for s in samples ])
+    except UserException as e:
+        err_exit(str(e))
+
+    # Check existence of the db_root directories (which a sample could override)
+    for s in samples:
+        if not os.path.isdir(s['args'].db_root):
+            err_exit('no such directory for --db-root: %s', s['args'].db_root)
+
+    # Create the batch output directory and per-sample directories beneath it
+    out_dir = os.path.abspath(args.out_dir)
+    try:
+        for s in samples:
+            s['args'].out_dir = os.path.join(out_dir, s['id'])
+            os.makedirs(s['args'].out_dir, exist_ok=True)
+    except Exception as e:
+        err_exit('error creating --out-dir %s: %s', out_dir, str(e))
+
+    # All samples share the one scheduler, each through its own SampleScheduler
+    scheduler = make_scheduler(args)
+    executor = BatchExecutor(SERVICES, scheduler)
+    cache = open_cache(args)
+
+    # Each sample's outputs are written as soon as its workflow is done
+    blackboards = list()
+    for s in samples:
+        try:
+            blackboards.append(start_sample(executor, scheduler, cache, s['args'], s['id'], s['inputs']))
+        except UserException as e:
+            err_exit('sample %s: %s', s['id'], str(e))
+
+    executor.execute()
+
+    # Write the combined summary over all samples, in sample sheet order
+    write_summary(os.path.join(out_dir, 'bap-summary.tsv'), blackboards)
+
+    return 0
+
+
+def run_reanalyse(parser, args):
+    '''Reanalyse the earlier runs whose output directories are in args.files, using
+       their recorded inputs and options.  Services whose backend version or
+       databases have changed since are rerun, along with all services that
+       depend on them.  The other services are replayed from their job outputs.
+       With args.replay, all completed services are replayed and none rerun.'''
+
+    if not args.files:
+        err_exit('no output directories to %s were given', 'replay' if args.replay else 'reanalyse')
+
+    # Check existence of the db_root directory
+    if not os.path.isdir(args.db_root):
+        err_exit('no such directory for --db-root: %s', args.db_root)
+    db_root = os.path.abspath(args.db_root)
+
+    # Replay runs no jobs, so has no use for the cache
+    scheduler = make_scheduler(args)
+    executor = BatchExecutor(SERVICES, scheduler)
+    cache = open_cache(args) if not args.replay else None
+    try:
+        profiles = open_profiles(args) if not args.replay else None
+    except UserException as e:
+        err_exit(str(e))
+
+    def run_done(run):
+        record_waits(scheduler, run.blackboard, run.scheduler.sample_id)
+        finish_run(cache, run.blackboard, run.workflow.status.value, run.scheduler.out_dir, run.scheduler.job_dirs)
+        print('BAP: %s %s: %s' % ('replayed' if args.replay else 'reanalysed',
+            run.scheduler.out_dir, run.workflow.status.value), file=sys.stderr)
+
+    for out_dir in args.files:
+        try:
+            results = load_results(out_dir)
+            a = recorded_args(args, results)
+            a.out_dir, a.db_root, a.files, a.reanalyse, a.replay = os.path.abspath(out_dir), db_root, [], False, False
+            parse_targets(a.targets, a.exclude)
+            inputs = recorded_inputs(results)
+            sample_id = a.id if a.id else make_sample_id(*inputs)
+
+            workflow, blackboard = make_workflow(a, sample_id, db_root, *inputs)
+            replay = completed_services(results) if args.replay else replayable_services(workflow, results, db_root)
+            blackboard.put('bap/run_info/replayed', sorted(replay))
+            checkpoint_run(workflow, blackboard, a.out_dir)
+
+        except UserException as e:
+            print('BAP: skipping %s: %s' % (out_dir, str(e)), file=sys.stderr)
+            continue
+
+        run_id = make_run_id(sample_id)
+        scheduler.set_weight(run_id, a.weight)
+        executor.add_run(workflow, blackboard, SampleScheduler(scheduler, run_id, a.out_dir, cache, replay, args.replay, profiles), run_done)
+
+    executor.execute()
+
+    return 0
+
+
+def run_serve(parser, args):
+    '''Run as a daemon that watches the args.serve_dir inbox for incoming samples,
+       and runs each on a single shared scheduler as soon as its files are complete.'''
+
+    # Check existence of the db_root directory
+    if not os.path.isdir(args.db_root):
+        err_exit('no such directory for --db-root: %s', args.db_root)
+    db_root = os.path.abspath(args.db_root)
+
+    # Validate the targets once, they are the same for every sample
+    try:
+        parse_targets(args.targets, args.exclude)
+    except UserException as e:
+        err_exit(str(e))
+
+    out_dir = os.path.abspath(args.out_dir)
+    summary = os.path.join(out_dir, 'bap-summary.tsv')
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+        watcher = InboxWatcher(args.serve_dir)
+    except Exception as e:
+        err_exit('cannot serve %s: %s', args.serve_dir, str(e))
+
+    scheduler = make_scheduler(args)
+    executor = BatchExecutor(SERVICES, scheduler)
+    cache = open_cache(args)
+
+    # The input files of the samples started, by sample id
+    sample_files = dict()
+
+    # Finished samples get a line in the combined summary
+    def sample_done(blackboard):
+        append_summary(summary, blackboard)
+        print('BAP: finished sample %s: %s' % (blackboard.get_sample_id(), blackboard.get('bap/run_info/status')), file=sys.stderr)
+
+    print('BAP: watching %s for incoming samples' % args.serve_dir, file=sys.stderr)
+
+    try:
+        while True:
+
+            # Wait for new samples only as long as there is nothing else to do
+            for sample_id, files in watcher.wait(0 if executor.is_busy() else None):
+
+                # Samples with the same name in different directories would share
+                # their output directory (and id), so the later ones are refused
+                sample_out = os.path.join(out_dir, sample_id)
+                earlier = sample_files.get(sample_id, recorded_files(sample_out))
+                if earlier is not None and earlier != set(files):
+                    print('BAP: skipping sample %s: its id is already taken by %s' % (sample_id, ' '.join(sorted(earlier))), file=sys.stderr)
+                    continue
+                elif earlier is not None:
+                    print('BAP: skipping sample %s: already done in %s' % (sample_id, sample_out), file=sys.stderr)
+                    continue
+
+                try:
+                    inputs = classify_inputs(files)
+                    validate_inputs(args, [ inputs ])
+                    os.makedirs(sample_out, exist_ok=True)
+                except Exception as e:
+                    print('BAP: skipping sample %s: %s' % (sample_id, str(e)), file=sys.stderr)
+                    continue
+
+                a = argparse.Namespace(**vars(args))
+                a.id, a.files, a.out_dir, a.db_root, a.serve_dir = sample_id, files, sample_out, db_root, None
+                print('BAP: started sample %s: %s' % (sample_id, ' '.join(files)), file=sys.stderr)
+                sample_files[sample_id] = set(files)
+                try:
+                    forget_db_fingerprints()
+                    start_sample(executor, scheduler, cache, a, sample_id, inputs, sample_done)
+                except UserException as e:
+                    print('BAP: skipping sample %s: %s' % (sample_id, str(e)), file=sys.stderr)
+
+            if executor.is_busy() and not executor.step():
+                scheduler.listen()
+
+    except KeyboardInterrupt:
+        print('BAP: interrupted, stopped watching %s' % args.serve_dir, file=sys.stderr)
+    finally:
+        watcher.close()
+
+    return 0
+
+
+def run_http(parser, args):
+    '''Run as a service that accepts jobs over HTTP on args.serve_http into a
+       durable queue, and executes them concurrently on one shared scheduler.'''
+
+    # Check existence of the db_root directory
+    if not os.path.isdir(args.db_root):
+        err_exit('no such directory for --db-root: %s', args.db_root)
+
+    host, _, port = args.serve_http.rpartition(':')
+    if not port.isdigit():
+        err_exit('invalid --serve-http port: %s', args.serve_http)
+
+    out_dir = os.path.abspath(args.out_dir)
+    results_file = lambda job_id: os.path.join(out_dir, job_id, 'bap-results.json')
+
+    # Validate a request and turn it into the args for its run, or raise UserException
+    def request_args(request):
+        files = request.get('files')
+        options = request.get('options', dict())
+        if not isinstance(files, list) or not files:
+            raise UserException('request must have a non-empty list of files')
+        if not isinstance(options, dict):
+            raise UserException('request options must be an object')
+        a = sample_args(parser, dict(map(lambda kv: (kv[0], str(kv[1])), options.items())), files)
+        a.id = request.get('id')
+        parse_targets(a.targets, a.exclude)
+        if not os.path.isdir(a.db_root):
+            raise UserException('no such directory for --db-root: %s', a.db_root)
+        return a, classify_inputs(a.files)
+
+    # Check a submitted request, reading its files in full if it has --validate; this
+    # runs in the request thread, so the loop below keeps the running jobs going, and
+    # for one request at a time, as the validation uses all of --max-cpus
+    validating = threading.Lock()
+    def check_request(request):
+        a, inputs = request_args(request)
+        with validating:
+            validate_inputs(a, [ inputs ])
+
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+        job_queue = JobQueue(os.path.join(out_dir, 'queue'))
+        server = JobServer((host if host else 'localhost', int(port)), job_queue, check_request, results_file, args.verbose)
+    except Exception as e:
+        err_exit('cannot serve on %s: %s', args.serve_http, str(e))
+
+    scheduler = make_scheduler(args)
+    executor = BatchExecutor(SERVICES, scheduler)
+    cache = open_cache(args)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('BAP: serving HTTP on %s:%d' % server.server_address[:2], file=sys.stderr)
+
+    try:
+        while True:
+
+            # Wait for new jobs only as long as there is nothing else to do
+            for job in job_queue.take(not executor.is_busy()):
+
+                job_id = job['id']
+                try:
+                    a, inputs = request_args(job['request'])
+                    a.out_dir = os.path.join(out_dir, job_id)
+                    os.makedirs(a.out_dir, exist_ok=True)
+                except Exception as e:
+                    job_queue.update(job_id, state=JobQueue.ERROR, error=str(e))
+                    continue
+
+                def job_done(blackboard, job_id=job_id):
+                    status = blackboard.get('bap/run_info/status')
+                    job_queue.update(job_id, state=JobQueue.COMPLETED if status == Workflow.Status.COMPLETED.value else JobQueue.FAILED,
+                        ended=blackboard.get('bap/run_info/time/end'))
+
+                sample_id = a.id if a.id else make_sample_id(*inputs)
+                job_queue.update(job_id, state=JobQueue.RUNNING, sample_id=sample_id)
+                try:
+                    forget_db_fingerprints()
+                    blackboard = start_sample(executor, scheduler, cache, a, sample_id, inputs, job_done)
+                    job_queue.update(job_id, started=blackboard.get('bap/run_info/time/start'))
+                except UserException as e:
+                    job_queue.update(job_id, state=JobQueue.ERROR, error=str(e))
+
+            if executor.is_busy() and not executor.step():
+                scheduler.listen()
+
+    except KeyboardInterrupt:
+        print('BAP: interrupted, stopped serving', file=sys.stderr)
+    finally:
+        server.shutdown()
+
+    return 0
+
+
 if __name__ == '__main__':
    main()
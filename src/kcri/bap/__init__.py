@@ -1,2 +1,13 @@
-__all__ = [ 'BAP', 'data', 'services', 'shims', 'workflow' ]
+__all__ = [ 'BAP', 'api', 'batch', 'cache', 'cgroups', 'checkpoint', 'data', 'downsample', 'executor', 'inbox', 'placement', 'profiles', 'reanalyse', 'scheduler', 'server', 'services', 'shims', 'slurm', 'staging', 'validate', 'workers', 'workflow' ]
 __version__ = "3.8.1"
+
+# The in-process API, see kcri.bap.api.  It is imported on first use, as it
+# imports all of the BAP and picoline, which the modules that jobs run under
+# (e.g. 'python3 -m kcri.bap.profiles') must do without
+_API_NAMES = [ 'run', 'get_runner', 'Runner' ]
+
+def __getattr__(name):
+    if name in _API_NAMES:
+        from . import api
+        return getattr(api, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.api - in-process Python API to the BAP
+#
+#   This module lets Python code run the BAP without spawning it as a process,
+#   and get the results back as a BAPBlackboard, e.g.
+#
+#       import kcri.bap
+#       bb = kcri.bap.run(['S1_R1.fq.gz', 'S1_R2.fq.gz'], 'DEFAULT,cgmlst',
+#                         { 'species': 'Escherichia coli', 'rf-i': 0.95 }, 'out/S1')
+#       print(bb.get_mlsts())
+#
+#   Unlike BAP.main(), run() does not change the working directory, and may
+#   be called concurrently from any number of threads.  All calls that pass
+#   the same scheduler (or none, to use the default one) share it, so that
+#   their jobs are scheduled within the same CPU and memory budget.
+#
+#   Each scheduler is driven by a Runner that executes the runs on its own
+#   thread.  This way the executor and scheduler, which are not thread-safe,
+#   are only ever touched from a single thread.
+#
+
+import os, queue, logging, threading
+from concurrent.futures import Future
+from pico.jobcontrol.subproc import SubprocessScheduler
+from .services import SERVICES
+from .executor import BatchExecutor
+from .scheduler import FairShareScheduler, EventScheduler, MemoryMonitor, psutil
+from .batch import options_to_argv
+from .cache import RunCache, forget_db_fingerprints
+from .shims.base import UserException
+from .BAP import make_parser, parse_targets, classify_inputs, validate_inputs, make_sample_id, start_sample
+
+# The Runner for each scheduler, by id of the scheduler
+_runners = dict()
+_runners_lock = threading.Lock()
+_default_scheduler = None
+
+
+### class Runner
+#
+#   Executes the BAP runs submitted to it, from any thread, on one scheduler.
+#   Runs are validated in the submitting thread, and executed on the Runner's
+#   own (daemon) thread, which drives a BatchExecutor over the scheduler.
+
+class Runner:
+    '''Executes BAP runs submitted from any thread on a shared scheduler.'''
+
+    def __init__(self, scheduler):
+        '''Create the runner for scheduler and start its thread.'''
+        self._scheduler = scheduler
+        self._executor = BatchExecutor(SERVICES, scheduler)
+        self._pending = queue.Queue()
+        self._active = dict()   # blackboard id -> (blackboard, future)
+        self._parser = make_parser()
+        self._parser.error = self._parse_error
+        self._parser_lock = threading.Lock()
+        threading.Thread(target=self._loop, name='BAP-runner', daemon=True).start()
+
+    def submit(self, inputs, targets='DEFAULT', options=None, out_dir='.'):
+        '''Submit a run of the BAP on the list of input files, for targets (a
+           comma-separated string or a list), with options (a dict of BAP long
+           option name to value, e.g. { 'species': ..., 'rf-i': 0.95 }), that
+           writes its output to out_dir.  Returns a Future whose result is the
+           BAPBlackboard of the finished run.  Raises UserException right away
+           if the inputs or options are invalid.'''
+
+        if isinstance(targets, (list, tuple)):
+            targets = ','.join(targets)
+        if isinstance(inputs, str):
+            inputs = [ inputs ]
+
+        with self._parser_lock:
+            options = dict(map(lambda kv: (kv[0], str(kv[1])), (options if options else dict()).items()))
+            args = self._parser.parse_args(options_to_argv(self._parser, options) +
+                        [ '--targets', targets, '--out-dir', out_dir ] + list(inputs))
+
+        # The modes of the command line make no sense here
+        args.batch = args.serve_dir = args.serve_http = None
+        args.reanalyse = args.replay = args.list_available = False
+        args.out_dir = os.path.abspath(args.out_dir)
+
+        parse_targets(args.targets, args.exclude)
+        inputs = classify_inputs(args.files)
+        if not any(inputs):
+            raise UserException('no input files were provided')
+        validate_inputs(args, [ inputs ])
+        if not os.path.isdir(args.db_root):
+            raise UserException('no such directory for --db-root: %s', args.db_root)
+
+        future = Future()
+        self._pending.put((args, inputs, future))
+        return future
+
+    def run(self, inputs, targets='DEFAULT', options=None, out_dir='.'):
+        '''Run the BAP like submit() does, and wait for it to finish.  Returns
+           the BAPBlackboard with the results.'''
+        return self.submit(inputs, targets, options, out_dir).result()
+
+    def _parse_error(self, message):
+        raise UserException('invalid options: %s', message)
+
+    def _loop(self):
+        '''Start pending runs, and step the executor, forever.'''
+        while True:
+
+            # Block for new runs only if there is nothing else to do
+            block = not self._executor.is_busy()
+            while True:
+                try:
+                    self._start(*self._pending.get(block))
+                    block = False
+                except queue.Empty:
+                    break
+
+            try:
+                if self._executor.is_busy() and not self._executor.step():
+                    self._scheduler.listen()
+            except Exception as e:
+                logging.exception(e)
+                self._fail_lost(e)
+
+    def _start(self, args, inputs, future):
+        '''Start the run for args on the executor, or fail its future.'''
+
+        def run_done(blackboard):
+            self._active.pop(id(blackboard), None)
+            future.set_result(blackboard)
+
+        try:
+            os.makedirs(args.out_dir, exist_ok=True)
+            cache = RunCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+            sample_id = args.id if args.id else make_sample_id(*inputs)
+            forget_db_fingerprints()
+            blackboard = start_sample(self._executor, self._scheduler, cache, args, sample_id, inputs, run_done)
+            if not future.done():
+                self._active[id(blackboard)] = (blackboard, future)
+        except Exception as e:
+            future.set_exception(e)
+
+    def _fail_lost(self, exc):
+        '''Fail the futures of the active runs that the executor no longer has.'''
+        running = set(map(lambda r: id(r.blackboard), self._executor.list_runs()))
+        for key in list(filter(lambda k: k not in running, self._active)):
+            _, future = self._active.pop(key)
+            future.set_exception(exc)
+
+
+def get_runner(scheduler=None):
+    '''Return the Runner for scheduler, creating it if needed.  If scheduler is
+       None, use the default scheduler, which shares all CPUs and memory fairly
+       between the runs (see the 'weight' option).'''
+    global _default_scheduler
+
+    with _runners_lock:
+        if scheduler is None:
+            if _default_scheduler is None:
+                monitor = MemoryMonitor() if psutil else None
+                _default_scheduler = FairShareScheduler(EventScheduler(SubprocessScheduler(None, None, None, 0, True), 5), monitor)
+            scheduler = _default_scheduler
+        runner = _runners.get(id(scheduler))
+        if runner is None:
+            runner = _runners[id(scheduler)] = Runner(scheduler)
+        return runner
+
+
+def run(inputs, targets='DEFAULT', options=None, out_dir='.', scheduler=None):
+    '''Run the BAP on the list of input files, for the targets (comma-separated
+       string or list), with options (dict of BAP long option name to value),
+       writing its output to out_dir, and return the BAPBlackboard with the
+       results.  The run's jobs are scheduled on scheduler, which may be shared
+       with other (concurrent) calls, or on the default scheduler if None.
+       Raises UserException if the inputs or options are invalid.'''
+    return get_runner(scheduler).run(inputs, targets, options, out_dir)
+
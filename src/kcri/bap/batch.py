@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.batch - sample sheet handling for BAP batch mode
+#
+#   A sample sheet is a tab-separated file with a header line naming its
+#   columns.  Column 'id' has the sample identifier, column 'files' has the
+#   comma-separated list of input files for the sample (relative paths are
+#   taken relative to the sample sheet).  All other columns are names of
+#   BAP options (e.g. 'species', 'targets', 'rf-i'), whose value for that
+#   sample overrides the value given on the command line.  Empty cells are
+#   ignored, as are empty lines and lines starting with '#' (except that a
+#   header line may start with '#').
+#
+#   Example:
+#
+#       id	files	species	targets
+#       S001	S001_R1.fq.gz,S001_R2.fq.gz	Escherichia coli	DEFAULT,cgmlst
+#       S002	asm/S002.fna
+#
+
+import os, re
+from .shims.base import UserException
+
+# Sample ids become directory names, so we restrict what they can be
+SAMPLE_ID_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+def read_sample_sheet(fname):
+    '''Parse the sample sheet fname, return a list of dicts with keys 'id',
+       'files' and 'options' (a dict of option name to value).  Raises
+       UserException with a descriptive message if the sheet is invalid.'''
+
+    if not os.path.isfile(fname):
+        raise UserException("no such sample sheet: %s", fname)
+
+    base_dir = os.path.dirname(os.path.abspath(fname))
+    samples = list()
+    header = None
+
+    with open(fname) as f:
+        for lno, line in enumerate(f, 1):
+
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+
+            if header is None:
+                header = [c.strip().lstrip('#').strip().lower() for c in line.split('\t')]
+                if 'id' not in header or 'files' not in header:
+                    raise UserException("sample sheet header must have columns 'id' and 'files': %s", fname)
+                continue
+
+            if line.startswith('#'):
+                continue
+
+            cells = [c.strip() for c in line.split('\t')]
+            if len(cells) > len(header):
+                raise UserException("sample sheet line %d has more cells than the header: %s", lno, fname)
+
+            row = dict(filter(lambda kv: kv[1], zip(header, cells)))
+
+            sample_id = row.pop('id', None)
+            if not sample_id:
+                raise UserException("sample sheet line %d has no sample id: %s", lno, fname)
+            if not SAMPLE_ID_RE.match(sample_id):
+                raise UserException("invalid sample id on line %d (use letters, digits, '.', '_', '-'): %s", lno, sample_id)
+            if any(s['id'] == sample_id for s in samples):
+                raise UserException("duplicate sample id on line %d: %s", lno, sample_id)
+
+            files = list(map(lambda p: os.path.join(base_dir, p.strip()),
+                    filter(None, row.pop('files', '').split(','))))
+            if not files:
+                raise UserException("sample sheet line %d has no files: %s", lno, sample_id)
+
+            samples.append({ 'id': sample_id, 'files': files, 'options': row })
+
+    if not samples:
+        raise UserException("sample sheet has no samples: %s", fname)
+
+    return samples
+
+
+def options_to_argv(parser, options):
+    '''Translate the options dict from a sample sheet row into a list of
+       command-line arguments that parser understands.  Option names may be
+       given with or without leading dashes, and with '_' or '-'.'''
+
+    argv = list()
+
+    for name, value in options.items():
+
+        opt = '--' + name.lstrip('-').replace('_', '-')
+        action = next(filter(lambda a: opt in a.option_strings, parser._actions), None)
+        if not action:
+            raise UserException("unknown option: %s", name)
+
+        # Flags (store_true) take a yes/no value in the sheet
+        if action.nargs == 0:
+            if value.lower() in ['1', 'y', 'yes', 'true']:
+                argv.append(opt)
+        else:
+            argv.extend([opt, value])
+
+    return argv
+
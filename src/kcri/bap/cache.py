@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.cache - content-addressed cache of BAP runs and service jobs
+#
+#   This module defines the RunCache, which stores the results of finished
+#   BAP runs under a key computed from the content of the input files, the
+#   user inputs that affect the results, the BAP and backend versions, and
+#   a fingerprint of the databases.  When the same inputs are submitted
+#   again, the results and service output directories are copied from the
+#   cache instead of running the workflow.
+#
+#   The RunCache also stores the output directories of individual backend
+#   jobs, keyed on their command line (with input files resolved to their
+#   content and databases to their fingerprint) and backend version.  When
+#   only some inputs of a run change (say, a ResFinder threshold), only the
+#   jobs that depend on them are executed, the others come from the cache.
+#
+#   Cache entries are directories under the cache directory, named by their
+#   key; job entries are in its 'jobs' subdirectory.  Each holds 'entry.json'
+#   with the data to restore, and a copy of the output directories.  The
+#   cache is kept below a maximum size by evicting the least recently used
+#   entries.
+#
+
+import os, json, shutil, hashlib, threading
+from datetime import datetime
+from pico.jobcontrol.job import Job
+from .shims.versions import BACKEND_VERSIONS
+from . import __version__
+
+# User inputs that do not affect the results, and are left out of the key
+VOLATILE_INPUTS = [
+    'id', 'out_dir', 'verbose', 'list_available', 'files', 'db_root',
+    'max_cpus', 'max_mem', 'max_time', 'poll', 'weight', 'elastic',
+    'mem_margin', 'max_readers', 'cgroup', 'numa', 'slurm', 'sbatch_opts',
+    'workers', 'min_workers',
+    'batch', 'serve_dir', 'serve_http', 'resume', 'reanalyse', 'replay', 'validate',
+    'cache_dir', 'cache_size', 'no_cache', 'profile_dir', 'stage_dir' ]
+
+# User inputs that hold paths to input files, which are keyed on content
+INPUT_FILES = [ 'contigs', 'illumina_fqs', 'nano_fq' ]
+
+# Placeholder for the run's output directory in the stored results
+OUT_DIR_PLACEHOLDER = '@BAP_OUT_DIR@'
+
+# Placeholder for directories (work, temp) on job command lines
+JOB_DIR_PLACEHOLDER = '@DIR@'
+
+# Placeholder for the CPUs and memory granted to elastic jobs on their command lines
+JOB_GRANT_PLACEHOLDER = '@GRANT@'
+
+# Subdirectory of the cache directory that holds the job entries
+JOBS_DIR = 'jobs'
+
+# Name of the file in which the (picoline) scheduler captures a job's stdout
+JOB_STDOUT = 'stdout'
+
+# Memo of file digests by (path, size, mtime), and of database fingerprints
+# by db root (for the duration of a run, see forget_db_fingerprints)
+_digests = dict()
+_db_fingerprints = dict()
+_lock = threading.Lock()
+
+
+def file_digest(path):
+    '''Return the SHA-256 hex digest of the content of the file at path.'''
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _lock:
+        if memo_key in _digests:
+            return _digests[memo_key]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(buf)
+    with _lock:
+        _digests[memo_key] = h.hexdigest()
+    return h.hexdigest()
+
+
+def db_fingerprint(db_root):
+    '''Return a fingerprint of the databases under db_root, computed from the
+       names, sizes and modification times of all files (not their content,
+       as the databases are far too big to hash on every run).'''
+    with _lock:
+        if db_root in _db_fingerprints:
+            return _db_fingerprints[db_root]
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(db_root, followlinks=True):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            path = os.path.join(dirpath, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            h.update(('%s\t%d\t%d\n' % (os.path.relpath(path, db_root), st.st_size, st.st_mtime_ns)).encode())
+    with _lock:
+        _db_fingerprints[db_root] = h.hexdigest()
+    return h.hexdigest()
+
+
+def forget_db_fingerprints():
+    '''Forget the memoised database fingerprints, so that they are computed
+       afresh.  Long-running processes (the daemons and the API) call this for
+       every new run, so that the run sees (and records) database updates.'''
+    with _lock:
+        _db_fingerprints.clear()
+
+
+def job_key(service, version, job_spec, db_root):
+    '''Return the cache key for the job_spec (a dict) of service at version.
+       Absolute paths on the command line are resolved to the content of the
+       file they point at, or the fingerprint of the database they are in.
+       Other directories (the work and temp dirs) do not affect the key.'''
+
+    db_root = os.path.abspath(db_root)
+
+    def resolve(arg):
+        if not isinstance(arg, str) or not os.path.isabs(arg):
+            return arg
+        elif arg == db_root or arg.startswith(db_root + os.sep):
+            db_dir = os.path.join(db_root, os.path.relpath(arg, db_root).split(os.sep)[0])
+            return 'db:%s:%s' % (os.path.relpath(arg, db_root), db_fingerprint(db_dir))
+        elif os.path.isfile(arg):
+            return 'file:%s' % file_digest(arg)
+        elif os.path.isdir(arg):
+            return JOB_DIR_PLACEHOLDER
+        else:
+            return arg
+
+    # Arguments can be comma-separated lists of paths (e.g. SKESA --reads)
+    args = list(map(lambda a: ','.join(map(resolve, a.split(','))) if isinstance(a, str) else a,
+                job_spec.get('args', list())))
+
+    h = hashlib.sha256(json.dumps({
+            'service': service,
+            'version': version,
+            'command': job_spec.get('command'),
+            'args': args
+        }, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
+### class CachedJob
+#
+#   Stands in for a backend Job whose output was copied from the cache, or
+#   that is replayed from an earlier run.  It is COMPLETED from the start, so
+#   the shim goes straight to collect_output.
+
+class CachedJob:
+    '''A completed job whose work directory was restored or is reused.'''
+
+    def __init__(self, name, job_dir, stdout=None):
+        self.name = name
+        self.state = Job.State.COMPLETED
+        self.error = None
+        self.stdout = os.path.join(job_dir, stdout) if stdout else None
+        self._job_dir = job_dir
+
+    def file_path(self, fname):
+        '''Return the path to fname in the job's work directory.'''
+        return os.path.join(self._job_dir, fname)
+
+
+### class RunCache
+#
+#   The cache proper.  It is safe to use from multiple threads, but not from
+#   multiple processes that share the cache directory and evict concurrently.
+
+class RunCache:
+    '''Size-capped LRU cache of BAP run and job results, keyed on content.'''
+
+    def __init__(self, cache_dir, max_gb):
+        '''Open or create the cache in cache_dir, capped at max_gb gigabytes.'''
+        os.makedirs(cache_dir, exist_ok=True)
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_bytes = int(max_gb * 1024 * 1024 * 1024)
+        self._lock = threading.Lock()
+
+    def run_key(self, blackboard):
+        '''Return the cache key for the run set up on blackboard.'''
+
+        inputs = dict(filter(lambda kv: kv[0] not in VOLATILE_INPUTS and kv[1] is not None,
+                        blackboard.get('bap/user_inputs', dict()).items()))
+
+        for k in INPUT_FILES:
+            v = inputs.get(k)
+            if isinstance(v, list):
+                inputs[k] = list(map(file_digest, v))
+            elif v:
+                inputs[k] = file_digest(v)
+
+        h = hashlib.sha256(json.dumps({
+                'bap': __version__,
+                'backends': BACKEND_VERSIONS,
+                'databases': db_fingerprint(blackboard.get_db_root()),
+                'inputs': inputs
+            }, sort_keys=True, default=str).encode())
+
+        return h.hexdigest()
+
+    def materialise(self, key, blackboard, out_dir):
+        '''If key is in the cache, copy its service output directories to out_dir
+           and its results to blackboard, and return the run status it had.
+           Return None if key is not in the cache.'''
+
+        entry_dir = os.path.join(self._cache_dir, key)
+        entry_file = os.path.join(entry_dir, 'entry.json')
+
+        with self._lock:
+            if not os.path.isfile(entry_file):
+                return None
+            os.utime(entry_file)    # marks it most recently used
+            with open(entry_file) as f:
+                entry = json.load(f)
+            for d in entry['job_dirs']:
+                shutil.copytree(os.path.join(entry_dir, d), os.path.join(out_dir, d), dirs_exist_ok=True)
+
+        data = json.loads(json.dumps(entry['data']).replace(OUT_DIR_PLACEHOLDER, os.path.abspath(out_dir)))
+
+        blackboard.put('services', data['services'])
+        for k, v in data['summary'].items():
+            if k != 'sample_id':
+                blackboard.put('bap/summary/%s' % k, v)
+        blackboard.put('bap/run_info/cache', { 'key': key, 'hit': True, 'stored': entry['stored'] })
+
+        return entry['status']
+
+    def store(self, key, blackboard, status, out_dir, job_dirs):
+        '''Store the results on blackboard of the run with status, and the listed
+           service job_dirs below out_dir, under key.  Then evict entries until
+           the cache is within its size limit.'''
+
+        out_dir = os.path.abspath(out_dir)
+        results = blackboard.as_dict(True)
+        data = json.dumps({
+                'services': results.get('services', dict()),
+                'summary': results.get('bap', dict()).get('summary', dict())
+            }).replace(out_dir + os.sep, OUT_DIR_PLACEHOLDER + os.sep)
+
+        entry_dir = os.path.join(self._cache_dir, key)
+        tmp_dir = entry_dir + '.tmp'
+
+        with self._lock:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+
+            size = 0
+            for d in job_dirs:
+                shutil.copytree(os.path.join(out_dir, d), os.path.join(tmp_dir, d), symlinks=True)
+                size += dir_size(os.path.join(tmp_dir, d))
+
+            with open(os.path.join(tmp_dir, 'entry.json'), 'w') as f:
+                json.dump({
+                    'status': status,
+                    'stored': datetime.now().isoformat(timespec='seconds'),
+                    'size': size,
+                    'job_dirs': list(job_dirs),
+                    'data': json.loads(data) }, f)
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+
+            self._evict()
+
+    def fetch_job(self, key, name, job_dir):
+        '''If job key is in the cache, copy its work directory to job_dir and
+           return a CachedJob called name for it.  Else return None.'''
+
+        entry_dir = os.path.join(self._cache_dir, JOBS_DIR, key)
+        entry_file = os.path.join(entry_dir, 'entry.json')
+
+        with self._lock:
+            if not os.path.isfile(entry_file):
+                return None
+            os.utime(entry_file)
+            with open(entry_file) as f:
+                entry = json.load(f)
+            shutil.rmtree(job_dir, ignore_errors=True)
+            shutil.copytree(os.path.join(entry_dir, 'files'), job_dir, symlinks=True)
+
+        return CachedJob(name, job_dir, entry.get('stdout'))
+
+    def store_job(self, key, job):
+        '''Store the work directory of the completed job under key, unless it
+           is already there.  Then evict entries to stay within the size limit.'''
+
+        if isinstance(job, CachedJob):
+            return
+
+        job_dir = job.file_path('')
+        stdout = os.path.relpath(job.stdout, job_dir) if job.stdout else None
+        if stdout and stdout.startswith(os.pardir):
+            return  # we would not restore it
+
+        entry_dir = os.path.join(self._cache_dir, JOBS_DIR, key)
+        tmp_dir = entry_dir + '.tmp'
+
+        with self._lock:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            shutil.copytree(job_dir, os.path.join(tmp_dir, 'files'), symlinks=True)
+
+            with open(os.path.join(tmp_dir, 'entry.json'), 'w') as f:
+                json.dump({
+                    'stored': datetime.now().isoformat(timespec='seconds'),
+                    'size': dir_size(os.path.join(tmp_dir, 'files')),
+                    'stdout': stdout }, f)
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+
+            self._evict()
+
+    def _evict(self):
+        '''Remove least recently used entries until we are within the size cap.'''
+
+        entries = list()
+        for top in [ self._cache_dir, os.path.join(self._cache_dir, JOBS_DIR) ]:
+            for key in os.listdir(top) if os.path.isdir(top) else []:
+                entry_file = os.path.join(top, key, 'entry.json')
+                if os.path.isfile(entry_file):
+                    with open(entry_file) as f:
+                        size = json.load(f).get('size', 0)
+                    entries.append((os.stat(entry_file).st_mtime, size, os.path.join(top, key)))
+
+        total = sum(e[1] for e in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+def dir_size(path):
+    '''Return the total size in bytes of the files below path.'''
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fname in filenames:
+            fpath = os.path.join(dirpath, fname)
+            if not os.path.islink(fpath):
+                total += os.path.getsize(fpath)
+    return total
+
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.cgroups - confining backend jobs to cgroup v2 limits
+#
+#   The picoline SubprocessScheduler only does the accounting of CPU and
+#   memory: a backend that takes more than its JobSpec says gets it, at the
+#   expense of the other jobs or the node.  This module enforces the limits,
+#   by running each job in its own cgroup v2 with the job's memory as its
+#   memory.max and its CPUs as its cpu.max.
+#
+#   The CgroupScheduler wraps the scheduler that runs the jobs, and has them
+#   run under this module ('python3 -m kcri.bap.cgroups CGROUP CPU MEM
+#   COMMAND ARGS...').  This creates the cgroup, runs the command in it, and
+#   writes its peak memory, CPU time and OOM kills to CGROUP_FILE in the
+#   job's work dir.  A job that is OOM-killed in its cgroup fails with an
+#   error that says so; other jobs are not affected.
+#
+#   The cgroup root must be a cgroup v2 directory that we may write, e.g.
+#   one delegated by systemd ('systemd-run --user --scope -p Delegate=yes').
+#   If the BAP itself runs in it, it is moved to a 'bap' leaf below it, as
+#   cgroups that have controllers enabled for their children cannot have
+#   processes of their own.
+#
+
+import sys, os, json, time, signal, itertools, subprocess
+from pico.jobcontrol.job import Job, JobSpec
+from .profiles import CGROUP_VAR
+from .shims.base import UserException
+
+# Name of the file in the job's work dir that receives its cgroup usage
+CGROUP_FILE = 'bap-cgroup.json'
+
+# The cpu.max period in microseconds
+CPU_PERIOD = 100000
+
+
+def read_cgroup_usage(job):
+    '''Return the cgroup usage dict the job wrote to CGROUP_FILE, or None.'''
+    try:
+        with open(job.file_path(CGROUP_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prepare_root(root):
+    '''Check that root is a writable cgroup v2 directory, move this process
+       out of it if it is in it, and enable the cpu and memory controllers for
+       its children.  Raises UserException if root cannot be used.'''
+
+    if not os.path.isfile(os.path.join(root, 'cgroup.controllers')):
+        raise UserException("not a cgroup v2 directory: %s", root)
+
+    with open(os.path.join(root, 'cgroup.controllers')) as f:
+        missing = { 'cpu', 'memory' } - set(f.read().split())
+    if missing:
+        raise UserException("cgroup %s lacks controllers: %s", root, ' '.join(sorted(missing)))
+
+    try:
+        with open(os.path.join(root, 'cgroup.procs')) as f:
+            if str(os.getpid()) in f.read().split():
+                os.makedirs(os.path.join(root, 'bap'), exist_ok=True)
+                with open(os.path.join(root, 'bap', 'cgroup.procs'), 'w') as f:
+                    f.write(str(os.getpid()))
+        with open(os.path.join(root, 'cgroup.subtree_control'), 'w') as f:
+            f.write('+cpu +memory')
+    except OSError as e:
+        raise UserException("cannot use cgroup %s: %s", root, str(e))
+
+
+### class CgroupScheduler
+#
+#   Wraps a scheduler and has every job it schedules run in a cgroup of its
+#   own under the cgroup root, limited to the CPUs and memory of its JobSpec.
+#   The jobs it returns tell when a job was killed for running out of memory.
+#   All other attributes are forwarded to the wrapped scheduler.
+
+class CgroupScheduler:
+    '''Scheduler layer that confines each job to its CPU and memory in a cgroup v2.'''
+
+    def __init__(self, scheduler, root):
+        '''Wrap scheduler, creating the job cgroups under root.  Raises
+           UserException if root is not a usable cgroup v2 directory.'''
+        self._scheduler = scheduler
+        self._root = os.path.abspath(root)
+        self._count = itertools.count(1)
+        prepare_root(self._root)
+
+    def schedule_job(self, name, spec, wdir):
+        '''Schedule the job to run in its own cgroup, returns a CgroupJob.'''
+        cgroup = os.path.join(self._root, 'job-%d-%d' % (os.getpid(), next(self._count)))
+        spec = JobSpec(sys.executable, [ '-m', 'kcri.bap.cgroups', cgroup, str(spec.cpu or 0), str(spec.mem or 0), spec.command ] +
+                    list(map(str, spec.args)), spec.cpu, spec.mem, spec.tim)
+        return CgroupJob(self._scheduler.schedule_job(name, spec, wdir))
+
+    def __getattr__(self, name):
+        return getattr(self._scheduler, name)
+
+
+### class CgroupJob
+#
+#   Proxy for a job run in a cgroup, whose error says if it was OOM-killed,
+#   and which has the cgroup_usage for the shim to record in its run_info.
+
+class CgroupJob:
+    '''Job run in a cgroup of its own.'''
+
+    def __init__(self, job):
+        self.job = job
+
+    @property
+    def cgroup_usage(self):
+        '''The usage dict the job wrote once it ended, or None.'''
+        done = self.job.state in [ Job.State.COMPLETED, Job.State.FAILED ]
+        return read_cgroup_usage(self.job) if done else None
+
+    @property
+    def error(self):
+        usage = self.cgroup_usage if self.job.state == Job.State.FAILED else None
+        if usage and usage.get('oom_kills'):
+            return "killed for exceeding its memory limit of %s GB" % usage.get('memory_max')
+        return self.job.error
+
+    def __getattr__(self, name):
+        return getattr(self.job, name)
+
+
+def confine(cgroup, cpu, mem, command):
+    '''Run command (a list) in a new cgroup at path cgroup, limited to cpu CPUs
+       and mem GB (no limit if 0), write its usage to CGROUP_FILE, and remove the
+       cgroup.  Signals that would end us are passed on.  Returns the exit code.'''
+
+    def write(fname, value):
+        with open(os.path.join(cgroup, fname), 'w') as f:
+            f.write(value)
+
+    def read(fname):
+        try:
+            with open(os.path.join(cgroup, fname)) as f:
+                return f.read()
+        except OSError:
+            return ''
+
+    os.mkdir(cgroup)
+    try:
+        write('memory.max', str(int(mem * 2**30)) if mem else 'max')
+        if os.path.exists(os.path.join(cgroup, 'memory.swap.max')):
+            write('memory.swap.max', '0')
+        write('cpu.max', '%d %d' % (cpu * CPU_PERIOD, CPU_PERIOD) if cpu else 'max %d' % CPU_PERIOD)
+
+        # The child moves itself into the cgroup before it execs the command,
+        # which is told its cgroup, so that the usage measurement can read it
+        try:
+            proc = subprocess.Popen(command, preexec_fn=lambda: write('cgroup.procs', '0'),
+                        env=dict(os.environ, **{ CGROUP_VAR: cgroup }))
+        except OSError as e:
+            print('cannot run %s: %s' % (command[0], str(e)), file=sys.stderr)
+            return 127
+
+        def forward(signum, frame):
+            proc.send_signal(signum)
+        for sig in [ signal.SIGTERM, signal.SIGINT, signal.SIGHUP ]:
+            signal.signal(sig, forward)
+
+        rc = proc.wait()
+
+        events = dict(l.split() for l in read('memory.events').splitlines() if l.strip())
+        cpu_stat = dict(l.split() for l in read('cpu.stat').splitlines() if l.strip())
+        peak = read('memory.peak').strip()
+        usage = {
+            'cpu_max': cpu,
+            'memory_max': mem,
+            'memory_peak': int(peak) / 2**30 if peak.isdigit() else None,
+            'cpu_time': int(cpu_stat.get('usage_usec', 0)) / 1e6,
+            'oom_kills': int(events.get('oom_kill', 0)) }
+
+        with open(CGROUP_FILE, 'w') as f:
+            json.dump(usage, f)
+
+        if usage['oom_kills']:
+            print('job was killed for exceeding its memory limit of %s GB' % mem, file=sys.stderr)
+            rc = rc if rc > 0 else 137
+
+        return rc
+
+    finally:
+        # Kill whatever the command left behind, then remove the cgroup
+        if os.path.exists(os.path.join(cgroup, 'cgroup.kill')):
+            write('cgroup.kill', '1')
+        for _ in range(50):
+            try:
+                os.rmdir(cgroup)
+                break
+            except OSError:
+                time.sleep(0.1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print('Usage: %s CGROUP CPU MEM COMMAND [ARGS...]' % sys.argv[0], file=sys.stderr)
+        sys.exit(2)
+    rc = confine(sys.argv[1], float(sys.argv[2]), float(sys.argv[3]), sys.argv[4:])
+    sys.exit(rc if rc >= 0 else 128 - rc)
+
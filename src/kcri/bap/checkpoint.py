@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.checkpoint - persisting and resuming the state of a BAP run
+#
+#   Every service execution saves a checkpoint of the blackboard to the run's
+#   output directory when it changes state (ServiceExecution._transition calls
+#   BAPBlackboard.save_checkpoint).  As the blackboard has the run_info status
+#   of every service, this is all we need to resume a run that was killed by
+#   a node reboot, OOM-kill, or Ctrl-C: the services that had completed are
+#   marked done in a fresh Workflow and their blackboard sections restored,
+#   so that only the remaining ones execute.
+#
+#   Some services also put outputs for the others to use in a section of the
+#   'bap' part of the blackboard (see SHARED_SECTIONS).  These are restored
+#   along with the service, or the services that still have to run would go
+#   on with other inputs than the ones that ran before.  If the files in the
+#   section are gone, the service is not resumed but runs again, unless they
+#   were released (removed because no service needs them any more).  A shared
+#   directory that is not restored is removed, as nothing else would.
+#
+#   The checkpoint is removed once the run has written its results.
+#
+
+import os, json, shutil
+from .cache import VOLATILE_INPUTS
+from .shims.base import UserException
+
+# Name of the checkpoint file in the run's output directory
+CHECKPOINT_FILE = 'bap-checkpoint.json'
+
+# The sections below 'bap' in which services leave outputs for the others
+SHARED_SECTIONS = { 'Downsampler': 'downsampling', 'Stager': 'staging' }
+
+
+def load_checkpoint(out_dir):
+    '''Return the checkpoint saved in out_dir as a dict, or None if there is none.'''
+    fname = os.path.join(out_dir, CHECKPOINT_FILE)
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except ValueError as e:
+        raise UserException("invalid checkpoint file %s: %s", fname, str(e))
+
+
+def remove_checkpoint(out_dir):
+    '''Remove the checkpoint file from out_dir, if it is there.'''
+    try:
+        os.remove(os.path.join(out_dir, CHECKPOINT_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def resume_run(workflow, blackboard, checkpoint):
+    '''Restore onto blackboard the sections of the services that completed in
+       checkpoint, and mark these completed in workflow, which must be fresh.
+       Returns the list of names of the services that were resumed.  Raises
+       UserException if the checkpoint was made for a run with other inputs.'''
+
+    strip = lambda d: dict(filter(lambda kv: kv[0] not in VOLATILE_INPUTS, d.items()))
+    if strip(checkpoint.get('bap', {}).get('user_inputs', {})) != strip(blackboard.get('bap/user_inputs', {})):
+        raise UserException("cannot resume: checkpoint was made for a run with different inputs or parameters")
+
+    services = checkpoint.get('services', dict())
+    shared = lambda s: checkpoint.get('bap', {}).get(SHARED_SECTIONS.get(s), {})
+    done = set(filter(lambda s: services[s].get('run_info', {}).get('status') == 'COMPLETED' and
+                (shared(s).get('released') or all(map(os.path.isfile, shared_files(shared(s))))), services))
+
+    resumed = mark_done(workflow, done)
+    for name in resumed:
+        blackboard.put('services/%s' % name, services[name])
+        if shared(name):
+            blackboard.put('bap/%s' % SHARED_SECTIONS[name], shared(name))
+
+    # The directories of the sections not restored would never be released
+    for name in filter(lambda s: s not in resumed, SHARED_SECTIONS):
+        if shared(name).get('dir') and not shared(name).get('released'):
+            shutil.rmtree(shared(name)['dir'], ignore_errors=True)
+
+    # The summary has the shared findings, which the services add to uniquely
+    for k, v in checkpoint.get('bap', {}).get('summary', {}).items():
+        if k != 'sample_id':
+            blackboard.put('bap/summary/%s' % k, v)
+
+    return resumed
+
+
+def shared_files(section):
+    '''Return the list of files in the 'files' of the shared section, which is
+       a list of paths, or a dict whose values are paths.'''
+    files = section.get('files', [])
+    return list(files.values()) if isinstance(files, dict) else list(files)
+
+
+def mark_done(workflow, done):
+    '''Mark completed in workflow the services whose names are in done, in
+       dependency order, by repeatedly taking them off its runnables.  Those
+       that never become runnable (as they depend on a service that is not
+       done) are left alone.  Returns the names of the services marked.'''
+
+    marked = list()
+    runnable = list(filter(lambda s: str(s) in done, workflow.list_runnable()))
+    while runnable:
+        for sid in runnable:
+            workflow.mark_started(sid)
+            workflow.mark_completed(sid)
+            marked.append(str(sid))
+        runnable = list(filter(lambda s: str(s) in done, workflow.list_runnable()))
+
+    return marked
+
@@ -5,7 +5,7 @@
 #   Defines the data structures that are shared across the BAP services.
 #
 
-import os, enum
+import os, enum, json
 from datetime import datetime
 from pico.workflow.blackboard import Blackboard
 
@@ -20,9 +20,24 @@ class BAPBlackboard(Blackboard):
     '''Adds to the generic Blackboard getters and putters specific to the shared
        data definitions in the current BAP.'''
 
+    _checkpoint_file = None
+
     def __init__(self, verbose=False):
         super().__init__(verbose)
 
+    # Checkpointing
+
+    def set_checkpoint_file(self, fname):
+        '''Make save_checkpoint() write the blackboard to fname (None to stop).'''
+        self._checkpoint_file = fname
+
+    def save_checkpoint(self):
+        '''Atomically write the blackboard to the checkpoint file, if one was set.'''
+        if self._checkpoint_file:
+            with open(self._checkpoint_file + '.tmp', 'w') as f:
+                json.dump(self.as_dict(True), f)
+            os.replace(self._checkpoint_file + '.tmp', self._checkpoint_file)
+
     # BAP-level methods
 
     def start_run(self, service, version, user_inputs):
@@ -88,6 +103,35 @@ class BAPBlackboard(Blackboard):
     def get_nanofq_path(self, default=None):
         return self.get_user_input('nano_fq', default)
 
+    def put_downsampled_paths(self, paths):
+        '''Stores the paths of the downsampled Illumina reads, which the services
+           then read instead of the user input (which is left as it was).'''
+        self.put('bap/downsampling/files', paths)
+
+    def get_downsampled_paths(self, default=None):
+        return self.get('bap/downsampling/files', default)
+
+    def put_staging_dir(self, path):
+        '''Stores the path to the run's directory of staged inputs.'''
+        self.put('bap/staging/dir', path)
+
+    def get_staging_dir(self, default=None):
+        return self.get('bap/staging/dir', default)
+
+    def put_staged_paths(self, staged):
+        '''Stores the dict of input paths to the paths of their staged copies.'''
+        self.put('bap/staging/files', staged)
+
+    def get_staged_paths(self, default=None):
+        return self.get('bap/staging/files', default)
+
+    def put_staging_released(self, time):
+        '''Stores the time that the staged inputs were removed.'''
+        self.put('bap/staging/released', time)
+
+    def get_staging_released(self, default=None):
+        return self.get('bap/staging/released', default)
+
     def put_user_contigs_path(self, path):
         '''Stores the contigs path as its own (pseudo) user input.'''
         self.put_user_input('contigs', path)
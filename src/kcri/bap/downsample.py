@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.downsample - downsampling reads to a target depth of coverage
+#
+#   Sequencers often deliver several hundred fold coverage of a bacterial
+#   genome, where the assembler and the read-based finders gain nothing above
+#   about 100x, while their run time grows with the amount of input.  This
+#   module is run as the job of the Downsampler service, and writes a random
+#   subset of the reads (pairs) that covers the genome at most DEPTH times:
+#
+#       python3 -m kcri.bap.downsample [-g SIZE] DEPTH FASTQ [FASTQ2]
+#
+#   The output files go in the current directory, with the names of the input
+#   files, and a JSON report of the counts goes to stdout.  When the reads do
+#   not exceed DEPTH, no files are written and the report says so.
+#
+#   The genome size is either given (-g), or estimated from the reads: the
+#   number of distinct k-mers that occur at least KMER_MIN_COUNT times in the
+#   first ESTIMATE_BASES of the reads.  To keep this fast and small, only the
+#   k-mers that start with KMER_PREFIX (or end in its reverse complement) are
+#   counted; these are found by regex, so Python only touches some 1 in 128.
+#   The count is scaled up by the fraction of k-mers in the reads that have
+#   the prefix, which also corrects for the GC content of the genome.
+#
+#   The subset is a uniform random sample of exactly as many reads as needed,
+#   as a reservoir sample would hold, but chosen by index after counting the
+#   reads in a first pass, so that the second pass can stream them to output
+#   rather than hold them in memory.  Mates are kept or dropped together.  The
+#   random generator is seeded, so the same inputs give the same output.
+#
+
+import sys, os, re, gzip, json, zlib, random, argparse
+from .validate import open_input
+
+# Parameters of the genome size estimate
+KMER_SIZE = 21
+KMER_PREFIX = b'ACAG'
+KMER_MIN_COUNT = 3
+ESTIMATE_BASES = 100 * 10**6
+
+# Seed for the random generator and gzip level of the output
+SEED = 42
+COMPRESS_LEVEL = 1
+
+# For reverse complementing the reads
+COMPLEMENT = bytes.maketrans(b'ACGTacgt', b'TGCAtgca')
+
+# Matches (overlapping) the prefix in group 1, or its reverse complement in group 2
+PREFIX_RE = re.compile(b'(?=(%s)|(%s))' % (KMER_PREFIX, KMER_PREFIX.translate(COMPLEMENT)[::-1]))
+
+
+def reads(f):
+    '''Generate the 4-line records (as lists of lines) in the open FASTQ file f.'''
+    lines = iter(f)
+    for head in lines:
+        yield [ head, next(lines, b''), next(lines, b''), next(lines, b'') ]
+
+
+def count_kmers(counts, seq):
+    '''Add to counts the sampled canonical k-mers of seq: those that start with
+       KMER_PREFIX or end in its reverse complement, so that a k-mer and its
+       reverse complement are both sampled or both not.  Returns the number of
+       k-mers in seq and the number of these that were sampled.'''
+    seq = seq.upper()
+    n = len(seq) - KMER_SIZE + 1
+    if n <= 0:
+        return 0, 0
+    starts = set()
+    for m in PREFIX_RE.finditer(seq):
+        i = m.start() if m.group(1) else m.start() + len(KMER_PREFIX) - KMER_SIZE
+        if 0 <= i < n:
+            starts.add(i)
+    for i in starts:
+        kmer = seq[i:i+KMER_SIZE]
+        kmer = min(kmer, kmer.translate(COMPLEMENT)[::-1])
+        counts[kmer] = counts.get(kmer, 0) + 1
+    return n, len(starts)
+
+
+def scan_reads(path, estimate=False):
+    '''Return the number of reads and bases in the FASTQ file at path, and if
+       estimate is True, the estimated genome size (else None).'''
+    n_reads = n_bases = n_kmers = n_sampled = 0
+    counts = dict() if estimate else None
+    with open_input(path) as f:
+        for rec in reads(f):
+            seq = rec[1].rstrip(b'\r\n')
+            n_reads += 1
+            n_bases += len(seq)
+            if counts is not None and n_bases <= ESTIMATE_BASES:
+                n, s = count_kmers(counts, seq)
+                n_kmers += n
+                n_sampled += s
+    if not n_sampled:
+        return n_reads, n_bases, None
+    solid = sum(1 for c in counts.values() if c >= KMER_MIN_COUNT)
+    return n_reads, n_bases, round(solid * n_kmers / n_sampled)
+
+
+def sample_reads(paths, out_paths, n_reads, keep, seed=SEED):
+    '''Write the same random keep of the n_reads records in each of paths
+       (the mate files) to the gzipped out_paths.'''
+    picks = sorted(random.Random(seed).sample(range(n_reads), keep))
+    picks.append(n_reads)   # sentinel
+    ins = [ open_input(p) for p in paths ]
+    outs = [ gzip.open(p, 'wb', compresslevel=COMPRESS_LEVEL) for p in out_paths ]
+    try:
+        nxt = 0
+        for i, recs in enumerate(zip(*map(reads, ins))):
+            if i == picks[nxt]:
+                for rec, out in zip(recs, outs):
+                    out.writelines(rec)
+                nxt += 1
+                if nxt == keep:
+                    break
+    finally:
+        for f in ins + outs:
+            f.close()
+
+
+def downsample(depth, paths, genome_size=None, seed=SEED):
+    '''Downsample the reads in paths (one file, or the two mate files) to at
+       most depth fold coverage of a genome of genome_size bases (estimated
+       if None), writing the output files to the current directory.  Returns
+       the dict of counts, with the output paths in 'files' if any.'''
+
+    n_reads, n_bases, estimate = scan_reads(paths[0], not genome_size)
+    n_bases *= len(paths)   # mates taken to be as long
+
+    if not genome_size:
+        if not estimate:
+            raise ValueError('cannot estimate the genome size from the reads')
+        genome_size = estimate
+
+    ret = {
+        'reads': n_reads,
+        'bases': n_bases,
+        'genome_size': genome_size,
+        'depth': round(n_bases / genome_size, 1),
+        'max_depth': depth,
+        'downsampled': False
+    }
+
+    if n_bases <= depth * genome_size:
+        return ret
+
+    keep = max(1, round(n_reads * depth * genome_size / n_bases))
+    out_paths = list()
+    for p in paths:
+        fname = os.path.basename(p)
+        out_paths.append(os.path.abspath(fname if fname.endswith('.gz') else fname + '.gz'))
+
+    sample_reads(paths, out_paths, n_reads, keep, seed)
+
+    ret.update({
+        'downsampled': True,
+        'kept_reads': keep,
+        'kept_bases': round(n_bases * keep / n_reads),
+        'files': out_paths
+    })
+    return ret
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Downsample reads to a target depth of coverage.')
+    parser.add_argument('-g', '--genome-size', metavar='BP', type=int, help="genome size (default: estimate from the reads)")
+    parser.add_argument('-s', '--seed', metavar='N', type=int, default=SEED, help="seed for the random sample [%d]" % SEED)
+    parser.add_argument('depth', metavar='DEPTH', type=float, help="maximum depth of coverage to keep")
+    parser.add_argument('fastqs', metavar='FASTQ', nargs='+', help="reads file, or the two mate files")
+    args = parser.parse_args()
+
+    if len(args.fastqs) > 2:
+        parser.error('at most two FASTQ files can be given')
+
+    try:
+        json.dump(downsample(args.depth, args.fastqs, args.genome_size, args.seed), sys.stdout)
+        print()
+    except (OSError, EOFError, ValueError, zlib.error) as e:
+        print('downsample: %s' % str(e), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.executor - executes multiple BAP workflows on a shared scheduler
+#
+#   This module defines the BatchExecutor, which drives any number of
+#   workflows (each with its own blackboard) to completion, scheduling the
+#   jobs of all of them on a single scheduler, and the SampleScheduler,
+#   which wraps that shared scheduler for the jobs of a single sample.
+#
+#   The generic pico.workflow.executor.Executor executes a single workflow
+#   and owns its scheduler.  When many samples are processed in one go, we
+#   want one global view of resources, hence this module.
+#
+
+import os, shutil, logging
+from pico.workflow.logic import Workflow
+from pico.workflow.executor import Task
+from .cache import CachedJob, JOB_STDOUT
+from .scheduler import FairShareScheduler
+from .staging import release_staged
+from .workflow import SERVICE_PRIORITIES, is_superfluous, reads_in_use
+from .shims.base import SkipException, UserException
+
+
+### class SampleScheduler
+#
+#   Wraps a (shared) scheduler so that the jobs of a single sample have their
+#   work directories rooted in the sample's output directory, and job names
+#   prefixed with the sample id.  Keeps the list of the top level job dirs
+#   it created.  If it has a cache, jobs scheduled with a cache key are taken
+#   from the cache when there.  If it has a replay dict, the services named
+#   in it reuse the jobs already in out_dir (see replay_job), and the work
+#   dirs of all other jobs are cleared before these run, unless replay_only
+#   is set, in which case no jobs are run at all.  If it has profiles (a
+#   ProfileStore), the shims run their jobs under usage measurement, and
+#   reserve the resources estimated from it.  All other attributes
+#   (notably max_cpu and max_mem, which shims use) are forwarded to the
+#   wrapped scheduler.
+
+class SampleScheduler:
+    '''Scheduler proxy that roots the jobs for one sample in its own directory.'''
+
+    def __init__(self, scheduler, sample_id, out_dir, cache=None, replay=None, replay_only=False, profiles=None):
+        '''Wrap scheduler for jobs of sample_id, which go in out_dir, and
+           take jobs from cache (a RunCache) if given.  Replay maps the names
+           of the services whose jobs in out_dir are to be reused to their
+           recorded run_info.  If replay_only, refuse to schedule other jobs.
+           Profiles is the ProfileStore for the shims to use, if any.'''
+        self._scheduler = scheduler
+        self.sample_id = sample_id
+        self.out_dir = out_dir
+        self.cache = cache
+        self.replay = replay
+        self.replay_only = replay_only
+        self.profiles = profiles
+        self.job_dirs = list()
+
+    def schedule_job(self, name, spec, wdir=None, cache_key=None, priority=None, runtime=None):
+        '''Schedule the job on the shared scheduler, in wdir below out_dir.
+           If cache_key is in the cache, return the cached job instead.  The
+           priority and expected runtime are passed on if the shared scheduler
+           is a FairShareScheduler.'''
+        wdir = wdir if wdir else name
+        top_dir = os.path.normpath(wdir).split(os.sep)[0]
+        if top_dir not in self.job_dirs:
+            self.job_dirs.append(top_dir)
+
+        name = '%s:%s' % (self.sample_id, name)
+        wdir = os.path.normpath(os.path.join(self.out_dir, wdir))
+
+        job = self.cache.fetch_job(cache_key, name, wdir) if self.cache and cache_key else None
+        if job:
+            return job
+
+        # When replaying, what is in wdir is the output of an outdated job
+        if self.replay_only:
+            raise UserException("no job output to replay in: %s", wdir)
+        elif self.replay is not None:
+            shutil.rmtree(wdir, ignore_errors=True)
+
+        if isinstance(self._scheduler, FairShareScheduler):
+            return self._scheduler.schedule_job(name, spec, wdir, priority if priority is not None else (0, 0), runtime)
+        return self._scheduler.schedule_job(name, spec, wdir)
+
+    def grant_resources(self, cpu_range, mem_range):
+        '''Return the (cpu, mem) grant for an elastic job of this sample, from the
+           shared scheduler if it does grants, else the most it can have.'''
+        if isinstance(self._scheduler, FairShareScheduler):
+            return self._scheduler.grant_resources(self.sample_id, cpu_range, mem_range)
+        return min(self.max_cpu, cpu_range[1]), min(int(self.max_mem), mem_range[1])
+
+    def replay_job(self, name, wdir):
+        '''Return the completed job already present in wdir below out_dir, or
+           None if there is none.  Nothing is scheduled.'''
+        top_dir = os.path.normpath(wdir).split(os.sep)[0]
+        if top_dir not in self.job_dirs:
+            self.job_dirs.append(top_dir)
+        wdir = os.path.normpath(os.path.join(self.out_dir, wdir))
+        return CachedJob('%s:%s' % (self.sample_id, name), wdir, JOB_STDOUT) if os.path.isdir(wdir) else None
+
+    def __getattr__(self, name):
+        return getattr(self._scheduler, name)
+
+
+### class BatchRun
+#
+#   Holds the state of one workflow execution in the BatchExecutor.
+
+class BatchRun:
+    '''The execution state of a single workflow in a batch.'''
+
+    def __init__(self, workflow, blackboard, scheduler, on_done=None):
+        self.workflow = workflow
+        self.blackboard = blackboard
+        self.scheduler = scheduler
+        self.on_done = on_done
+        self.tasks = dict()
+
+    def is_done(self):
+        '''Return True if the workflow has completed or failed.'''
+        return self.workflow.status in [ Workflow.Status.COMPLETED, Workflow.Status.FAILED ]
+
+
+### class BatchExecutor
+#
+#   Executes a batch of workflows concurrently against one scheduler.  Each
+#   iteration starts the runnable services of every workflow, in order of
+#   their SERVICE_PRIORITIES, then waits on the scheduler for job state
+#   changes, and feeds the task states back into their workflows.  Services
+#   that can no longer change the outcome of their workflow are cancelled,
+#   and staged reads are removed as soon as no service can still read them.
+
+class BatchExecutor:
+    '''Executes any number of workflows to completion on a shared scheduler.'''
+
+    def __init__(self, services, scheduler):
+        '''Construct executor for the services map, using the shared scheduler.'''
+        self._services = services
+        self._scheduler = scheduler
+        self._runs = list()
+
+    def add_run(self, workflow, blackboard, scheduler=None, on_done=None):
+        '''Add workflow for execution writing to blackboard and scheduling its jobs
+           on scheduler (which must wrap the shared scheduler, the default).  If
+           on_done is given, it is called with the BatchRun when it finishes.
+           Runs may be added at any time, also while the executor is running.'''
+        run = BatchRun(workflow, blackboard, scheduler if scheduler else self._scheduler, on_done)
+        self._runs.append(run)
+        return run
+
+    def is_busy(self):
+        '''Return True if any added run has not yet finished.'''
+        return len(self._runs) > 0
+
+    def list_runs(self):
+        '''Return the list of runs that have not yet finished.'''
+        return list(self._runs)
+
+    def execute(self):
+        '''Execute all added runs, returning when every workflow has finished.'''
+        while self.is_busy():
+            # Only block on the scheduler when nothing moved this iteration
+            if not self.step():
+                self._scheduler.listen()
+
+    def step(self):
+        '''Perform one non-blocking round over all unfinished runs, reporting on
+           their started tasks and starting their runnable services.  Finished
+           runs are removed (after their on_done is called).  Returns True if
+           anything changed, False if we can only wait for the scheduler.'''
+
+        changed = False
+        for run in list(self._runs):
+            changed = self._step(run) or changed
+
+        for run in list(filter(BatchRun.is_done, self._runs)):
+            self._runs.remove(run)
+            if run.on_done:
+                run.on_done(run)
+
+        return changed
+
+    def _step(self, run):
+        '''Report on the started tasks of run and start its runnable services.
+           Returns True if anything changed in the workflow.'''
+
+        changed = False
+        workflow = run.workflow
+
+        for sid in workflow.list_started():
+            task = run.tasks.get(sid)
+            try:
+                state = task.report() if task else Task.State.FAILED
+            except Exception as e:
+                # A shim bug must not take down the other services and runs
+                logging.exception(e)
+                run.blackboard.put('services/%s/run_info/status' % sid, 'FAILED')
+                run.blackboard.append_to('services/%s/errors' % sid, str(e))
+                state = Task.State.FAILED
+            if state == Task.State.COMPLETED:
+                workflow.mark_completed(sid)
+                changed = True
+            elif state == Task.State.FAILED:
+                workflow.mark_failed(sid)
+                changed = True
+
+        # Cancel the services that can no longer change the outcome: all of
+        # them once the workflow is done, else those whose alternatives completed
+        completed = workflow.list_completed()
+        for sid in workflow.list_started():
+            task = run.tasks.get(sid)
+            if not task:
+                continue
+            elif run.is_done():
+                task.cancel('workflow %s before it finished' % workflow.status.value.lower())
+                changed = True
+            elif is_superfluous(sid, completed):
+                task.cancel('an alternative to it completed')
+                workflow.mark_failed(sid)
+                changed = True
+
+        # Start the services that others wait on first, so their jobs queue first
+        if not run.is_done():
+            for sid in sorted(workflow.list_runnable(), key=lambda s: SERVICE_PRIORITIES.get(s, (0, 0)), reverse=True):
+                self._start_task(run, sid)
+                changed = True
+
+        # Remove the staged reads once the last service that reads them is done
+        if run.blackboard.get_staging_dir() and (run.is_done() or
+                not reads_in_use(workflow.list_started(), workflow.list_runnable())):
+            release_staged(run.blackboard)
+
+        return changed
+
+    def _start_task(self, run, sid):
+        '''Start the service sid for run, recording skips and errors on its blackboard.'''
+
+        run.workflow.mark_started(sid)
+
+        try:
+            run.tasks[sid] = self._services[sid].execute(sid, None, run.blackboard, run.scheduler)
+
+        except SkipException as e:
+            run.blackboard.put('services/%s/run_info/status' % sid, 'SKIPPED')
+            run.blackboard.append_to('services/%s/warnings' % sid, str(e))
+
+        except Exception as e:
+            logging.exception(e)
+            run.blackboard.put('services/%s/run_info/status' % sid, 'FAILED')
+            run.blackboard.append_to('services/%s/errors' % sid, str(e))
+
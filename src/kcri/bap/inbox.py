@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.inbox - watches an inbox directory for incoming sample files
+#
+#   This module defines the InboxWatcher, which uses Linux inotify to watch
+#   a directory tree (e.g. the output folder of a sequencer) for completed
+#   reads and contigs files, and groups these into samples.
+#
+#   A file counts as complete when its writer closes it, or when it is moved
+#   into the tree (as rsync and most copy tools do when done).  Files that are
+#   already there when a directory is first watched (at startup, or when the
+#   directory is created or moved in) may still be being written: these count
+#   as complete when their writer closes them, or when their size and mtime
+#   have not changed for STABLE_TIME seconds.  Illumina reads
+#   files named like SAMPLE_S1_L001_R1_001.fastq.gz are paired on everything
+#   but their R1/R2 part; a sample is ready once both files are complete.
+#   FASTA files (.fa, .fna, .fasta, .fsa, optionally .gz) are each a sample.
+#
+
+import os, re, time, select, struct, ctypes, ctypes.util
+from .shims.base import UserException
+
+# Illumina file name pattern (groups: sample, sample number and lane, read, chunk)
+ILLUMINA_FQ_RE = re.compile(r'^(.*)_(S[0-9]+_L[0-9]+)_R([12])_([0-9]+)\.fastq\.gz$')
+
+# FASTA file name pattern (group: sample)
+FASTA_RE = re.compile(r'^(.*)\.(fa|fna|fasta|fsa)(\.gz)?$')
+
+# Seconds that a file found in a directory must not change to count as complete
+STABLE_TIME = 10
+
+# The inotify constants we need, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = os.O_CLOEXEC
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HDR = struct.Struct('iIII')   # wd, mask, cookie, len
+
+
+### class InboxWatcher
+#
+#   Watches a directory tree and returns samples as their files complete.
+#   Files that are present when a directory is first watched are complete once
+#   they were closed, or have been stable for STABLE_TIME seconds.
+
+class InboxWatcher:
+    '''Watches the inbox directory tree for samples whose files are complete.'''
+
+    def __init__(self, inbox):
+        '''Start watching the directory tree rooted at inbox.'''
+
+        if not os.path.isdir(inbox):
+            raise UserException("no such directory: %s", inbox)
+
+        libc_name = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libc_name if libc_name else 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise UserException("inotify is not available on this platform")
+
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise UserException("failed to initialise inotify: %s", os.strerror(ctypes.get_errno()))
+
+        self._inbox = os.path.abspath(inbox)
+        self._watches = dict()      # watch descriptor -> directory path
+        self._halves = dict()       # pair key -> { '1': path, '2': path }
+        self._seen = set()          # paths of files that we handed out
+        self._unsure = dict()       # path of file found by listing -> (size, mtime, since)
+        self._ready = list()        # samples ready to be handed out
+
+        self._add_tree(self._inbox)
+
+    def fileno(self):
+        '''Return the inotify file descriptor, for use with select.'''
+        return self._fd
+
+    def close(self):
+        '''Stop watching.'''
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def wait(self, timeout=None):
+        '''Wait up to timeout seconds (forever if None, not at all if 0) for
+           samples to complete.  Returns the list of (sample_id, files) tuples
+           that became ready, in order of completion.'''
+
+        self._check_unsure()
+        if not self._ready:
+            if self._unsure:
+                timeout = STABLE_TIME if timeout is None else min(timeout, STABLE_TIME)
+            rlist, _, _ = select.select([self._fd], [], [], timeout)
+            if rlist:
+                self._read_events()
+            self._check_unsure()
+
+        ready, self._ready = self._ready, list()
+        return ready
+
+    def _read_events(self):
+        '''Read and process all queued inotify events.'''
+
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            if not buf:
+                return
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, size = EVENT_HDR.unpack_from(buf, pos)
+                pos += EVENT_HDR.size
+                name = buf[pos:pos+size].rstrip(b'\0').decode(errors='replace')
+                pos += size
+
+                if mask & IN_Q_OVERFLOW:
+                    self._add_tree(self._inbox)
+                elif mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                elif wd in self._watches:
+                    path = os.path.join(self._watches[wd], name)
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            self._add_tree(path)
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        self._unsure.pop(path, None)
+                        self._file_complete(path)
+
+    def _add_tree(self, top):
+        '''Watch top and its subdirectories, and pick up the files already there
+           once they are stable.  We add the watch before listing, so that no
+           file can slip through.'''
+
+        for dirpath, dirnames, filenames in os.walk(top):
+
+            if dirpath not in self._watches.values():
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), WATCH_MASK)
+                if wd < 0:
+                    raise UserException("failed to watch %s: %s", dirpath, os.strerror(ctypes.get_errno()))
+                self._watches[wd] = dirpath
+
+            for fname in sorted(filenames):
+                path = os.path.join(dirpath, fname)
+                if path not in self._seen and path not in self._unsure:
+                    try:
+                        st = os.stat(path)
+                        self._unsure[path] = (st.st_size, st.st_mtime_ns, min(time.time(), st.st_mtime))
+                    except OSError:
+                        pass
+
+    def _check_unsure(self):
+        '''Complete the files found by listing that have not changed for
+           STABLE_TIME seconds (counting from their mtime when first seen),
+           and forget those that are gone.'''
+
+        now = time.time()
+        for path, (size, mtime, since) in sorted(self._unsure.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._unsure[path]
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                self._unsure[path] = (st.st_size, st.st_mtime_ns, now)
+            elif now - since >= STABLE_TIME:
+                del self._unsure[path]
+                self._file_complete(path)
+
+    def _file_complete(self, path):
+        '''Register that the file at path is complete, and queue the sample it
+           belongs to if that is now complete too.'''
+
+        dirname, fname = os.path.split(path)
+        if path in self._seen or fname.startswith('.') or not os.path.isfile(path):
+            return
+
+        mat = ILLUMINA_FQ_RE.fullmatch(fname)
+        if mat:
+            sample, s_l, read, chunk = mat.groups()
+            key = os.path.join(dirname, '%s_%s_R_%s' % (sample, s_l, chunk))
+            halves = self._halves.setdefault(key, dict())
+            halves[read] = path
+            if len(halves) == 2:
+                del self._halves[key]
+                lane = s_l.split('_')[1]
+                sample_id = sample if lane == 'L001' else '%s_%s' % (sample, lane)
+                self._queue(sample_id, [ halves['1'], halves['2'] ])
+            return
+
+        mat = FASTA_RE.fullmatch(fname)
+        if mat:
+            self._queue(mat.group(1), [ path ])
+
+    def _queue(self, sample_id, files):
+        self._seen.update(files)
+        self._ready.append((sample_id, files))
+
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.placement - placing backend jobs on CPUs and NUMA nodes
+#
+#   Left to the OS, the threads of a job wander over all CPUs, and on a
+#   multi-socket machine away from the NUMA node that holds the job's memory.
+#   This hurts the kma-based services in particular, which do little else
+#   than look up k-mers in a database of several GB.
+#
+#   The PlacementScheduler wraps the scheduler that runs the jobs, and gives
+#   each job CPUs of its own: as many as its JobSpec says, all on one NUMA
+#   node if one has enough CPUs and memory free.  The job is then run under
+#   this module ('python3 -m kcri.bap.placement CPUS NODE COMMAND ARGS...'),
+#   which sets its CPU affinity and execs the command.  As Linux allocates
+#   memory on the node of the thread that first touches it, the job's memory
+#   mostly ends up on its node.  With the 'bind' policy it is bound to it
+#   (using numactl, when installed).
+#
+#   Jobs for which not enough CPUs are free (when jobs ask for more than
+#   there are, or --max-cpus exceeds the CPUs we may use) run unpinned.
+#
+
+import sys, os, glob, math, shutil
+from pico.jobcontrol.job import Job, JobSpec
+
+# The placement policies: run jobs anywhere, pin them to CPUs (on one node
+# where they fit), or also bind their memory to that node
+POLICIES = [ 'off', 'pin', 'bind' ]
+
+
+def parse_cpulist(text):
+    '''Return the set of CPUs in a Linux CPU list such as '0-3,8-11'.'''
+    cpus = set()
+    for part in filter(None, text.strip().split(',')):
+        lo, _, hi = part.partition('-')
+        cpus.update(range(int(lo), int(hi if hi else lo) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    '''Return the Linux CPU list for the set of cpus.'''
+    ranges = list()
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(map(lambda r: '%d-%d' % tuple(r) if r[0] != r[1] else str(r[0]), ranges))
+
+
+def read_topology():
+    '''Return the list of NUMA nodes as (node, cpus, mem) tuples, where cpus is
+       the set of CPUs on the node that we may run on, and mem its memory in GB.
+       If the system has no NUMA information, it is taken to be one node.'''
+
+    allowed = os.sched_getaffinity(0)
+    nodes = list()
+
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*'), key=lambda p: int(p.rsplit('node', 1)[1])):
+        try:
+            with open(os.path.join(path, 'cpulist')) as f:
+                cpus = parse_cpulist(f.read()) & allowed
+            with open(os.path.join(path, 'meminfo')) as f:
+                mem = next(int(l.split()[3]) for l in f if 'MemTotal:' in l) / 2**20
+        except (OSError, ValueError, IndexError, StopIteration):
+            continue
+        if cpus:
+            nodes.append((int(path.rsplit('node', 1)[1]), cpus, mem))
+
+    if not nodes:
+        nodes.append((0, allowed, os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30))
+
+    return nodes
+
+
+### class PlacementScheduler
+#
+#   Wraps a scheduler and runs each job it schedules on CPUs of its own, on a
+#   single NUMA node where one has enough CPUs and memory free.  Of the nodes
+#   that fit, it takes the one with the fewest free CPUs, to keep room on the
+#   others for larger jobs.  The CPUs are free again when the job has ended,
+#   as seen in listen().  All other attributes are forwarded.
+
+class PlacementScheduler:
+    '''Scheduler layer that pins each job to its own CPUs, on one NUMA node where it fits.'''
+
+    def __init__(self, scheduler, policy='pin', nodes=None):
+        '''Wrap scheduler, placing jobs by policy ('pin' or 'bind', see POLICIES),
+           on the nodes returned by read_topology(), unless nodes is given.'''
+        self._scheduler = scheduler
+        self._policy = policy
+        self._nodes = nodes if nodes is not None else read_topology()
+        self._free = dict((n, set(cpus)) for n, cpus, _ in self._nodes)
+        self._mem = dict((n, mem) for n, _, mem in self._nodes)
+        self._placed = list()   # (job, cpus, node, mem) of the jobs that hold CPUs
+
+    def schedule_job(self, name, spec, wdir):
+        '''Schedule the job on the wrapped scheduler, on the CPUs (and node) we
+           place it on.  Returns the job of the wrapped scheduler.'''
+
+        placement = self._place(spec)
+        if not placement:
+            return self._scheduler.schedule_job(name, spec, wdir)
+
+        cpus, node = placement
+        membind = str(node) if node is not None and self._policy == 'bind' else '-'
+        job = self._scheduler.schedule_job(name, JobSpec(sys.executable,
+                    [ '-m', 'kcri.bap.placement', format_cpulist(cpus), membind, spec.command ] +
+                    list(map(str, spec.args)), spec.cpu, spec.mem, spec.tim), wdir)
+
+        mem = spec.mem if node is not None and spec.mem else 0
+        self._placed.append((job, cpus, node, mem))
+        for n in self._free:
+            self._free[n] -= cpus
+        if node is not None:
+            self._mem[node] -= mem
+
+        return job
+
+    def listen(self):
+        '''Have the wrapped scheduler pick up job changes, and release the CPUs
+           of the jobs that have ended.'''
+        self._scheduler.listen()
+
+        ended = [ Job.State.COMPLETED, Job.State.FAILED ]
+        for p in list(filter(lambda p: p[0].state in ended, self._placed)):
+            job, cpus, node, mem = p
+            self._placed.remove(p)
+            for n, all_cpus, _ in self._nodes:
+                self._free[n] |= cpus & all_cpus
+            if node is not None:
+                self._mem[node] += mem
+
+    def __getattr__(self, name):
+        return getattr(self._scheduler, name)
+
+    def _place(self, spec):
+        '''Return the (cpus, node) to run a job with spec on, where node is None
+           if the job is spread over nodes, or None if too few CPUs are free.'''
+
+        want = max(1, math.ceil(spec.cpu if spec.cpu else 1))
+        fits = list(filter(lambda n: len(self._free[n]) >= want and self._mem[n] >= (spec.mem or 0), self._free))
+        if fits:
+            node = min(fits, key=lambda n: len(self._free[n]))
+            return set(sorted(self._free[node])[:want]), node
+
+        if sum(map(len, self._free.values())) < want:
+            return None
+
+        cpus = set()
+        for n in sorted(self._free, key=lambda n: len(self._free[n]), reverse=True):
+            cpus.update(sorted(self._free[n])[:want - len(cpus)])
+        return cpus, None
+
+
+def run_placed(cpulist, membind, command):
+    '''Exec command (a list) on the CPUs in cpulist, with its memory bound to
+       NUMA node membind unless this is '-' or numactl is not installed.
+       Returns only if the command could not be run, with exit code 127.'''
+
+    os.sched_setaffinity(0, parse_cpulist(cpulist))
+    if membind != '-' and shutil.which('numactl'):
+        command = [ 'numactl', '--membind=%s' % membind, '--' ] + command
+
+    try:
+        os.execvp(command[0], command)
+    except OSError as e:
+        print('cannot run %s: %s' % (command[0], str(e)), file=sys.stderr)
+        return 127
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: %s CPULIST NODE|- COMMAND [ARGS...]' % sys.argv[0], file=sys.stderr)
+        sys.exit(2)
+    sys.exit(run_placed(sys.argv[1], sys.argv[2], sys.argv[3:]))
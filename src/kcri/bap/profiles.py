@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.profiles - measured resource profiles of the backend services
+#
+#   The shims declare the CPUs and memory their jobs need as constants, and
+#   these are mostly guesses on the safe side.  This module keeps profiles of
+#   the resources that jobs actually used, so that the scheduler can reserve
+#   what a job is likely to need, instead of the guess.
+#
+#   When a ProfileStore is in use, every job is run under this module (as in
+#   'python3 -m kcri.bap.profiles USAGE_FILE COMMAND ARGS...'), which writes
+#   the job's wall time, CPU time, and peak RSS to USAGE_FILE in its work dir.
+#   When the service completes, these are recorded in the store along with
+#   the total size of the job's input files, and the backend version.
+#
+#   The peak RSS is that of the job's whole process tree, as many backends
+#   are pipelines or wrappers around other programs.  In a job cgroup (see
+#   kcri.bap.cgroups, which passes it in CGROUP_VAR), it is the cgroup's
+#   memory.peak.  Else it is the peak of the summed RSS of the processes,
+#   sampled every SAMPLE_INTERVAL seconds with psutil, and at least the
+#   peak of the largest process (which is all we have without psutil).
+#
+#   To estimate a job's needs, the usage recorded for the service at its
+#   current version is scaled up to the job's input size (never down: much
+#   of the memory is databases), and the PERCENTILE of this is taken.  When
+#   there are fewer than MIN_RECORDS, there is no estimate and the shim's
+#   constants are used as before.
+#
+#   Likewise, the job's expected run time is the RUNTIME_PERCENTILE of the
+#   recorded wall times, scaled up to its input size.  Its time limit is then
+#   TIMEOUT_FACTOR times that (but at least MIN_TIMEOUT), rather than the
+#   shim's constant.  The scheduler relaunches jobs that hang beyond their
+#   expected run time (see FairShareScheduler).
+#
+
+import sys, os, json, math, time, signal, subprocess, threading
+
+# psutil comes with picoline, but we can do without
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Name of the file in the job's work dir that receives its usage
+USAGE_FILE = 'bap-usage.json'
+
+# Environment variable with the path of the job's own cgroup, if it has one
+CGROUP_VAR = 'BAP_JOB_CGROUP'
+
+# Seconds between samples of the memory use of the job's processes
+SAMPLE_INTERVAL = 1
+
+# Percentile of the recorded usage to reserve
+PERCENTILE = 95
+
+# Number of records needed for an estimate, and number kept per service
+MIN_RECORDS = 5
+MAX_RECORDS = 500
+
+# Margin on the estimated memory, as jobs that exceed it may be killed
+MEM_HEADROOM = 1.2
+
+# Percentile of the recorded run times that a job is expected to finish in
+RUNTIME_PERCENTILE = 99
+
+# Time limit on a job as a multiple of its expected run time, and its minimum
+TIMEOUT_FACTOR = 3
+MIN_TIMEOUT = 600
+
+_lock = threading.Lock()
+
+
+def job_input_size(job_spec, db_root):
+    '''Return the total size in bytes of the files on the command line of the
+       job_spec (a dict), not counting those in the databases under db_root.
+       Only absolute paths that are arguments (or comma-separated parts of
+       arguments) count, so shims that run a 'sh -c' script must pass their
+       inputs as arguments to it rather than inside the script.'''
+
+    db_root = os.path.abspath(db_root)
+    paths = set()
+    for arg in filter(lambda a: isinstance(a, str), job_spec.get('args', list())):
+        for path in arg.split(','):
+            if os.path.isabs(path) and not path.startswith(db_root + os.sep) and os.path.isfile(path):
+                paths.add(path)
+
+    return sum(map(os.path.getsize, paths))
+
+
+def scale(record, input_size):
+    '''Return the factor to scale the usage in record up to input_size by.'''
+    return max(1.0, input_size / record['size']) if record.get('size') else 1.0
+
+
+def percentile(values, pct):
+    '''Return the pct percentile of the non-empty list of values.'''
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))]
+
+
+### class ProfileStore
+#
+#   Keeps the recorded usage of each service in a JSON lines file named after
+#   the service in the profile directory.  Lines are appended, so that BAP
+#   processes sharing the directory do not need to lock it.  When a file has
+#   grown to twice MAX_RECORDS, it is cut back to the latest MAX_RECORDS.
+
+class ProfileStore:
+    '''Stores the measured resource usage of services, and estimates their needs from it.'''
+
+    def __init__(self, profile_dir):
+        '''Open the profile store in profile_dir, creating it if needed.'''
+        self._dir = os.path.abspath(profile_dir)
+        os.makedirs(self._dir, exist_ok=True)
+
+    def record(self, service, version, input_size, usage):
+        '''Record the usage (a dict with wall, cpu, and rss) of a job of service
+           at version that had input_size bytes of input.'''
+
+        fname = os.path.join(self._dir, '%s.jsonl' % service)
+        line = json.dumps(dict(usage, version=version, size=input_size, time=int(time.time())))
+        with _lock:
+            with open(fname, 'a') as f:
+                print(line, file=f)
+
+            records = self._load(fname)
+            if len(records) >= 2 * MAX_RECORDS:
+                tmp = fname + '.%d.tmp' % os.getpid()
+                with open(tmp, 'w') as f:
+                    for r in records[-MAX_RECORDS:]:
+                        print(json.dumps(r), file=f)
+                os.replace(tmp, fname)
+
+    def estimate(self, service, version, input_size):
+        '''Return the estimated (cpu, mem) needs of a job of service at version
+           with input_size bytes of input, as the PERCENTILE of the recorded
+           CPU usage (CPU time over wall time), and of the recorded peak RSS
+           in GB scaled to input_size.  Returns None if too little is known.'''
+
+        records = self._records(service, version, input_size)
+        if len(records) < MIN_RECORDS:
+            return None
+
+        cpu = percentile([ r['cpu'] / r['wall'] for r in records ], PERCENTILE)
+        mem = percentile([ r['rss'] * scale(r, input_size) for r in records ], PERCENTILE) * MEM_HEADROOM
+
+        return max(1, math.ceil(cpu)), math.ceil(max(mem, 0.1) * 10) / 10
+
+    def runtime(self, service, version, input_size):
+        '''Return the (expected, limit) run time in seconds of a job of service
+           at version with input_size bytes of input, where expected is the
+           RUNTIME_PERCENTILE of the recorded wall times scaled to input_size,
+           and limit TIMEOUT_FACTOR times that.  None if too little is known.'''
+
+        records = self._records(service, version, input_size)
+        if len(records) < MIN_RECORDS:
+            return None
+
+        expected = math.ceil(percentile([ r['wall'] * scale(r, input_size) for r in records ], RUNTIME_PERCENTILE))
+        return expected, max(MIN_TIMEOUT, TIMEOUT_FACTOR * expected)
+
+    def _records(self, service, version, input_size=0):
+        '''Return the usable records for service at version.  For a job with
+           input, records without input size (from when its inputs were not
+           seen) cannot be scaled, so are only used if there are no others.'''
+        with _lock:
+            records = list(filter(lambda r: r.get('version') == version and r.get('wall', 0) > 0,
+                            self._load(os.path.join(self._dir, '%s.jsonl' % service))))
+        sized = list(filter(lambda r: r.get('size'), records))
+        return sized if input_size and sized else records
+
+    def _load(self, fname):
+        '''Return the list of records in fname, skipping lines that do not parse
+           (as can happen with a partial write).'''
+        records = list()
+        try:
+            with open(fname) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return records
+
+
+def read_usage(job):
+    '''Return the usage dict the job wrote to USAGE_FILE, or None.'''
+    try:
+        with open(job.file_path(USAGE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def tree_rss(proc):
+    '''Return the summed RSS in bytes of psutil.Process proc and its descendants.'''
+    total = 0
+    try:
+        procs = [ proc ] + proc.children(recursive=True)
+    except psutil.Error:
+        return total
+    for p in procs:
+        try:
+            total += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def cgroup_peak():
+    '''Return the memory.peak in GB of the job's cgroup, or None if it has none.'''
+    cgroup = os.environ.get(CGROUP_VAR)
+    try:
+        with open(os.path.join(cgroup, 'memory.peak')) as f:
+            return int(f.read()) / 2**30
+    except (TypeError, OSError, ValueError):
+        return None
+
+
+def measure(usage_file, command):
+    '''Run command (a list), and write its wall time, CPU time (user and system,
+       in seconds) and peak RSS (in GB) of its process tree to usage_file.
+       Signals that would end us are passed on to the command.  Returns its
+       exit code.'''
+
+    start = time.time()
+    try:
+        proc = subprocess.Popen(command)
+    except OSError as e:
+        print('cannot run %s: %s' % (command[0], str(e)), file=sys.stderr)
+        return 127
+
+    def forward(signum, frame):
+        proc.send_signal(signum)
+    for sig in [ signal.SIGTERM, signal.SIGINT, signal.SIGHUP ]:
+        signal.signal(sig, forward)
+
+    # Sample the RSS of the process tree until it has exited
+    peak, ended = [ 0 ], threading.Event()
+    def sample():
+        try:
+            root = psutil.Process(proc.pid)
+        except psutil.Error:
+            return
+        while not ended.wait(SAMPLE_INTERVAL):
+            peak[0] = max(peak[0], tree_rss(root))
+    if psutil and not os.environ.get(CGROUP_VAR):
+        threading.Thread(target=sample, daemon=True).start()
+
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except InterruptedError:
+            pass
+
+    ended.set()
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    rss = cgroup_peak()
+    if rss is None:
+        rss = max(peak[0] / 2**30, rusage.ru_maxrss / (1024 * 1024))   # ru_maxrss is in KB on Linux
+
+    with open(usage_file, 'w') as f:
+        json.dump({
+            'wall': time.time() - start,
+            'cpu': rusage.ru_utime + rusage.ru_stime,
+            'rss': rss }, f)
+
+    return proc.returncode
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: %s USAGE_FILE COMMAND [ARGS...]' % sys.argv[0], file=sys.stderr)
+        sys.exit(2)
+    rc = measure(sys.argv[1], sys.argv[2:])
+    sys.exit(rc if rc >= 0 else 128 - rc)
+
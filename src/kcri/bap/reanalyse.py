@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.reanalyse - incremental re-analysis of earlier BAP runs
+#
+#   Every service records in its run_info the backend version it ran and a
+#   fingerprint of each database it used.  When databases are updated (e.g.
+#   by scripts/clone-databases.sh) or backends upgraded, the services whose
+#   recorded fingerprints or version differ from the current ones are stale.
+#
+#   Re-analysis reruns the stale services and everything downstream of them,
+#   and replays the others: their shims collect the output from the job
+#   directories already present (see SampleScheduler.replay_job).  Thus the
+#   assembly and the reads and contigs metrics are normally reused.
+#
+#   Results from BAP versions that did not record database fingerprints are
+#   taken to be stale for every service whose job used a database.
+#
+#   Replay is the special case where all services that completed are replayed
+#   and nothing is rerun.  It regenerates the results after changes to the
+#   shims' output parsing.
+#
+
+import os, json, copy
+from .cache import VOLATILE_INPUTS, db_fingerprint
+from .services import SERVICE_VERSIONS
+from .workflow import Services
+from .checkpoint import mark_done
+from .shims.base import UserException
+
+# Name of the results file in a BAP output directory
+RESULTS_FILE = 'bap-results.json'
+
+
+def load_results(out_dir):
+    '''Return the results of the earlier run in out_dir as a dict.'''
+    fname = os.path.join(out_dir, RESULTS_FILE)
+    if not os.path.isfile(fname):
+        raise UserException("no BAP results to reanalyse: %s", fname)
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except ValueError as e:
+        raise UserException("invalid BAP results file %s: %s", fname, str(e))
+
+
+def recorded_args(args, results):
+    '''Return a copy of args with the options that affect the results replaced
+       by those recorded in results.  The others (resources, db_root, etc.)
+       are kept as they are in args.'''
+
+    ret = copy.copy(args)
+    for k, v in results.get('bap', {}).get('user_inputs', {}).items():
+        if k not in VOLATILE_INPUTS and hasattr(ret, k):
+            setattr(ret, k, ','.join(v) if isinstance(v, list) else v)
+
+    ret.id = results.get('bap', {}).get('summary', {}).get('sample_id')
+    return ret
+
+
+def recorded_inputs(results):
+    '''Return the (contigs, illufqs, nanofq) inputs recorded in results.'''
+    inputs = results.get('bap', {}).get('user_inputs', {})
+    return inputs.get('contigs'), inputs.get('illumina_fqs'), inputs.get('nano_fq')
+
+
+def is_up_to_date(name, run_info, old_db_root, db_root):
+    '''Return True if service name with run_info completed, with the current
+       backend version, and databases that have not changed since.'''
+
+    try:
+        sid = Services(name)
+    except ValueError:
+        return False
+
+    if run_info.get('status') != 'COMPLETED' or run_info.get('version') != SERVICE_VERSIONS[sid]:
+        return False
+
+    dbs = run_info.get('databases')
+    if dbs is None:
+        # Recorded before we kept fingerprints: only fine if it used no database
+        job = run_info.get('job')
+        return bool(job) and not any(isinstance(a, str) and a.startswith(old_db_root + os.sep) for a in job.get('args', []))
+
+    return all(os.path.isdir(os.path.join(db_root, db)) and
+               db_fingerprint(os.path.join(db_root, db)) == fp for db, fp in dbs.items())
+
+
+def completed_services(results):
+    '''Return the dict of service name to recorded run_info of the services
+       that completed in results.'''
+    return dict((name, svc.get('run_info', {})) for name, svc in results.get('services', {}).items()
+                    if svc.get('run_info', {}).get('status') == 'COMPLETED')
+
+
+def replayable_services(workflow, results, db_root):
+    '''Return the dict of service name to recorded run_info of the services in
+       results that can be replayed in workflow: those that are up to date, and
+       depend only on services that are up to date.  Workflow is not changed.'''
+
+    old_db_root = results.get('bap', {}).get('user_inputs', {}).get('db_root', db_root)
+    fresh = dict(filter(lambda kv: is_up_to_date(kv[0], kv[1], old_db_root, db_root),
+                    completed_services(results).items()))
+
+    return dict((name, fresh[name]) for name in mark_done(copy.deepcopy(workflow), fresh))
+
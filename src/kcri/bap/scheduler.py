@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.scheduler - scheduler layers on top of the picoline schedulers
+#
+#   This module defines the FairShareScheduler, which sits between the
+#   SampleSchedulers of concurrently running samples and the scheduler that
+#   actually runs the jobs (normally the picoline SubprocessScheduler).
+#
+#   The FairShareScheduler keeps a queue of jobs per sample, and passes jobs
+#   on only when they fit in the CPU and memory that are free.  When there is
+#   room, it picks the next job from the sample with the smallest weighted
+#   dominant share: the largest of its fractions of CPU and memory in use,
+#   divided by its weight.  So a sample that holds 12 cores for SKESA, or a
+#   long cgMLST job, does not keep the short jobs of other samples waiting.
+#
+#   Elastic jobs, which can make do with fewer CPUs and less memory (the
+#   assemblers), ask for a grant: what is left after the running and queued
+#   jobs, but no more than their sample's share (see grant_resources).
+#
+#   Jobs are admitted by the memory they declare, which is mostly a guess.
+#   With a MemoryMonitor, a job that has run for RSS_GRACE seconds counts
+#   for the peak RSS it actually reached instead (plus RSS_HEADROOM), which
+#   lets more jobs in when the guesses are high.  And no job is let in when
+#   that would bring the memory available on the system below the margin,
+#   which holds jobs back when the guesses are low.
+#
+#   Jobs that read large input files (HEAVY_INPUT_SIZE, i.e. reads) all want
+#   to stream the same files from the same disk or NFS server at once.  With
+#   max_readers, at most that many different heavy files are read at the same
+#   time from each device.  Jobs that read a file that is already being read
+#   are let through regardless, as they are likely served from page cache;
+#   so readers of the same file are scheduled together.  Jobs that wait only
+#   for I/O are passed over by the jobs behind them.
+#
+#   Jobs may come with their expected run time (e.g. the 99th percentile of
+#   the run times in the ProfileStore).  With a MemoryMonitor, a job that has
+#   run longer than that, and used no CPU for STALL_TIME seconds, is taken to
+#   hang (e.g. on a bad NFS mount): it is killed and launched again, once.
+#   The shim does not notice, but for the attempts it finds on the job.
+#
+#   Per sample it keeps the time its jobs spent waiting in the queue, for
+#   tuning the weights (see wait_stats).  Each sample's own jobs are queued
+#   by priority, so that those on its critical path go first.
+#
+#   The EventScheduler makes job completion event-driven.  The scheduler it
+#   wraps is created to poll without delay, and EventScheduler.listen waits
+#   for SIGCHLD before asking it to poll.  So when a job exits, its service
+#   reports and the services that depend on it start right away, instead of
+#   up to a poll interval later.  The poll interval remains as the timeout on
+#   the wait, in case signals cannot be had (see watch_children).
+#
+#   The signal handler does not itself wake the listeners: it runs on the main
+#   thread between any two bytecodes, possibly while that thread holds a lock
+#   that it would need.  Instead the SIGCHLD is written to a self-pipe by the
+#   interpreter (signal.set_wakeup_fd), from where a thread passes it on to a
+#   pipe per EventScheduler, on which its listen() selects.
+#
+
+import os, time, select, signal, threading
+from datetime import datetime
+from pico.jobcontrol.job import Job
+
+# psutil comes with picoline, but we can do without
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Seconds a job runs at its declared memory before its measured RSS counts
+RSS_GRACE = 60
+
+# Margin on the measured peak RSS of a job, as it may still grow
+RSS_HEADROOM = 1.2
+
+# Size in bytes from which an input file is heavy to read
+HEAVY_INPUT_SIZE = 64 * 2**20
+
+# Seconds without CPU progress after which a job past its expected run time hangs
+STALL_TIME = 60
+
+# Write ends of the pipes to signal when a child process exits, see watch_children
+_child_fds = tuple()
+_watching = False
+
+
+### class FairShareJob
+#
+#   Stands in for a job while it is in the FairShareScheduler's queue, and
+#   forwards to the actual job once that has been scheduled.  If scheduling
+#   it fails, it is FAILED with that error, as the shim is no longer around
+#   to catch the exception.  While a hung job is being relaunched, it stays
+#   RUNNING, and the earlier attempts are kept.
+
+class FairShareJob:
+    '''Job in the fair share queue, or the proxy for the job it became.'''
+
+    def __init__(self, name, spec, wdir, owner, priority, runtime=None):
+        self.name = name
+        self.spec = spec
+        self.wdir = wdir
+        self.owner = owner
+        self.priority = priority
+        self.runtime = runtime
+        self.reads = heavy_inputs(spec)
+        self.queued_at = time.time()
+        self.started_at = None
+        self.job = None
+        self.relaunching = None     # the reason, while the killed attempt ends
+        self._attempts = list()
+        self._error = None
+
+    @property
+    def state(self):
+        if self._error:
+            return Job.State.FAILED
+        if self.relaunching:
+            return Job.State.RUNNING
+        return self.job.state if self.job else Job.State.QUEUED
+
+    def attempts(self):
+        '''Return the list of attempts at running the job, each a dict with its
+           start time, duration and status, or the reason it was killed.'''
+        attempts = list(self._attempts)
+        if self.started_at:
+            attempts.append({ 'start': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+                'duration': time.time() - self.started_at, 'status': self.state.value })
+        return attempts
+
+    @property
+    def error(self):
+        return self._error if self._error or not self.job else self.job.error
+
+    def file_path(self, fname):
+        return self.job.file_path(fname) if self.job else os.path.join(self.wdir, fname)
+
+    def __getattr__(self, name):
+        if self.job is None:
+            raise AttributeError("job %s has not started yet: no %s" % (self.name, name))
+        return getattr(self.job, name)
+
+
+### class FairShareScheduler
+#
+#   Wraps a scheduler and shares its max_cpu and max_mem fairly among the
+#   owners of the jobs.  The owner of a job is the part of its name up to
+#   the first ':', which is the sample id for jobs from a SampleScheduler.
+#   All other attributes are forwarded to the wrapped scheduler.
+
+class FairShareScheduler:
+    '''Scheduler layer that does weighted fair sharing of CPU and memory between samples.'''
+
+    def __init__(self, scheduler, monitor=None, max_readers=None):
+        '''Wrap scheduler, whose max_cpu and max_mem are the resources to share,
+           using the MemoryMonitor monitor for admission if given, and reading
+           at most max_readers heavy files per device at a time if given.'''
+        self._scheduler = scheduler
+        self._monitor = monitor
+        self._max_readers = max_readers
+        self._queues = dict()       # owner -> list of queued FairShareJob
+        self._running = list()      # FairShareJobs passed on and not yet done
+        self._weights = dict()      # owner -> weight
+        self._stats = dict()        # owner -> dict of wait statistics
+
+    def set_weight(self, owner, weight):
+        '''Set the share weight of owner (default 1), higher gets more.'''
+        self._weights[owner] = max(float(weight), 0.001)
+
+    def schedule_job(self, name, spec, wdir, priority=(0, 0), runtime=None):
+        '''Queue the job and start what fits, returns a FairShareJob.  Within
+           the owner's queue, jobs go in order of descending priority (any
+           comparable value, e.g. the SERVICE_PRIORITIES), else in FIFO order.
+           If runtime is given, the job is relaunched if it hangs past it.'''
+        owner = name.split(':')[0] if ':' in name else ''
+        job = FairShareJob(name, spec, wdir, owner, priority, runtime)
+        queue = self._queues.setdefault(owner, list())
+        queue.insert(next((i for i, j in enumerate(queue) if j.priority < priority), len(queue)), job)
+        self._start_jobs()
+        return job
+
+    def listen(self):
+        '''Wait on the wrapped scheduler for job changes, relaunch hung jobs,
+           then start what fits.'''
+        self._scheduler.listen()
+        self._relaunch_jobs()
+        self._start_jobs()
+
+    def stop_job(self, job):
+        '''Stop the FairShareJob: if still queued it is dropped and FAILED, else
+           it is stopped through the wrapped scheduler, if that can.'''
+        queue = self._queues.get(job.owner, [])
+        if job in queue:
+            queue.remove(job)
+            job._error = 'cancelled before it started'
+        elif job.job:
+            stop_job = getattr(self._scheduler, 'stop_job', None)
+            if stop_job:
+                stop_job(job.job)
+
+    def grant_resources(self, owner, cpu_range, mem_range):
+        '''Return the (cpu, mem) to give an elastic job of owner that can use
+           anything in cpu_range and mem_range (min, max tuples).  It gets what
+           is free after the running and queued jobs, but no more than owner's
+           weighted share when other owners have jobs, and at least the min.'''
+
+        self._running = list(filter(lambda j: j.state not in [ Job.State.COMPLETED, Job.State.FAILED ], self._running))
+        queued = [ j for q in self._queues.values() for j in q ]
+
+        owners = set(j.owner for j in self._running + queued) | { owner }
+        fraction = self._weights.get(owner, 1.0) / sum(self._weights.get(o, 1.0) for o in owners)
+
+        def grant(total, used, lo, hi):
+            free = total - used
+            amount = min(free, total * fraction) if len(owners) > 1 else free
+            return int(min(max(amount, lo), hi, total))
+
+        return (grant(self._scheduler.max_cpu, sum(j.spec.cpu for j in self._running + queued), *cpu_range),
+                grant(self._scheduler.max_mem, sum(j.spec.mem for j in self._running + queued), *mem_range))
+
+    def wait_stats(self, owner):
+        '''Return dict with the number of jobs, and total and maximum seconds
+           they waited in the queue, for owner.'''
+        return dict(self._stats.get(owner, { 'jobs': 0, 'wait': 0.0, 'max_wait': 0.0 }))
+
+    def forget(self, owner):
+        '''Drop the weight and statistics for owner, e.g. when it is done.'''
+        self._weights.pop(owner, None)
+        self._stats.pop(owner, None)
+        if not self._queues.get(owner):
+            self._queues.pop(owner, None)
+
+    def __getattr__(self, name):
+        return getattr(self._scheduler, name)
+
+    def _start_jobs(self):
+        '''Pass on to the wrapped scheduler the queued jobs that fit, in order of
+           their owners' weighted dominant shares.'''
+
+        self._running = list(filter(lambda j: j.state not in [ Job.State.COMPLETED, Job.State.FAILED ], self._running))
+
+        while True:
+            owners = list(filter(lambda o: self._queues[o], self._queues))
+            if not owners:
+                return
+
+            # The next job of the owner with the smallest share that is not
+            # waiting for its input files to be free to read
+            job = None
+            for owner in sorted(owners, key=lambda o: self._share(o)):
+                job = next(filter(self._can_read, self._queues[owner]), None)
+                if job:
+                    break
+            if not job:
+                return
+
+            # Strictly in share order, so big jobs are not starved by small
+            # ones; but a job that does not fit at all can run on its own
+            if self._running and not self._fits(job):
+                return
+
+            self._queues[owner].remove(job)
+            job.started_at = time.time()
+            try:
+                job.job = self._scheduler.schedule_job(job.name, job.spec, job.wdir)
+                self._running.append(job)
+            except Exception as e:
+                job._error = str(e)
+
+            wait = job.started_at - job.queued_at
+            stats = self._stats.setdefault(owner, { 'jobs': 0, 'wait': 0.0, 'max_wait': 0.0 })
+            stats['jobs'] += 1
+            stats['wait'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+
+    def _relaunch_jobs(self):
+        '''Kill the running jobs that are past their expected run time and made
+           no CPU progress for STALL_TIME, unless relaunched before, and launch
+           them again once the killed attempt has ended.'''
+
+        if not self._monitor:
+            return
+
+        watched = list(filter(lambda j: j.runtime and j.job and j.state == Job.State.RUNNING, self._running))
+        if not watched:
+            return
+        self._monitor.sample(j.wdir for j in self._running)
+
+        for job in watched:
+            if job.relaunching:
+                if job.job.state not in [ Job.State.COMPLETED, Job.State.FAILED ]:
+                    continue
+                job._attempts.append({ 'start': datetime.fromtimestamp(job.started_at).isoformat(timespec='seconds'),
+                    'duration': time.time() - job.started_at, 'status': 'KILLED', 'reason': job.relaunching })
+                job.relaunching = None
+                job.started_at = time.time()
+                try:
+                    job.job = self._scheduler.schedule_job(job.name, job.spec, job.wdir)
+                except Exception as e:
+                    job._error = str(e)
+
+            elif not job._attempts and time.time() - job.started_at > job.runtime and self._monitor.stalled(job.wdir) >= STALL_TIME:
+                job.relaunching = 'no CPU progress for %ds after its expected run time of %ds' % (STALL_TIME, job.runtime)
+                stop_job = getattr(self._scheduler, 'stop_job', None)
+                if stop_job:
+                    stop_job(job.job)
+                else:
+                    self._monitor.kill(job.wdir)
+
+    def _can_read(self, job):
+        '''Return True if the heavy files that job reads are already being read
+           by a running job, or their devices have fewer than max_readers other
+           heavy files being read.'''
+        if not self._max_readers or not self._running:
+            return True
+        reading = set().union(*(j.reads for j in self._running))
+        for dev, path in job.reads - reading:
+            if sum(1 for d, _ in reading if d == dev) >= self._max_readers:
+                return False
+        return True
+
+    def _fits(self, job):
+        '''Return True if job fits in the CPUs and memory left by the running jobs,
+           and, if we have a monitor, in the memory available on the system.
+           Jobs in their grace period may not show in the latter yet, so their
+           declared memory is taken off it.'''
+
+        cpu_used = sum(j.spec.cpu for j in self._running)
+        mem_used = sum(self._mem_used(j) for j in self._running)
+        if cpu_used + job.spec.cpu > self._scheduler.max_cpu or mem_used + job.spec.mem > self._scheduler.max_mem:
+            return False
+
+        if self._monitor:
+            self._monitor.sample(j.wdir for j in self._running)
+            fresh = sum(j.spec.mem for j in self._running if time.time() - j.started_at < RSS_GRACE)
+            if self._monitor.available() - fresh - job.spec.mem < self._monitor.margin:
+                return False
+
+        return True
+
+    def _mem_used(self, job):
+        '''Return the memory to count for running job: its declared memory, or
+           if measured and past its grace period, its peak RSS with headroom.'''
+        if not self._monitor or time.time() - job.started_at < RSS_GRACE:
+            return job.spec.mem
+        return self._monitor.peak(job.wdir) * RSS_HEADROOM
+
+    def _share(self, owner):
+        '''Return the weighted dominant share of owner's running jobs.'''
+        jobs = list(filter(lambda j: j.owner == owner, self._running))
+        cpu = sum(j.spec.cpu for j in jobs) / max(self._scheduler.max_cpu, 1)
+        mem = sum(j.spec.mem for j in jobs) / max(self._scheduler.max_mem, 1)
+        return max(cpu, mem) / self._weights.get(owner, 1.0)
+
+
+def heavy_inputs(spec):
+    '''Return the set of (device, path) of the heavy input files of the job
+       spec: those on its command line of at least HEAVY_INPUT_SIZE bytes.'''
+    ret = set()
+    for arg in filter(lambda a: isinstance(a, str), spec.args):
+        for path in arg.split(','):
+            try:
+                st = os.stat(path) if os.path.isabs(path) else None
+            except OSError:
+                continue
+            if st and os.path.isfile(path) and st.st_size >= HEAVY_INPUT_SIZE:
+                ret.add((st.st_dev, os.path.realpath(path)))
+    return ret
+
+
+### class MemoryMonitor
+#
+#   Samples the memory available on the system, and the RSS and CPU time of
+#   the processes that run in each job's work directory, using psutil.  These
+#   are all our descendants, as jobs run in their own directory (unless they
+#   chdir away, in which case they go unmeasured).  Sampling is at most every
+#   interval seconds, as it walks the process table.
+
+class MemoryMonitor:
+    '''Measures the available memory, and the peak RSS and CPU progress of running jobs.'''
+
+    def __init__(self, margin=None, interval=2):
+        '''Create monitor that keeps margin GB available, by default 5% of the
+           total memory but at least 1 GB.  Requires psutil.'''
+        total = psutil.virtual_memory().total / 2**30
+        self.margin = margin if margin is not None else max(1.0, 0.05 * total)
+        self._interval = interval
+        self._sampled = 0
+        self._available = total
+        self._peaks = dict()    # absolute work dir -> peak RSS in GB
+        self._cpu = dict()      # absolute work dir -> (CPU seconds, time they last changed)
+
+    def sample(self, wdirs):
+        '''Measure the available memory and the RSS and CPU time of the jobs
+           running in the wdirs, unless we did so less than interval seconds ago.'''
+
+        if time.time() - self._sampled < self._interval:
+            return
+        self._sampled = time.time()
+        self._available = psutil.virtual_memory().available / 2**30
+
+        rss = dict((os.path.abspath(w), 0) for w in wdirs)
+        cpu = dict.fromkeys(rss, 0.0)
+        for proc, wdir in self._processes(rss):
+            try:
+                mem, times = proc.memory_info().rss, proc.cpu_times()
+            except psutil.Error:
+                continue
+            rss[wdir] += mem
+            cpu[wdir] += times.user + times.system + times.children_user + times.children_system
+
+        now = time.time()
+        self._peaks = dict((w, max(self._peaks.get(w, 0), r / 2**30)) for w, r in rss.items())
+        self._cpu = dict((w, (c, now if abs(c - self._cpu.get(w, (-1, 0))[0]) > 0.01 else self._cpu[w][1])) for w, c in cpu.items())
+
+    def available(self):
+        '''Return the memory available on the system in GB, as last sampled.'''
+        return self._available
+
+    def peak(self, wdir):
+        '''Return the peak RSS in GB of the job running in wdir, as far as sampled.'''
+        return self._peaks.get(os.path.abspath(wdir), 0)
+
+    def stalled(self, wdir):
+        '''Return the seconds since the CPU time of the job running in wdir last
+           went up, as far as sampled.'''
+        return time.time() - self._cpu.get(os.path.abspath(wdir), (0, time.time()))[1]
+
+    def kill(self, wdir):
+        '''Kill the processes of the job running in wdir.'''
+        for proc, _ in self._processes({ os.path.abspath(wdir) }):
+            try:
+                proc.kill()
+            except psutil.Error:
+                pass
+
+    def _processes(self, wdirs):
+        '''Yield the (process, wdir) of our descendants that run in (a directory
+           below) one of the absolute wdirs.'''
+        for proc in psutil.Process().children(recursive=True):
+            try:
+                wdir = proc.cwd()
+            except psutil.Error:
+                continue
+            while wdir not in wdirs and os.path.dirname(wdir) != wdir:
+                wdir = os.path.dirname(wdir)
+            if wdir in wdirs:
+                yield proc, wdir
+
+
+def watch_children(fd):
+    '''Write a byte to fd (a non-blocking pipe) whenever a child process exits.
+       Returns False if this is not possible, because there is no SIGCHLD, or
+       the SIGCHLD handler was not installed yet and we are not on the main
+       thread (Python only allows the main thread to install signal handlers),
+       or the wakeup fd is already taken (e.g. by an asyncio loop).'''
+    global _watching, _child_fds
+
+    if not _watching:
+        if not hasattr(signal, 'SIGCHLD') or threading.current_thread() is not threading.main_thread():
+            return False
+
+        r, w = os.pipe()
+        os.set_blocking(w, False)
+        previous_fd = signal.set_wakeup_fd(w, warn_on_full_buffer=False)
+        if previous_fd != -1:
+            signal.set_wakeup_fd(previous_fd)
+            os.close(r)
+            os.close(w)
+            return False
+
+        # The wakeup fd is only written for signals that have a Python handler
+        previous = signal.getsignal(signal.SIGCHLD)
+        def on_sigchld(signum, frame):
+            if callable(previous):
+                previous(signum, frame)
+
+        signal.signal(signal.SIGCHLD, on_sigchld)
+        threading.Thread(target=_relay_children, args=(r,), name='BAP-sigchld', daemon=True).start()
+        _watching = True
+
+    _child_fds = _child_fds + (fd,)
+    return True
+
+
+def _relay_children(fd):
+    '''Read the signal numbers that the interpreter writes to fd, and pass each
+       SIGCHLD on to the pipes in _child_fds.  Runs in its own thread.'''
+    while True:
+        if int(signal.SIGCHLD) in os.read(fd, 512):
+            for w in _child_fds:
+                try:
+                    os.write(w, b'\0')
+                except BlockingIOError:   # pipe full, so the listener will wake anyway
+                    pass
+
+
+### class EventScheduler
+#
+#   Wraps a scheduler that was created with a poll interval of 0, and makes
+#   its listen() wait until a child process has exited, or poll seconds have
+#   passed.  All other attributes are forwarded to the wrapped scheduler.
+
+class EventScheduler:
+    '''Scheduler layer that listens for job completion on SIGCHLD, and falls back to polling.'''
+
+    def __init__(self, scheduler, poll):
+        '''Wrap scheduler, which must not sleep in listen(), and poll it every
+           poll seconds if no child exit was signalled.'''
+        self._scheduler = scheduler
+        self._poll = poll
+        self._exited, exited = os.pipe()
+        os.set_blocking(self._exited, False)
+        os.set_blocking(exited, False)
+        self.event_driven = watch_children(exited)
+
+    def listen(self):
+        '''Wait for a child to exit (or at most poll seconds), then have the wrapped
+           scheduler pick up the job changes.  The pipe is drained before it does,
+           so exits during its poll are not missed.'''
+        if select.select([self._exited], [], [], self._poll)[0]:
+            try:
+                while os.read(self._exited, 512):
+                    pass
+            except BlockingIOError:
+                pass
+        self._scheduler.listen()
+
+    def __getattr__(self, name):
+        return getattr(self._scheduler, name)
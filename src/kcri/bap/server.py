@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.server - HTTP submission service with a durable job queue
+#
+#   This module defines the JobQueue, which persists submitted jobs as JSON
+#   files in a spool directory so that they survive a restart, and JobServer,
+#   a small stdlib HTTP server through which jobs are submitted and queried.
+#
+#   The HTTP API (all bodies are JSON):
+#
+#       POST /jobs                  submit { "files": [ PATH, ... ],
+#                                            "id": SAMPLE_ID (optional),
+#                                            "options": { OPTION: VALUE, ... } }
+#                                   where OPTION is any BAP long option, e.g.
+#                                   "species", "targets", "rf-i"; returns the job
+#       GET  /jobs                  list all jobs with their state
+#       GET  /jobs/ID               return the job with its state
+#       GET  /jobs/ID/results       return the bap-results.json of a finished job;
+#                                   409 while it is queued or running, 404 if
+#                                   it ended without results
+#
+#   The server only validates and queues submissions.  Executing them is up
+#   to the caller (see BAP.run_http), which takes jobs off the queue.
+#
+
+import os, json, uuid, queue, threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .shims.base import UserException
+
+
+### class JobQueue
+#
+#   Durable queue of jobs.  Every job is a dict that is written to its own
+#   JSON file in the spool directory on every change.  On construction, jobs
+#   that were queued or running when the previous process stopped are queued
+#   again.
+
+class JobQueue:
+    '''Durable, thread-safe queue of submitted jobs.'''
+
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    COMPLETED = 'COMPLETED'
+    FAILED = 'FAILED'
+    ERROR = 'ERROR'
+
+    def __init__(self, spool_dir):
+        '''Open the queue in spool_dir, requeueing unfinished jobs found there.'''
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self._spool_dir = spool_dir
+        self._lock = threading.Lock()
+        self._jobs = dict()
+        self._queue = queue.Queue()
+
+        for fname in sorted(os.listdir(spool_dir)):
+            if fname.endswith('.json'):
+                with open(os.path.join(spool_dir, fname)) as f:
+                    job = json.load(f)
+                self._jobs[job['id']] = job
+
+        for job in sorted(self._jobs.values(), key=lambda j: j['submitted']):
+            if job['state'] in [ JobQueue.QUEUED, JobQueue.RUNNING ]:
+                self.update(job['id'], state=JobQueue.QUEUED)
+                self._queue.put(job['id'])
+
+    def submit(self, request):
+        '''Add a job for request to the queue, return the new job.'''
+        job_id = uuid.uuid4().hex[:16]
+        with self._lock:
+            self._jobs[job_id] = {
+                'id': job_id,
+                'state': JobQueue.QUEUED,
+                'submitted': datetime.now().isoformat(timespec='seconds'),
+                'request': request }
+            self._save(job_id)
+        self._queue.put(job_id)
+        return self.get(job_id)
+
+    def take(self, block=True, timeout=None):
+        '''Return the list of queued jobs that are waiting, blocking until there
+           is one if block is True (for at most timeout seconds if not None).'''
+        ret = list()
+        try:
+            ret.append(self.get(self._queue.get(block, timeout)))
+            while True:
+                ret.append(self.get(self._queue.get_nowait()))
+        except queue.Empty:
+            pass
+        return ret
+
+    def update(self, job_id, **fields):
+        '''Update the job with fields and persist it.'''
+        with self._lock:
+            self._jobs[job_id].update(fields)
+            self._save(job_id)
+
+    def get(self, job_id):
+        '''Return a copy of the job with job_id, or None.'''
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        '''Return the list of all jobs, oldest first.'''
+        with self._lock:
+            return [ dict(j) for j in sorted(self._jobs.values(), key=lambda j: j['submitted']) ]
+
+    def _save(self, job_id):
+        fname = os.path.join(self._spool_dir, '%s.json' % job_id)
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(self._jobs[job_id], f)
+        os.replace(fname + '.tmp', fname)
+
+
+### class JobServer
+#
+#   HTTP server for the API above.  The validate callable is invoked on every
+#   submitted request (in the request thread) and must raise UserException if
+#   it is invalid.  The results_file callable maps a job id to the path of its
+#   bap-results.json.
+
+class JobServer(ThreadingHTTPServer):
+    '''HTTP server that accepts BAP job submissions into a JobQueue.'''
+
+    daemon_threads = True
+
+    def __init__(self, address, job_queue, validate, results_file, verbose=False):
+        super().__init__(address, JobRequestHandler)
+        self.job_queue = job_queue
+        self.validate = validate
+        self.results_file = results_file
+        self.verbose = verbose
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    '''Handles the requests for the JobServer.'''
+
+    def do_GET(self):
+        parts = list(filter(None, self.path.split('?')[0].split('/')))
+
+        if parts == ['jobs']:
+            self._reply(200, list(map(lambda j: { 'id': j['id'], 'state': j['state'] }, self.server.job_queue.list())))
+
+        elif len(parts) in [2, 3] and parts[0] == 'jobs':
+            job = self.server.job_queue.get(parts[1])
+            if not job:
+                self._reply(404, { 'error': 'no such job: %s' % parts[1] })
+            elif len(parts) == 2:
+                self._reply(200, job)
+            elif parts[2] != 'results':
+                self._reply(404, { 'error': 'no such resource: %s' % self.path })
+            elif job['state'] in [ JobQueue.QUEUED, JobQueue.RUNNING ]:
+                self._reply(409, { 'error': 'job has no results yet: %s' % job['state'] })
+            else:
+                try:
+                    with open(self.server.results_file(job['id'])) as f:
+                        results = json.load(f)
+                except (OSError, ValueError):
+                    self._reply(404, { 'error': 'job has no results: %s' % job['state'] })
+                else:
+                    self._reply(200, results)
+
+        else:
+            self._reply(404, { 'error': 'no such resource: %s' % self.path })
+
+    def do_POST(self):
+        parts = list(filter(None, self.path.split('?')[0].split('/')))
+
+        if parts != ['jobs']:
+            self._reply(404, { 'error': 'no such resource: %s' % self.path })
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length)) if length else None
+            if not isinstance(request, dict):
+                raise UserException("request body must be a JSON object")
+            self.server.validate(request)
+        except (UserException, ValueError) as e:
+            self._reply(400, { 'error': str(e) })
+            return
+
+        self._reply(201, self.server.job_queue.submit(request))
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
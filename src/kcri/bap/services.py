@@ -7,6 +7,8 @@
 #   the service.
 #
 
+import sys
+
 # Import the Services enum
 from .workflow import Services
 
@@ -16,6 +18,7 @@ from .shims.cgMLSTFinder import cgMLSTFinderShim
 from .shims.CholeraeFinder import CholeraeFinderShim
 from .shims.ContigsMetrics import ContigsMetricsShim
 from .shims.DisinFinder import DisinFinderShim
+from .shims.Downsampler import DownsamplerShim
 from .shims.GetReference import GetReferenceShim
 from .shims.GFAConnector import GFAConnectorShim
 from .shims.Flye import FlyeShim
@@ -28,11 +31,14 @@ from .shims.PointFinder import PointFinderShim
 from .shims.ReadsMetrics import ReadsMetricsShim
 from .shims.ResFinder import ResFinderShim
 from .shims.SKESA import SKESAShim
+from .shims.Stager import StagerShim
 from .shims.VirulenceFinder import VirulenceFinderShim
 
 SERVICES = {
     Services.CONTIGSMETRICS:    ContigsMetricsShim(),
     Services.READSMETRICS:      ReadsMetricsShim(),
+    Services.DOWNSAMPLER:       DownsamplerShim(),
+    Services.STAGER:            StagerShim(),
     Services.SKESA:             SKESAShim(),
     Services.FLYE:              FlyeShim(),
     Services.GFACONNECTOR:      GFAConnectorShim(),
@@ -54,3 +60,6 @@ SERVICES = {
 for s in Services:
     assert s in SERVICES, "No service shim defined for service %s" % s
 
+
+# The backend version of each service, as reported by its shim's module
+SERVICE_VERSIONS = dict(map(lambda kv: (kv[0], sys.modules[type(kv[1]).__module__].VERSION), SERVICES.items()))
@@ -3,7 +3,7 @@
 # kcri.bap.shims.CholeraeFinder - service shim to the CholeraeFinder
 #
 
-import os, json, logging, tempfile
+import os, json, logging
 from pico.workflow.executor import Task
 from pico.jobcontrol.job import JobSpec, Job
 from .base import ServiceExecution, UserException, SkipException
@@ -69,9 +69,9 @@ class CholeraeFinderExecution(ServiceExecution):
     def start(self, job_spec, work_dir):
         if self.state == Task.State.STARTED:
             self.store_job_spec(job_spec.as_dict())
-            self._tmp_dir = tempfile.TemporaryDirectory()
+            self._tmp_dir = self.make_tmp_dir()
             job_spec.args.extend(['--tmp_dir', self._tmp_dir.name])
-            self._job = self._scheduler.schedule_job('choleraefinder', job_spec, work_dir)
+            self._job = self.schedule_job('choleraefinder', job_spec, work_dir)
 
     # Parse the output produced by the backend service, return list of hits
     def collect_output(self, job):
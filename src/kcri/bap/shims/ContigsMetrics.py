@@ -31,9 +31,10 @@ class ContigsMetricsShim:
         try:
             min_len = blackboard.get_user_input('cm_l')
             fn = os.path.abspath(execution.get_contigs_path())
-            cmd = "uf '%s' | uf-stats -m %d -t" % (fn,min_len)
+            # The path is an argument of its own, for the cache and profiles to see
+            cmd = 'uf "$1" | uf-stats -m %d -t' % min_len
             params = [
-                '-c', cmd, 'uf-stats'
+                '-c', cmd, 'uf-stats', fn
             ]
 
             job_spec = JobSpec('sh', params, MAX_CPU, MAX_MEM, MAX_TIM)
@@ -59,7 +60,7 @@ class ContigsMetricsExecution(ServiceExecution):
 
     def start(self, job_spec):
         if self.state == Task.State.STARTED:
-            self._job = self._scheduler.schedule_job('uf-stats', job_spec, 'ContigsMetrics')
+            self._job = self.schedule_job('uf-stats', job_spec, 'ContigsMetrics')
 
     def collect_output(self, job):
         '''Collect the job output and put on blackboard.
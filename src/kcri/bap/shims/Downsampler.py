@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.shims.Downsampler - service shim to the kcri.bap.downsample module
+#
+
+import sys, os, json, logging
+from pico.workflow.executor import Task
+from pico.jobcontrol.job import JobSpec, Job
+from .base import ServiceExecution, UserException
+
+# Our service name and current backend version: that of the kcri.bap.downsample
+# module, not the BAP's, so that BAP releases don't make its output outdated;
+# bump it only when the module's output changes
+SERVICE, VERSION = "Downsampler", "1.0.0"
+
+# Resource parameters: cpu, memory, disk, run time reqs
+MAX_CPU = 1
+MAX_MEM = 2
+MAX_TIM = 30 * 60
+
+# Typical genome sizes (in Mbp) of the genera we see most, for when the
+# species is known up front; other genomes are sized from the reads
+GENOME_SIZES = {
+    'Acinetobacter': 3.9, 'Bacillus': 5.4, 'Bordetella': 4.1, 'Brucella': 3.3,
+    'Burkholderia': 7.0, 'Campylobacter': 1.7, 'Citrobacter': 5.0, 'Clostridioides': 4.2,
+    'Corynebacterium': 2.5, 'Enterobacter': 4.8, 'Enterococcus': 2.9, 'Escherichia': 5.1,
+    'Haemophilus': 1.9, 'Helicobacter': 1.7, 'Klebsiella': 5.6, 'Legionella': 3.4,
+    'Listeria': 3.0, 'Mycobacterium': 4.4, 'Neisseria': 2.2, 'Proteus': 4.0,
+    'Pseudomonas': 6.5, 'Salmonella': 4.8, 'Serratia': 5.2, 'Shigella': 4.5,
+    'Staphylococcus': 2.8, 'Stenotrophomonas': 4.7, 'Streptococcus': 2.1, 'Vibrio': 4.0,
+    'Yersinia': 4.7
+}
+
+
+# The Service class
+class DownsamplerShim:
+    '''Service shim that executes the backend.'''
+
+    def execute(self, sid, xid, blackboard, scheduler):
+        '''Invoked by the executor.  Creates, starts and returns the Task.'''
+
+        execution = DownsamplerExecution(SERVICE, VERSION, sid, xid, blackboard, scheduler)
+
+        # From here we catch exception and execution will FAIL
+        try:
+            fastqs = execution.get_user_illufq_paths()
+            if len(fastqs) > 2:
+                raise UserException("cannot downsample more than two reads files")
+
+            depth = float(execution.get_user_input('max_depth'))
+            if depth <= 0:
+                raise UserException("invalid maximum depth: %s", depth)
+
+            params = [ '-m', 'kcri.bap.downsample' ]
+            genome_size, source = execution.genome_size()
+            if genome_size:
+                params.extend([ '-g', str(genome_size) ])
+            params.append(str(depth))
+            params.extend(map(os.path.abspath, fastqs))
+
+            execution.put_run_info('genome_size_source', source)
+            job_spec = JobSpec(sys.executable, params, MAX_CPU, MAX_MEM, MAX_TIM)
+            execution.store_job_spec(job_spec.as_dict())
+            execution.start(job_spec)
+
+        # Failing inputs will throw UserException
+        except UserException as e:
+            execution.fail(str(e))
+
+        # Deeper errors additionally dump stack
+        except Exception as e:
+            logging.exception(e)
+            execution.fail(str(e))
+
+        return execution
+
+# Single execution of the service
+class DownsamplerExecution(ServiceExecution):
+    '''A single execution of the service, returned by execute().'''
+
+    _job = None
+
+    def genome_size(self):
+        '''Return the genome size to downsample for and where it came from:
+           the user specified species if it is in GENOME_SIZES, else None to
+           have the backend estimate it.'''
+
+        for species in self._blackboard.get_user_species([]):
+            size = GENOME_SIZES.get(species.split(' ')[0].capitalize())
+            if size:
+                return int(size * 1000000), 'species'
+
+        return None, 'estimate'
+
+    def start(self, job_spec):
+        if self.state == Task.State.STARTED:
+            self._job = self.schedule_job('downsample', job_spec, 'Downsampler')
+
+    def collect_output(self, job):
+        '''Collect the job output and put on blackboard.
+           This method is called by super().report() once job is done.'''
+
+        try:
+            with open(job.stdout) as f:
+                results = json.load(f)
+
+            # Downstream services pick up the reads from the blackboard; the
+            # job may come from the cache, so the files are in its dir now
+            files = list(map(lambda f: os.path.abspath(job.file_path(os.path.basename(f))), results.pop('files', [])))
+            if files:
+                results['illumina_fqs'] = files
+                self._blackboard.put_downsampled_paths(files)
+
+            self.store_results(results)
+
+        except Exception as e:
+            self.fail("failed to process job output (%s): %s", job.stdout, str(e))
@@ -13,6 +13,9 @@ from .versions import BACKEND_VERSIONS
 SERVICE, VERSION = "Flye", BACKEND_VERSIONS['flye']
 
 # Flye resource parameters: cpu, memory, disk, run time reqs
+# CPU and memory (GB) are granted by the scheduler within these bounds
+CPU_RANGE = (2, 12)
+MEM_RANGE = (8, 32)
 MAX_TIM = 0  # unlimited
 
 # Output file ex work dir
@@ -28,14 +31,13 @@ class FlyeShim:
 
         execution = FlyeExecution(SERVICE, VERSION, sid, xid, blackboard, scheduler)
 
-        # Max out the CPU and MEM but within reasonability
-        MAX_CPU = min(scheduler.max_cpu, 12)
-        MAX_MEM = min(int(scheduler.max_mem), 32)
-
         readqual = 'hq' if execution.get_user_input('fl_h', False) else 'raw'
 
         # Get the execution parameters from the blackboard
         try:
+            # Take what the scheduler can spare, but within reasonability
+            MAX_CPU, MAX_MEM = execution.grant_resources(CPU_RANGE, MEM_RANGE)
+
             reads = execution.get_nanofq_path()
 
             params = [
@@ -68,7 +70,7 @@ class FlyeExecution(ServiceExecution):
 
     def start(self, job_spec):
         if self.state == Task.State.STARTED:
-            self._job = self._scheduler.schedule_job('flye', job_spec, 'Flye')
+            self._job = self.schedule_job('flye', job_spec, 'Flye')
 
     def collect_output(self, job):
         '''Collect the job output and put on blackboard.
@@ -13,8 +13,9 @@ from .versions import BACKEND_VERSIONS
 SERVICE, VERSION = "GFAConnector", BACKEND_VERSIONS['skesa']
 
 # Resource parameters: cpu, memory, disk, run time reqs
-#MAX_CPU = -1 # all
-#MAX_MEM = 12 # all
+# CPU and memory (GB) are granted by the scheduler within these bounds
+CPU_RANGE = (2, 12)
+MEM_RANGE = (4, 32)
 MAX_TIM = 30 * 60
 
 # Output file ex work dir
@@ -30,12 +31,11 @@ class GFAConnectorShim:
 
         execution = GFAConnectorExecution(SERVICE, VERSION, sid, xid, blackboard, scheduler)
 
-        # Max out the CPU and MEM but within reasonability
-        MAX_CPU = min(scheduler.max_cpu, 12)
-        MAX_MEM = min(int(scheduler.max_mem), 32)
-
         # Get the execution parameters from the blackboard
         try:
+            # Take what the scheduler can spare, but within reasonability
+            MAX_CPU, MAX_MEM = execution.grant_resources(CPU_RANGE, MEM_RANGE)
+
             reads = execution.get_illufq_paths()
             if len(reads) != 2:
                 raise UserException("GFAConnector backend only handles Illumina paired-end reads")
@@ -71,7 +71,7 @@ class GFAConnectorExecution(ServiceExecution):
 
     def start(self, job_spec):
         if self.state == Task.State.STARTED:
-            self._job = self._scheduler.schedule_job('gfa-connector', job_spec, 'GFAConnector')
+            self._job = self.schedule_job('gfa-connector', job_spec, 'GFAConnector')
 
     def collect_output(self, job):
         '''Collect the job output and put on blackboard.
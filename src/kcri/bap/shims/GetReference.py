@@ -73,7 +73,7 @@ class GetReferenceExecution(ServiceExecution):
     def start(self, job_spec, out_file):
         if self.state == Task.State.STARTED:
             self._out_file = out_file
-            self._job = self._scheduler.schedule_job('kma-retrieve', job_spec, 'Reference')
+            self._job = self.schedule_job('kma-retrieve', job_spec, 'Reference')
 
     def collect_output(self, job):
 
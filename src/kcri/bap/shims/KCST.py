@@ -61,7 +61,7 @@ class KCSTExecution(ServiceExecution):
 
     def start(self, job_spec):
         if self.state == Task.State.STARTED:
-            self._job = self._scheduler.schedule_job('kcst', job_spec, 'kcst')
+            self._job = self.schedule_job('kcst', job_spec, 'kcst')
 
 
     def collect_output(self, job):
@@ -61,7 +61,7 @@ class KmerFinderExecution(ServiceExecution):
 
     def start(self, job_spec, scheme):
         if self.state == Task.State.STARTED:
-            self._job = self._scheduler.schedule_job('kf_%s' % scheme, job_spec, os.path.join(SERVICE,scheme))
+            self._job = self.schedule_job('kf_%s' % scheme, job_spec, os.path.join(SERVICE,scheme))
 
 
     # Parse the output produced by the backend service, return list of hits
@@ -3,7 +3,7 @@
 # kcri.bap.shims.MLSTFinder - service shim to the CGE MLST backend
 #
 
-import os, tempfile, json, logging
+import os, json, logging
 from pico.workflow.executor import Task
 from pico.jobcontrol.job import JobSpec, Job
 from .base import ServiceExecution, UserException
@@ -111,9 +111,10 @@ class MLSTFinderShim:
 class MLSTFinderExecution(ServiceExecution):
     '''A single execution of the MLSTFinder service, returned by MLSTFinder.execute().'''
 
-    _jobs = list()
+    _jobs = None
 
     def start(self, schemes, files, db_dir):
+        self._jobs = list()
         # Schedule a backend job for every scheme if all is good
         if self.state == Task.State.STARTED:
             for scheme,loci in schemes:
@@ -123,7 +124,7 @@ class MLSTFinderExecution(ServiceExecution):
         '''Spawn CGE MLST for one scheme and corresponding loci list.'''
 
         # Create a command line for the job
-        tmpdir = tempfile.TemporaryDirectory()
+        tmpdir = self.make_tmp_dir()
         params = [
                 '-p', db_dir,
                 '-s', scheme,
@@ -133,7 +134,7 @@ class MLSTFinderExecution(ServiceExecution):
 
         # Spawn the job and hold a record in the jobs table
         job_spec = JobSpec('mlst.py', params, MAX_CPU, MAX_MEM, MAX_TIM)
-        job = self._scheduler.schedule_job('mlst_%s' % scheme, job_spec, os.path.join(SERVICE,scheme))
+        job = self.schedule_job('mlst_%s' % scheme, job_spec, os.path.join(SERVICE,scheme))
         self._jobs.append((job, scheme, loci, tmpdir))
 
 
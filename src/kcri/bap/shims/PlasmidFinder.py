@@ -3,7 +3,7 @@
 # kcri.bap.shims.PlasmidFinder - service shim to the PlasmidFinder backend
 #
 
-import os, json, logging, tempfile
+import os, json, logging
 from pico.workflow.executor import Task
 from pico.jobcontrol.job import JobSpec, Job
 from .base import ServiceExecution, UserException
@@ -77,9 +77,9 @@ class PlasmidFinderExecution(ServiceExecution):
         self.store_job_spec(job_spec.as_dict())
 
         if self.state == Task.State.STARTED:
-            self._tmp_dir = tempfile.TemporaryDirectory()
+            self._tmp_dir = self.make_tmp_dir()
             job_spec.args.extend(['--tmp_dir', self._tmp_dir.name])
-            self._job = self._scheduler.schedule_job('plasmidfinder', job_spec, 'PlasmidFinder')
+            self._job = self.schedule_job('plasmidfinder', job_spec, 'PlasmidFinder')
 
     # Collect the output produced by the backend service and store on blackboard
     def collect_output(self, job):
@@ -116,7 +116,7 @@ class PointFinderExecution(ServiceExecution):
 
     def start(self, job_spec, work_dir):
         if self.state == Task.State.STARTED:
-            self._job = self._scheduler.schedule_job('pointfinder', job_spec, work_dir)
+            self._job = self.schedule_job('pointfinder', job_spec, work_dir)
 
     # Parse the output produced by the backend service, return list of hits
     def collect_output(self, job):
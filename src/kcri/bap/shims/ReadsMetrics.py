@@ -29,19 +29,17 @@ class ReadsMetricsShim:
 
         # From here we catch exception and execution will FAIL
         try:
-            fastqs = execution.get_illufq_paths([])
+            fastqs = execution.get_user_illufq_paths([])
             nanofq = execution.get_nanofq_path("")
             if nanofq: fastqs.append(nanofq)
             if not fastqs: raise UserException("no reads files to process")
 
-            arg = ""
-            for fq in fastqs:
-                arg += " '%s'" % os.path.abspath(fq)
-            # Cater for either gzipped or plain input using shell succinctness
-            cmd = "(gzip -dc %s 2>/dev/null || cat %s) | fastq-stats" % (arg,arg) 
+            # Cater for either gzipped or plain input using shell succinctness;
+            # the paths are arguments of their own, for the cache and profiles to see
+            cmd = '(gzip -dc "$@" 2>/dev/null || cat "$@") | fastq-stats'
             params = [
                 '-c', cmd, 'fastq-stats'
-            ]
+            ] + list(map(os.path.abspath, fastqs))
 
             job_spec = JobSpec('sh', params, MAX_CPU, MAX_MEM, MAX_TIM)
             execution.store_job_spec(job_spec.as_dict())
@@ -66,7 +64,7 @@ class ReadsMetricsExecution(ServiceExecution):
 
     def start(self, job_spec):
         if self.state == Task.State.STARTED:
-            self._job = self._scheduler.schedule_job('fastq-stats', job_spec, 'ReadsMetrics')
+            self._job = self.schedule_job('fastq-stats', job_spec, 'ReadsMetrics')
 
     def collect_output(self, job):
         '''Collect the job output and put on blackboard.
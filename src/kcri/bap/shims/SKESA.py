@@ -13,8 +13,9 @@ from .versions import BACKEND_VERSIONS
 SERVICE, VERSION = "SKESA", BACKEND_VERSIONS['skesa']
 
 # SKESA resource parameters: cpu, memory, disk, run time reqs
-#MAX_CPU = -1 # all
-#MAX_MEM = 12 # all
+# CPU and memory (GB) are granted by the scheduler within these bounds
+CPU_RANGE = (2, 12)
+MEM_RANGE = (4, 32)
 MAX_TIM = 0  # unlimited
 
 # Output file ex work dir
@@ -29,12 +30,11 @@ class SKESAShim:
 
         execution = SKESAExecution(SERVICE, VERSION, sid, xid, blackboard, scheduler)
 
-        # Max out the CPU and MEM but within reasonability
-        MAX_CPU = min(scheduler.max_cpu, 12)
-        MAX_MEM = min(int(scheduler.max_mem), 32)
-
         # Get the execution parameters from the blackboard
         try:
+            # Take what the scheduler can spare, but within reasonability
+            MAX_CPU, MAX_MEM = execution.grant_resources(CPU_RANGE, MEM_RANGE)
+
             if len(execution.get_illufq_paths()) != 2:
                 raise UserException("SKESA backend only handles paired-end reads")
 
@@ -68,7 +68,7 @@ class SKESAExecution(ServiceExecution):
 
     def start(self, job_spec):
         if self.state == Task.State.STARTED:
-            self._job = self._scheduler.schedule_job('skesa', job_spec, 'SKESA')
+            self._job = self.schedule_job('skesa', job_spec, 'SKESA')
 
     def collect_output(self, job):
         '''Collect the job output and put on blackboard.
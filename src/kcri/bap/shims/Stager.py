@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.shims.Stager - service shim to the kcri.bap.staging module
+#
+
+import sys, os, shutil, logging, tempfile
+from pico.workflow.executor import Task
+from pico.jobcontrol.job import JobSpec, Job
+from .base import ServiceExecution, UserException, SkipException
+
+# Our service name and current backend version: that of the kcri.bap.staging
+# module, not the BAP's, so that BAP releases don't make its output outdated
+SERVICE, VERSION = "Stager", "1.0.0"
+
+# Resource parameters: cpu (per file), memory, disk, run time reqs
+MAX_CPU = 1
+MAX_MEM = 1
+MAX_TIM = 30 * 60
+
+# Space to have free in the stage dir, as a multiple of the gzipped size
+SPACE_FACTOR = 5
+
+
+# The Service class
+class StagerShim:
+    '''Service shim that executes the backend.'''
+
+    def execute(self, sid, xid, blackboard, scheduler):
+        '''Invoked by the executor.  Creates, starts and returns the Task.'''
+
+        # Only gzipped reads files gain from staging (other than on a slow disk)
+        fastqs = blackboard.get_downsampled_paths(blackboard.get_illufq_paths(list())) + list(filter(None, [ blackboard.get_nanofq_path() ]))
+        gzipped = list(filter(is_gzipped, fastqs))
+        if not gzipped:
+            raise SkipException("no gzipped reads files to stage")
+
+        stage_root = blackboard.get_user_input('stage_dir')
+        need = SPACE_FACTOR * sum(map(os.path.getsize, gzipped))
+        free = shutil.disk_usage(stage_root).free
+        if free < need:
+            raise SkipException("not enough space in %s: %.1f GB free, %.1f GB needed", stage_root, free / 2**30, need / 2**30)
+
+        execution = StagerExecution(SERVICE, VERSION, sid, xid, blackboard, scheduler)
+
+        # From here we catch exception and execution will FAIL
+        try:
+            stage_dir = tempfile.mkdtemp(prefix='bap-%s-' % blackboard.get_sample_id(), dir=stage_root)
+            blackboard.put_staging_dir(stage_dir)
+
+            params = [ '-m', 'kcri.bap.staging' ]
+            staged = dict()
+            for i, fq in enumerate(gzipped):
+                name = os.path.basename(fq)
+                name = name[:-3] if name.endswith('.gz') else name
+                if name in map(os.path.basename, staged.values()):
+                    name = '%d-%s' % (i, name)
+                staged[fq] = os.path.join(stage_dir, name)
+                params.extend([ os.path.abspath(fq), staged[fq] ])
+
+            job_spec = JobSpec(sys.executable, params, MAX_CPU * len(gzipped), MAX_MEM, MAX_TIM)
+            execution.store_job_spec(job_spec.as_dict())
+            execution.start(job_spec, staged)
+
+        # Failing inputs will throw UserException
+        except UserException as e:
+            execution.fail(str(e))
+
+        # Deeper errors additionally dump stack
+        except Exception as e:
+            logging.exception(e)
+            execution.fail(str(e))
+
+        return execution
+
+# Single execution of the service
+class StagerExecution(ServiceExecution):
+    '''A single execution of the service, returned by execute().'''
+
+    # The staged files are not in the job dir, so the job can't come from cache
+    _cacheable = False
+    _job = None
+    _files = None
+
+    def start(self, job_spec, staged):
+        if self.state == Task.State.STARTED:
+            self._files = staged
+            self._job = self.schedule_job('staging', job_spec, 'Stager')
+
+    def collect_output(self, job):
+        '''Check the staged files and put them on blackboard.
+           This method is called by super().report() once job is done.'''
+
+        missing = list(filter(lambda p: not os.path.isfile(p), self._files.values()))
+        if missing:
+            self.fail("backend job did not stage: %s", ', '.join(missing))
+        else:
+            self.store_results({ 'staged': self._files, 'bytes': sum(map(os.path.getsize, self._files.values())) })
+            self._blackboard.put_staged_paths(self._files)
+
+
+def is_gzipped(path):
+    '''Return True if the file at path is gzipped.'''
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
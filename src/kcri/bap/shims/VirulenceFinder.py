@@ -3,7 +3,7 @@
 # kcri.bap.shims.VirulenceFinder - service shim to the VirulenceFinder backend
 #
 
-import os, json, logging, tempfile
+import os, json, logging
 from pico.workflow.executor import Task
 from pico.jobcontrol.job import JobSpec, Job
 from .base import ServiceExecution, UserException
@@ -88,9 +88,9 @@ class VirulenceFinderExecution(ServiceExecution):
         self.store_job_spec(job_spec.as_dict())
 
         if self.state == Task.State.STARTED:
-            self._tmp_dir = tempfile.TemporaryDirectory()
+            self._tmp_dir = self.make_tmp_dir()
             job_spec.args.extend(['--tmp_dir', self._tmp_dir.name])
-            self._job = self._scheduler.schedule_job('virulencefinder', job_spec, 'VirulenceFinder')
+            self._job = self.schedule_job('virulencefinder', job_spec, 'VirulenceFinder')
 
     # Collect the output produced by the backend service and store on blackboard
     def collect_output(self, job):
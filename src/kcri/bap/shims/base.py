@@ -5,10 +5,13 @@
 #   This module defines ServiceExecution and UnimplementedService.
 #
 
-import os
+import os, sys, tempfile
 from datetime import datetime
 from pico.workflow.executor import Task
-from pico.jobcontrol.job import Job
+from pico.jobcontrol.job import Job, JobSpec
+from ..cache import job_key, db_fingerprint, CachedJob, JOB_GRANT_PLACEHOLDER
+from ..profiles import USAGE_FILE, job_input_size, read_usage
+from ..workflow import SERVICE_PRIORITIES
 
 
 ### class UserException
@@ -30,6 +33,25 @@ class SkipException(Exception):
         super().__init__(message % args)
 
 
+def parse_grant_ranges(ranges, cpu_range, mem_range):
+    '''Parse ranges, formatted as 'CPUS[:GB]' where CPUS and GB are a number
+       or a MIN-MAX range, into a (cpu_range, mem_range) tuple, taking omitted
+       parts from cpu_range and mem_range.  Raises UserException if invalid.'''
+
+    def parse(part):
+        lo, _, hi = part.partition('-')
+        try:
+            lo, hi = int(lo), int(hi if hi else lo)
+        except ValueError:
+            raise UserException("invalid range in --elastic: %s", part)
+        if lo < 1 or hi < lo:
+            raise UserException("invalid range in --elastic: %s", part)
+        return (lo, hi)
+
+    cpus, _, gbs = ranges.partition(':')
+    return parse(cpus) if cpus else cpu_range, parse(gbs) if gbs else mem_range
+
+
 ### class ServiceExecution
 #
 #   Base class for the executions returned by all BAP Service shims.
@@ -40,6 +62,12 @@ class ServiceExecution(Task):
 
     _blackboard = None
     _scheduler = None
+    _cache_jobs = None
+    _profile_jobs = None
+    _sched_jobs = None
+    _cancelled = False
+    _grant = None
+    _cacheable = True   # False if the jobs' output is not just in their work dir
 
     def __init__(self, svc_shim, svc_version, sid, xid, blackboard, scheduler):
         '''Construct execution of service sid for workflow execution xid (will be None)
@@ -47,6 +75,9 @@ class ServiceExecution(Task):
         super().__init__(sid, xid)
         self._blackboard = blackboard
         self._scheduler = scheduler
+        self._cache_jobs = list()
+        self._profile_jobs = list()
+        self._sched_jobs = list()
         #self.put_run_info('id', self.id)		is (sid,xid) and here always (sid,None)
         #self.put_run_info('execution', xid)	always None
         self.put_run_info('shim', svc_shim)
@@ -71,6 +102,121 @@ class ServiceExecution(Task):
 
         return self.state
 
+    def schedule_job(self, name, job_spec, work_dir):
+        '''Schedule job_spec on the scheduler as job name in work_dir, and return
+           the job.  If the scheduler replays this service, the job is the one
+           already in work_dir.  If the scheduler has a cache, the job may come
+           from there, and if it doesn't, is cached when this execution completes.'''
+
+        # Reuse the job's existing work directory if we are replaying this service
+        replay = getattr(self._scheduler, 'replay', None)
+        if replay and str(self.sid) in replay:
+            job = self._scheduler.replay_job(name, work_dir)
+            if job:
+                # The output was produced by the recorded backend and databases
+                recorded = replay[str(self.sid)]
+                self.put_run_info('version', recorded.get('version'))
+                if recorded.get('databases') or self.get_run_info('databases'):
+                    self.put_run_info('databases', recorded.get('databases'))
+                self.put_run_info('replayed', True)
+                return job
+
+        # The cache key is of the job as the shim specified it, but not its grant
+        cache = getattr(self._scheduler, 'cache', None) if self._cacheable else None
+        key = job_key(self.sid, self.get_run_info('version'), self.ungranted(job_spec.as_dict()), self._blackboard.get_db_root()) if cache else None
+        job_spec, input_size, runtime = self.profile_job(job_spec)
+
+        priority = SERVICE_PRIORITIES.get(self.sid)
+        if not cache:
+            job = self._scheduler.schedule_job(name, job_spec, work_dir, priority=priority, runtime=runtime)
+        else:
+            reuse = not self.get_user_input('no_cache', False)
+            job = self._scheduler.schedule_job(name, job_spec, work_dir, key if reuse else None, priority, runtime)
+            self._cache_jobs.append((key, job))
+
+        if input_size is not None and not isinstance(job, CachedJob):
+            self._profile_jobs.append((input_size, job))
+        self._sched_jobs.append(job)
+        return job
+
+    def make_tmp_dir(self):
+        '''Return a new TemporaryDirectory for a backend job to keep its temporary
+           files in.  It is in the system temp dir, unless the scheduler runs jobs
+           on other hosts, which only share the output directory with us.'''
+        remote = getattr(self._scheduler, 'remote', False)
+        return tempfile.TemporaryDirectory(prefix='bap-tmp-', dir=os.path.abspath(self._scheduler.out_dir) if remote else None)
+
+    def grant_resources(self, cpu_range, mem_range):
+        '''Return the (cpu, mem) to give an elastic job, which can use anything
+           in cpu_range and mem_range (min, max tuples), unless the user set
+           other bounds for this service with --elastic.  The scheduler picks
+           the grant from what is free, and it is recorded in the run_info.'''
+
+        for spec in self._blackboard.get_user_input('elastic') or []:
+            svc, _, ranges = spec.partition('=')
+            if svc == str(self.sid):
+                cpu_range, mem_range = parse_grant_ranges(ranges, cpu_range, mem_range)
+
+        grant = getattr(self._scheduler, 'grant_resources', None)
+        if grant:
+            cpu, mem = grant(cpu_range, mem_range)
+        else:
+            cpu, mem = min(self._scheduler.max_cpu, cpu_range[1]), min(int(self._scheduler.max_mem), mem_range[1])
+
+        self.put_run_info('grant', { 'cpu': cpu, 'mem': mem })
+        self._grant = (cpu, mem)
+        return cpu, mem
+
+    def cancel(self, reason):
+        '''Stop the jobs of this execution, if the scheduler can, and end it with
+           status CANCELLED and reason as its warning.  The Task state is FAILED.'''
+        stop_job = getattr(self._scheduler, 'stop_job', None)
+        for job in self._sched_jobs:
+            if stop_job and job.state not in [ Job.State.COMPLETED, Job.State.FAILED ]:
+                stop_job(job)
+        self._cancelled = True
+        self.add_warning('cancelled: %s' % reason)
+        return self._transition(Task.State.FAILED, reason)
+
+    def ungranted(self, spec):
+        '''Return the job spec dict with the granted CPUs and memory on its command
+           line replaced by a placeholder, as the output does not depend on them.'''
+        if not self._grant:
+            return spec
+        return dict(spec, args=[ JOB_GRANT_PLACEHOLDER if isinstance(a, int) and a in self._grant else a for a in spec.get('args', []) ])
+
+    def profile_job(self, job_spec):
+        '''If the scheduler has a ProfileStore, return job_spec changed to reserve
+           the CPU and memory (unless these were granted), and to have the time
+           limit, estimated from the recorded usage (if there is enough), and to
+           be run under the usage measurement, along with the job's input size
+           and expected run time (or None).  Else return job_spec as is, and None
+           for both.'''
+
+        profiles = getattr(self._scheduler, 'profiles', None)
+        if not profiles:
+            return job_spec, None, None
+
+        spec = job_spec.as_dict()
+        cpu, mem, tim = spec['cpu'], spec['mem'], spec['tim']
+        input_size = job_input_size(spec, self._blackboard.get_db_root())
+        version = self.get_run_info('version')
+
+        # Jobs with a grant have it on their command line, so must reserve all of it
+        estimate = profiles.estimate(str(self.sid), version, input_size)
+        if estimate and not self._grant:
+            cpu = min(cpu, estimate[0]) if cpu else estimate[0]
+            mem = min(estimate[1], self._scheduler.max_mem)
+            self.put_run_info('resources', { 'cpu': cpu, 'mem': mem, 'profiled': True })
+
+        runtime = profiles.runtime(str(self.sid), version, input_size)
+        if runtime:
+            tim = runtime[1]
+            self.put_run_info('resources/runtime', { 'expected': runtime[0], 'limit': tim })
+
+        args = [ sys.executable, '-m', 'kcri.bap.profiles', USAGE_FILE, spec['command'] ] + list(map(str, spec['args']))
+        return JobSpec(args[0], args[1:], cpu, mem, tim), input_size, runtime[0] if runtime else None
+
     # Low level update routines for subclasses
 
     def get_run_info(self, path):
@@ -119,12 +265,52 @@ class ServiceExecution(Task):
             self.put_run_info('time/end', now_time.isoformat(timespec='seconds'))
 
         # Set the run_info status field and error list
-        self.put_run_info('status', new_state.value)
-        if new_state == Task.State.FAILED:
+        self.put_run_info('status', 'CANCELLED' if self._cancelled else new_state.value)
+        if new_state == Task.State.FAILED and not self._cancelled:
             self.add_error(self.error)
 
+        # Cache and record the usage of the jobs of a successful execution
+        if new_state == Task.State.COMPLETED:
+            self.cache_jobs()
+            self.profile_jobs()
+
+        # Record the usage of jobs that ran in a cgroup (see kcri.bap.cgroups),
+        # and the attempts of jobs that were relaunched (see FairShareScheduler)
+        if new_state in [ Task.State.COMPLETED, Task.State.FAILED ]:
+            usages = list(filter(None, map(lambda j: getattr(j, 'cgroup_usage', None), self._sched_jobs)))
+            if usages:
+                self.put_run_info('cgroups', usages)
+            attempts = [ { 'job': j.name, 'attempts': j.attempts() } for j in self._sched_jobs if len(getattr(j, 'attempts', list)()) > 1 ]
+            if attempts:
+                self.put_run_info('relaunched', attempts)
+
+        # Checkpoint the blackboard so that the run can be resumed
+        self._blackboard.save_checkpoint()
+
         return new_state
 
+    def cache_jobs(self):
+        '''Store the completed jobs of this execution in the scheduler's cache.'''
+        for key, job in self._cache_jobs:
+            if job.state == Job.State.COMPLETED:
+                try:
+                    self._scheduler.cache.store_job(key, job)
+                except Exception as e:
+                    self.add_warning('failed to store job %s in cache: %s' % (job.name, str(e)))
+        self._cache_jobs = list()
+
+    def profile_jobs(self):
+        '''Record the usage of the completed jobs of this execution in the
+           scheduler's ProfileStore.'''
+        for input_size, job in self._profile_jobs:
+            usage = read_usage(job) if job.state == Job.State.COMPLETED else None
+            if usage:
+                try:
+                    self._scheduler.profiles.record(str(self.sid), self.get_run_info('version'), input_size, usage)
+                except Exception as e:
+                    self.add_warning('failed to record usage of job %s: %s' % (job.name, str(e)))
+        self._profile_jobs = list()
+
     # Getters for the shared fields among services;
     # all of these raise an exception unless default is given
 
@@ -141,6 +327,7 @@ class ServiceExecution(Task):
         db_path = os.path.join(self._blackboard.get_db_root(), db_name)
         if not os.path.isdir(db_path):
             raise UserException("database path not found: %s", db_path)
+        self.put_run_info('databases/%s' % db_name, db_fingerprint(db_path))
         return db_path
 
     def get_user_input(self, param, default=None):
@@ -151,18 +338,25 @@ class ServiceExecution(Task):
         return ret
 
     def get_illufq_paths(self, default=None):
-        '''Return the list of fastq paths, or fail if no default provided.'''
+        '''Return the list of fastq paths (downsampled and/or staged if so), or fail if no default provided.'''
+        ret = self._blackboard.get_downsampled_paths(self._blackboard.get_illufq_paths(default))
+        if ret is None:
+            raise UserException("no Illumina fastq files were provided")
+        return self._staged(ret)
+
+    def get_user_illufq_paths(self, default=None):
+        '''Return the list of user provided fastq paths (staged if so), or fail if no default provided.'''
         ret = self._blackboard.get_illufq_paths(default)
         if ret is None:
             raise UserException("no Illumina fastq files were provided")
-        return ret
+        return self._staged(ret)
 
     def get_nanofq_path(self, default=None):
-        '''Return the fastq path, or fail if no default provided.'''
+        '''Return the fastq path (staged if so), or fail if no default provided.'''
         ret = self._blackboard.get_nanofq_path(default)
         if ret is None:
             raise UserException("no Nanopore fastq files were provided")
-        return ret
+        return self._staged(ret)
 
     def get_user_contigs_path(self, default=None):
         '''Return the path to the user provided contigs, or fail if no default.'''
@@ -187,18 +381,25 @@ class ServiceExecution(Task):
 
     def get_illufq_or_contigs_paths(self, default=None):
         '''Return the Illumina fastqs or else the assembled or user provided contigs in a list.'''
-        ret = self._blackboard.get_illufq_paths(self.get_contigs_path([]))
+        ret = self._staged(self._blackboard.get_downsampled_paths(self._blackboard.get_illufq_paths(self.get_contigs_path([]))))
         if not ret and default is None:
             raise UserException("no Illumina reads or contigs files were provided")
         return ret if isinstance(ret,list) else [ret]
 
     def get_fastq_or_contigs_paths(self, default=None):
         '''Return the Illumina fastqs, or else the Nanopore fastq, or else contigs, in a list, or else default or fail.'''
-        ret = self._blackboard.get_illufq_paths(self._blackboard.get_nanofq_path(self.get_contigs_path("")))
+        ret = self._staged(self._blackboard.get_downsampled_paths(self._blackboard.get_illufq_paths(self._blackboard.get_nanofq_path(self.get_contigs_path("")))))
         if not ret and default is None:
             raise UserException("no reads files or contigs files were provided")
         return ret if isinstance(ret,list) else [ret]
 
+    def _staged(self, paths):
+        '''Return paths (a list or single path) with the staged copy of each in
+           its place, if it has one that exists (see kcri.bap.staging).'''
+        staged = self._blackboard.get_staged_paths(dict())
+        lookup = lambda p: staged[p] if p in staged and os.path.isfile(staged[p]) else p
+        return list(map(lookup, paths)) if isinstance(paths, list) else lookup(paths) if paths else paths
+
     def get_species(self, default=None):
         '''Return the list of specified and detected species, or else default or else fail if None.'''
         ret = self._blackboard.get_species(default)
@@ -3,7 +3,7 @@
 # kcri.bap.shims.cgMLSTFinder - service shim to the cgMLSTFinder backend
 #
 
-import os, json, tempfile, logging
+import os, json, logging
 from pico.workflow.executor import Task
 from pico.jobcontrol.job import JobSpec, Job
 from .base import ServiceExecution, UserException, SkipException
@@ -100,9 +100,10 @@ class cgMLSTFinderShim:
 class cgMLSTExecution(ServiceExecution):
     '''A single execution of the service, returned by the shim's execute().'''
 
-    _jobs = list()
+    _jobs = None
 
     def start(self, schemes, inputs, db_dir):
+        self._jobs = list()
         # Schedule a backend job for every scheme if all is good
         if self.state == Task.State.STARTED:
             for scheme in schemes:
@@ -112,7 +113,7 @@ class cgMLSTExecution(ServiceExecution):
         '''Spawn cgMLST for one scheme.'''
 
         # Create a command line for the job
-        tmpdir = tempfile.TemporaryDirectory()
+        tmpdir = self.make_tmp_dir()
         params = [
                 '-i', inputs,
                 '-db', db_dir,
@@ -122,7 +123,7 @@ class cgMLSTExecution(ServiceExecution):
 
         # Spawn the job and hold a record in the jobs table
         job_spec = JobSpec('cgMLST.py', params, MAX_CPU, MAX_MEM, MAX_TIM)
-        job = self._scheduler.schedule_job('cgmlst_%s' % scheme, job_spec, os.path.join(SERVICE,scheme))
+        job = self.schedule_job('cgmlst_%s' % scheme, job_spec, os.path.join(SERVICE,scheme))
         self._jobs.append((job, scheme, tmpdir))
  
 
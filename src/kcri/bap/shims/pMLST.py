@@ -3,7 +3,7 @@
 # kcri.bap.shims.pMLSTShim - service shim to the pMLST backend
 #
 
-import os, tempfile, json, logging
+import os, json, logging
 from pico.workflow.executor import Task
 from pico.jobcontrol.job import JobSpec, Job
 from .base import ServiceExecution, UserException, SkipException
@@ -125,9 +125,10 @@ class pMLSTShim:
 class pMLSTExecution(ServiceExecution):
     '''A single execution of the service, returned by the shim's execute().'''
 
-    _jobs = list()  # of (job, scheme, loci, tmpdir) tuple
+    _jobs = None  # of (job, scheme, loci, tmpdir) tuple
 
     def start(self, schemes, files, db_dir):
+        self._jobs = list()
         # Schedule a backend job for every scheme if all is good
         if self.state == Task.State.STARTED:
             for scheme,loci in schemes:
@@ -137,7 +138,7 @@ class pMLSTExecution(ServiceExecution):
         '''Spawn pMLST for one scheme and corresponding loci list.'''
 
         # Create a command line for the job
-        tmpdir = tempfile.TemporaryDirectory()
+        tmpdir = self.make_tmp_dir()
         params = [
                 '-p', db_dir,
                 '-s', scheme,
@@ -147,7 +148,7 @@ class pMLSTExecution(ServiceExecution):
 
         # Spawn the job and hold a record in the jobs table
         job_spec = JobSpec('pmlst.py', params, MAX_CPU, MAX_MEM, MAX_TIM)
-        job = self._scheduler.schedule_job('pmlst_%s' % scheme, job_spec, os.path.join(SERVICE,scheme))
+        job = self.schedule_job('pmlst_%s' % scheme, job_spec, os.path.join(SERVICE,scheme))
         self._jobs.append((job, scheme, loci, tmpdir))
 
 
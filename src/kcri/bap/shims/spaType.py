@@ -59,7 +59,7 @@ class spaTypeExecution(ServiceExecution):
     def start(self, job_spec, work_dir):
         if self.state == Task.State.STARTED:
             self.store_job_spec(job_spec.as_dict())
-            self._job = self._scheduler.schedule_job('spa-type', job_spec, work_dir)
+            self._job = self.schedule_job('spa-type', job_spec, work_dir)
 
     # Parse the output produced by the backend service, return list of hits
     def collect_output(self, job):
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.slurm - running the backend jobs on a Slurm cluster
+#
+#   The SlurmScheduler stands in for the picoline SubprocessScheduler, and
+#   submits jobs to Slurm with sbatch rather than running them locally.  The
+#   BAP then only orchestrates, and a batch of samples fans out over as many
+#   nodes as the cluster gives it.
+#
+#   Each job is submitted as a small shell script (JOB_SCRIPT) in its work
+#   directory, which runs the command with its output in the 'stdout' and
+#   'stderr' files, as a local job would, and writes the command's exit code
+#   to EXIT_FILE.  The scheduler tracks the jobs with squeue, and when a job
+#   has left the queue reads its exit code from EXIT_FILE.  It needs neither
+#   sacct nor accounting, but it does need the work directories (i.e. the
+#   output directory) to be on a filesystem shared with the nodes, as well as
+#   the backends (and the BAP itself, when profiling) at the same paths.
+#
+#   The sbatch, squeue and scancel commands are looked up on the PATH, so for
+#   testing, stand-ins that run the script locally will do.
+#
+
+import os, math, time, shlex, shutil, subprocess
+from pico.jobcontrol.job import Job
+from .shims.base import UserException
+
+# Names of the files in the job's work dir that hold its script and exit code
+JOB_SCRIPT = 'bap-job.sh'
+EXIT_FILE = 'bap-exit'
+
+# Name of the file in the job's work dir that gets Slurm's own output
+SLURM_LOG = 'bap-slurm.log'
+
+# Seconds to wait for the exit code of a job that has left the queue, as the
+# shared filesystem may not show it right away
+EXIT_GRACE = 30
+
+# Default limits on the CPUs and memory (GB) of the jobs submitted at once,
+# which leave the queueing to Slurm
+MAX_CPU = 1024
+MAX_MEM = 4096
+
+
+### class SlurmJob
+#
+#   A job submitted to Slurm.  It has the attributes of a picoline Job that
+#   the shims use: name, spec, state, error, stdout, and file_path().
+
+class SlurmJob:
+    '''Job that runs as a Slurm batch job.'''
+
+    def __init__(self, name, spec, wdir):
+        self.name = name
+        self.spec = spec
+        self.state = Job.State.QUEUED
+        self.error = None
+        self.stdout = os.path.join(wdir, 'stdout')
+        self.stderr = os.path.join(wdir, 'stderr')
+        self.slurm_id = None
+        self._wdir = wdir
+        self._gone_since = None     # time it was first missing from squeue
+        self._cancelled = False
+
+    def file_path(self, fname):
+        '''Return the path to fname in the job's work directory.'''
+        return os.path.join(self._wdir, fname)
+
+
+### class SlurmScheduler
+#
+#   Submits jobs to Slurm, and polls squeue every poll seconds for their state.
+#   Like the SubprocessScheduler, it has max_cpu and max_mem, which here cap
+#   the resources of the jobs that are submitted at once (see FairShareScheduler).
+
+class SlurmScheduler:
+    '''Scheduler that runs jobs on a Slurm cluster through sbatch and squeue.'''
+
+    # Jobs run on other hosts, which share only the output directory with us
+    remote = True
+
+    def __init__(self, max_cpu=None, max_mem=None, poll=5, sbatch_opts=None):
+        '''Create scheduler that has at most max_cpu CPUs and max_mem GB worth
+           of jobs submitted, polls every poll seconds, and passes the list of
+           sbatch_opts (e.g. [ '--partition=long' ]) to sbatch.  Raises
+           UserException if the Slurm commands are not on the PATH.'''
+
+        for cmd in [ 'sbatch', 'squeue', 'scancel' ]:
+            if not shutil.which(cmd):
+                raise UserException("cannot find the Slurm command %s on the PATH", cmd)
+
+        self.max_cpu = max_cpu if max_cpu else MAX_CPU
+        self.max_mem = max_mem if max_mem else MAX_MEM
+        self._poll = poll
+        self._sbatch_opts = list(sbatch_opts) if sbatch_opts else list()
+        self._jobs = list()     # SlurmJobs that are QUEUED or RUNNING
+
+    def schedule_job(self, name, spec, wdir):
+        '''Submit the job to run in wdir, returns a SlurmJob.  Raises an
+           Exception if sbatch fails.'''
+
+        wdir = os.path.abspath(wdir if wdir else name)
+        os.makedirs(wdir, exist_ok=True)
+        job = SlurmJob(name, spec, wdir)
+
+        for fname in [ EXIT_FILE, EXIT_FILE + '.tmp' ]:
+            if os.path.exists(job.file_path(fname)):
+                os.remove(job.file_path(fname))
+
+        command = ' '.join(map(lambda a: shlex.quote(str(a)), [ spec.command ] + list(spec.args)))
+        with open(job.file_path(JOB_SCRIPT), 'w') as f:
+            print('#!/bin/sh', file=f)
+            print('cd %s || exit 1' % shlex.quote(wdir), file=f)
+            print('%s >stdout 2>stderr' % command, file=f)
+            print('echo $? >%s.tmp && mv %s.tmp %s' % (EXIT_FILE, EXIT_FILE, EXIT_FILE), file=f)
+
+        args = [ 'sbatch', '--parsable', '--job-name', name, '--chdir', wdir, '--output', SLURM_LOG,
+                 '--cpus-per-task', str(max(1, math.ceil(spec.cpu or 1))) ]
+        if spec.mem:
+            args.extend([ '--mem', '%dM' % math.ceil(spec.mem * 1024) ])
+        if spec.tim:
+            args.extend([ '--time', str(max(1, math.ceil(spec.tim / 60))) ])
+
+        proc = subprocess.run(args + self._sbatch_opts + [ job.file_path(JOB_SCRIPT) ],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if proc.returncode != 0 or not proc.stdout.strip():
+            raise Exception('sbatch failed: %s' % (proc.stderr.strip() or 'exit %d' % proc.returncode))
+
+        job.slurm_id = proc.stdout.strip().split(';')[0]
+        self._jobs.append(job)
+        return job
+
+    def listen(self):
+        '''Sleep poll seconds, then update the state of the submitted jobs.'''
+
+        time.sleep(self._poll)
+        if not self._jobs:
+            return
+
+        listed = self._squeue(self._jobs)
+        if listed is None:
+            return  # squeue failed, try again next time
+
+        for job in list(self._jobs):
+            state = listed.get(job.slurm_id)
+            if state:
+                job.state = Job.State.QUEUED if state == 'PENDING' else Job.State.RUNNING
+                job._gone_since = None
+            else:
+                self._collect(job)
+
+    def stop_job(self, job):
+        '''Cancel the job in Slurm.  It FAILs when it has left the queue.'''
+        if job in self._jobs:
+            subprocess.run([ 'scancel', job.slurm_id ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            job._cancelled = True
+
+    def _squeue(self, jobs):
+        '''Return dict of Slurm job id to state of those jobs squeue lists, or
+           None if squeue failed.'''
+
+        proc = subprocess.run([ 'squeue', '--noheader', '--format', '%i %T', '--jobs', ','.join(j.slurm_id for j in jobs) ],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+        # squeue fails when none of the jobs is known any more
+        if proc.returncode != 0:
+            return dict() if 'Invalid job id' in proc.stderr else None
+
+        return dict(tuple(l.split()[:2]) for l in proc.stdout.splitlines() if len(l.split()) >= 2)
+
+    def _collect(self, job):
+        '''Set the final state of job, which has left the queue, from its exit
+           code, or fail it if that has not shown up within EXIT_GRACE.'''
+
+        try:
+            with open(job.file_path(EXIT_FILE)) as f:
+                rc = int(f.read().strip())
+        except (OSError, ValueError):
+            if job._gone_since is None:
+                job._gone_since = time.time()
+            if time.time() - job._gone_since < EXIT_GRACE and not job._cancelled:
+                return
+            job.state = Job.State.FAILED
+            job.error = 'cancelled' if job._cancelled else \
+                'Slurm job %s ended without an exit code (cancelled, out of time or memory, or node failure), see %s' % (
+                    job.slurm_id, job.file_path(SLURM_LOG))
+        else:
+            job.state = Job.State.COMPLETED if rc == 0 else Job.State.FAILED
+            job.error = 'backend exited with code %d' % rc if rc else None
+
+        self._jobs.remove(job)
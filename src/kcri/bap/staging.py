@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.staging - decompressing the input reads once for all services
+#
+#   Most read-based services take the gzipped reads files as they are, and
+#   each decompresses them again: some ten times per sample.  With the
+#   --stage-dir option, the Stager service first decompresses them once into
+#   a directory of the run's own below the stage dir (ideally on a fast local
+#   disk or tmpfs), and the shims get these copies in their place from
+#   get_illufq_paths() and get_nanofq_path() (see ServiceExecution).
+#
+#   The Stager's job runs this module, which decompresses each SRC to DST,
+#   all in parallel (zlib releases the GIL):
+#
+#       python3 -m kcri.bap.staging SRC DST [SRC DST ...]
+#
+#   The run's staging directory is removed by release_staged() once none of
+#   the services that read the reads can still run (see reads_in_use in the
+#   workflow module), or when the run ends, whichever comes first.  Shims
+#   only get staged copies that exist, and otherwise get the original files.
+#
+
+import sys, os, shutil, zlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from .validate import open_input
+
+# Read buffer size for the copying
+BUFFER_SIZE = 2**20
+
+
+def stage_file(src, dst):
+    '''Decompress (or copy) src to dst, through a temporary file.'''
+    with open_input(src) as fi, open(dst + '.tmp', 'wb') as fo:
+        shutil.copyfileobj(fi, fo, BUFFER_SIZE)
+    os.replace(dst + '.tmp', dst)
+
+
+def stage_files(pairs):
+    '''Stage each (src, dst) in pairs, in parallel.  Raises the first error.'''
+    with ThreadPoolExecutor(max(1, len(pairs))) as pool:
+        for _ in pool.map(lambda p: stage_file(*p), pairs):
+            pass
+
+
+def release_staged(blackboard):
+    '''Remove the staging directory of the run on blackboard, if it has one
+       that was not released yet.'''
+    stage_dir = blackboard.get_staging_dir()
+    if stage_dir and not blackboard.get_staging_released():
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        blackboard.put_staging_released(datetime.now().isoformat(timespec='seconds'))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or len(sys.argv) % 2 != 1:
+        print('Usage: %s SRC DST [SRC DST ...]' % sys.argv[0], file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        stage_files(list(zip(sys.argv[1::2], sys.argv[2::2])))
+    except (OSError, EOFError, zlib.error) as e:
+        print('staging: %s' % str(e), file=sys.stderr)
+        sys.exit(1)
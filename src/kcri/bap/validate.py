@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.validate - checking the input files in full before a run
+#
+#   When the BAP starts, it only looks at the first record of each input
+#   file to classify it.  A truncated gzip, or R1 and R2 files that do not
+#   pair up, then surface hours later as an assembler failure.  With the
+#   --validate option, every input file is read in full before anything is
+#   scheduled, each in a process of its own, and the run is not started if
+#   any of them is broken.
+#
+#   A file is checked for gzip integrity (if compressed), for its FASTA or
+#   FASTQ record structure, and, for FASTQ, to have at least one read.  The
+#   Illumina R1 and R2 files of a sample must have the same number of reads,
+#   with the same names in the same order (ignoring /1 and /2 suffixes).
+#   For that, each process returns the read count and a digest of the names.
+#
+#   The processes are spawned rather than forked, as the BAP validates from
+#   its threaded daemon modes too, where a forked child could inherit a lock
+#   that another thread held at the time.
+#
+
+import os, gzip, zlib, hashlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Read buffer size for the files
+BUFFER_SIZE = 2**20
+
+
+def open_input(path):
+    '''Open the (optionally gzipped) file at path for binary reading.'''
+    f = open(path, 'rb', buffering=BUFFER_SIZE)
+    if f.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=f)
+    return f
+
+
+def check_fastq(f):
+    '''Return the number of reads in the open FASTQ file f and the digest of
+       their names, or raise ValueError at the first broken record.'''
+    digest = hashlib.sha1()
+    count = 0
+    lines = iter(f)
+    for head in lines:
+        seq, plus, qual = next(lines, None), next(lines, None), next(lines, None)
+        count += 1
+        if qual is None:
+            raise ValueError('incomplete record at read %d' % count)
+        if head[:1] != b'@' or plus[:1] != b'+':
+            raise ValueError('malformed record at read %d' % count)
+        if len(seq.rstrip(b'\r\n')) != len(qual.rstrip(b'\r\n')):
+            raise ValueError('sequence and quality differ in length at read %d' % count)
+        name = head[1:].split(None, 1)[0] if len(head) > 2 else b''
+        digest.update((name[:-2] if name[-2:] in (b'/1', b'/2') else name) + b'\n')
+    if not count:
+        raise ValueError('file has no reads')
+    return count, digest.hexdigest()
+
+
+def check_fasta(f):
+    '''Return the number of sequences in the open FASTA file f, and None, or
+       raise ValueError if it is not FASTA.'''
+    count = 0
+    for line in f:
+        if line[:1] == b'>':
+            count += 1
+        elif not count and line.strip():
+            raise ValueError('file does not start with a FASTA header')
+    if not count:
+        raise ValueError('file has no sequences')
+    return count, None
+
+
+def check_file(path, kind):
+    '''Read the file at path in full and check it is valid kind ('fasta' or
+       'fastq').  Returns a dict with the number of records, the digest of the
+       read names (FASTQ only), and the error if it is invalid.'''
+    try:
+        with open_input(path) as f:
+            records, names = check_fastq(f) if kind == 'fastq' else check_fasta(f)
+        return { 'records': records, 'names': names, 'error': None }
+    except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+        return { 'records': None, 'names': None, 'error': 'corrupt or truncated gzip data (%s)' % str(e) }
+    except (OSError, ValueError) as e:
+        return { 'records': None, 'names': None, 'error': str(e) }
+
+
+def validate_samples(samples, workers=None):
+    '''Check the input files of the samples, a list of (contigs, illufqs, nanofq)
+       tuples as returned by classify_inputs, using at most workers processes.
+       Returns the list of the error messages for each sample (empty if valid).'''
+
+    kinds = dict()
+    for contigs, illufqs, nanofq in samples:
+        if contigs:
+            kinds[contigs] = 'fasta'
+        for fq in illufqs + ([ nanofq ] if nanofq else []):
+            kinds[fq] = 'fastq'
+
+    paths = list(kinds)
+    with ProcessPoolExecutor(max(1, min(len(paths), workers if workers else os.cpu_count())), multiprocessing.get_context('spawn')) as pool:
+        checks = dict(zip(paths, pool.map(check_file, paths, [ kinds[p] for p in paths ])))
+
+    ret = list()
+    for contigs, illufqs, nanofq in samples:
+        errors = list()
+        for path in filter(None, [ contigs, nanofq ] + illufqs):
+            if checks[path]['error']:
+                errors.append('%s: %s' % (path, checks[path]['error']))
+
+        if len(illufqs) == 2 and not errors:
+            r1, r2 = checks[illufqs[0]], checks[illufqs[1]]
+            if r1['records'] != r2['records']:
+                errors.append('read files do not pair up: %s has %d reads, %s has %d' % (
+                    illufqs[0], r1['records'], illufqs[1], r2['records']))
+            elif r1['names'] != r2['names']:
+                errors.append('read files do not pair up: reads in %s and %s differ in name or order' % tuple(illufqs))
+
+        ret.append(errors)
+
+    return ret
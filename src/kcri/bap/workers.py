@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+#
+# kcri.bap.workers - running the backend jobs on remote worker daemons
+#
+#   For sites that have a few large machines but no batch system.  On each
+#   machine a worker daemon (BAP-worker, the main() below) connects to the
+#   BAP over TCP, registers the CPUs and memory it offers, and runs the jobs
+#   it is sent.  The WorkerScheduler in the BAP stands in for the picoline
+#   SubprocessScheduler, and places each job on the worker with the most CPUs
+#   free that it fits on.  Its max_cpu and max_mem are those of all workers
+#   together, so the FairShareScheduler shares them all between the samples.
+#
+#   The protocol is newline-delimited JSON over a single TCP connection that
+#   the worker opens.  The BAP first sends a random nonce
+#
+#       { "type": "challenge", "nonce": N1 }
+#
+#   and from then on the worker sends
+#
+#       { "type": "hello", "name": NAME, "cpu": N, "mem": GB, "nonce": N2, "mac": MAC }
+#       { "type": "started", "id": ID, "mac": MAC }
+#       { "type": "exited", "id": ID, "rc": RC, "error": MESSAGE or null, "mac": MAC }
+#
+#   and the BAP sends
+#
+#       { "type": "welcome", "mac": MAC }   or   { "type": "reject", "error": MESSAGE }
+#       { "type": "run", "id": ID, "command": CMD, "args": [ ... ], "wdir": PATH, "tim": SEC, "mac": MAC }
+#       { "type": "stop", "id": ID, "mac": MAC }
+#
+#   Each MAC is the HMAC of the message with a key derived from the secret
+#   in BAP_WORKER_SECRET and both nonces, over the sender's role and the
+#   message's sequence number (see Channel).  So each side proves that it
+#   holds the secret without sending it, and messages cannot be forged,
+#   replayed or reordered by someone who doesn't.  The BAP only accepts
+#   workers that present a valid hello, and the workers only run jobs from
+#   a BAP that sent a valid welcome.  The messages are not encrypted.
+#
+#   Jobs run in their work directory with their output in its 'stdout' and
+#   'stderr' files, as local jobs do, so the output directory must be on a
+#   filesystem shared with the workers.  Jobs on a worker whose connection
+#   is lost fail.  Without a secret both sides refuse any but loopback
+#   addresses; note that on a shared machine, other users can then still
+#   connect to the BAP, or (when it is not running) listen on its port and
+#   have the workers run commands as their user, so set a secret there too.
+#
+
+import sys, os, hmac, json, time, queue, socket, secrets, argparse, ipaddress, threading, subprocess
+from hmac import compare_digest
+from pico.jobcontrol.job import Job
+from .shims.base import UserException
+
+# Environment variable with the secret that workers must present
+SECRET_VAR = 'BAP_WORKER_SECRET'
+
+# Seconds between attempts of a worker to (re)connect
+RECONNECT = 5
+
+
+def send_message(sock, msg):
+    '''Send the dict msg as a JSON line on socket sock.'''
+    sock.sendall((json.dumps(msg) + '\n').encode())
+
+
+def is_loopback(host):
+    '''Return True if host has only loopback addresses.'''
+    try:
+        addrs = set(info[4][0].split('%')[0] for info in socket.getaddrinfo(host, None))
+        return bool(addrs) and all(ipaddress.ip_address(a).is_loopback for a in addrs)
+    except (OSError, ValueError):
+        return False
+
+
+def read_messages(sock):
+    '''Yield the dicts received as JSON lines on socket sock, until it closes.
+       Lines that do not parse are skipped.'''
+    with sock.makefile('r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(msg, dict):
+                yield msg
+
+
+### class Channel
+#
+#   One side of an authenticated worker connection, after the nonces were
+#   exchanged.  Messages are signed with a key that is derived from the secret
+#   and both nonces (so it is new for every connection), over the role of the
+#   sender (so a message cannot be reflected) and its sequence number (so it
+#   cannot be replayed or dropped).
+
+class Channel:
+    '''Signs the messages sent and verifies the messages received on a socket.'''
+
+    def __init__(self, sock, secret, role, peer_role, nonces):
+        '''Channel on sock for role, talking to peer_role, keyed on secret (may
+           be None) and the nonces of the BAP and the worker.'''
+        self.sock = sock
+        self._key = hmac.new((secret or '').encode(), ':'.join(nonces).encode(), 'sha256').digest()
+        self._role = role
+        self._peer_role = peer_role
+        self._sent = 0
+        self._received = 0
+        self._lock = threading.Lock()
+
+    def send(self, msg):
+        '''Sign and send the dict msg.  Raises OSError if the connection failed.'''
+        with self._lock:
+            send_message(self.sock, dict(msg, mac=self._mac(self._role, self._sent, msg)))
+            self._sent += 1
+
+    def verify(self, msg):
+        '''Return the received msg without its mac if it is the valid next message
+           from the peer, else None.'''
+        msg = dict(msg)
+        mac = str(msg.pop('mac', ''))
+        if not compare_digest(mac, self._mac(self._peer_role, self._received, msg)):
+            return None
+        self._received += 1
+        return msg
+
+    def _mac(self, role, seq, msg):
+        data = '%s:%d:%s' % (role, seq, json.dumps(msg, sort_keys=True))
+        return hmac.new(self._key, data.encode(), 'sha256').hexdigest()
+
+
+### class WorkerJob
+#
+#   A job that runs on a worker.  It has the attributes of a picoline Job that
+#   the shims use: name, spec, state, error, stdout, and file_path().
+
+class WorkerJob:
+    '''Job that runs on a remote worker.'''
+
+    def __init__(self, name, spec, wdir, job_id):
+        self.name = name
+        self.spec = spec
+        self.state = Job.State.QUEUED
+        self.error = None
+        self.stdout = os.path.join(wdir, 'stdout')
+        self.stderr = os.path.join(wdir, 'stderr')
+        self.worker = None
+        self._id = job_id
+        self._wdir = wdir
+
+    def file_path(self, fname):
+        '''Return the path to fname in the job's work directory.'''
+        return os.path.join(self._wdir, fname)
+
+
+### class Worker
+#
+#   The BAP's record of a connected worker and the jobs it runs.
+
+class Worker:
+    '''A registered worker, as seen by the WorkerScheduler.'''
+
+    def __init__(self, channel, name, cpu, mem):
+        self.channel = channel
+        self.sock = channel.sock
+        self.name = name
+        self.cpu = cpu
+        self.mem = mem
+        self.jobs = dict()      # id -> WorkerJob
+
+    def free(self):
+        '''Return the (cpu, mem) not taken by the jobs on the worker.'''
+        return (self.cpu - sum(j.spec.cpu for j in self.jobs.values()),
+                self.mem - sum(j.spec.mem for j in self.jobs.values()))
+
+    def takes(self, spec):
+        '''Return True if a job with spec fits in what is free, or is too big
+           for the worker but it is idle.'''
+        cpu, mem = self.free()
+        if spec.cpu <= cpu and spec.mem <= mem:
+            return True
+        return not self.jobs and (spec.cpu > self.cpu or spec.mem > self.mem)
+
+
+### class WorkerScheduler
+#
+#   Accepts worker connections on a TCP address, and places the jobs scheduled
+#   on it on the workers.  Jobs that fit on no worker wait until one has room.
+#   The accept and connection threads only put what they receive on a queue;
+#   it is handled in listen(), so that all state is kept on the caller's thread.
+
+class WorkerScheduler:
+    '''Scheduler that runs jobs on the worker daemons that connect to it.'''
+
+    # Jobs run on other hosts, which share only the output directory with us
+    remote = True
+
+    def __init__(self, address, poll=5, secret=None):
+        '''Listen for workers on address, a (host, port) tuple, and have listen()
+           wait at most poll seconds.  Workers must prove they hold secret, which
+           is required unless address is a loopback address.  Raises UserException
+           if there is no secret when required, or address cannot be listened on.'''
+        if not secret and not is_loopback(address[0]):
+            raise UserException("a secret must be set in %s to listen for workers on %s", SECRET_VAR, address[0])
+        try:
+            self._server = socket.create_server(address)
+        except OSError as e:
+            raise UserException("cannot listen for workers on %s:%s: %s", address[0], address[1], str(e))
+
+        self.address = self._server.getsockname()[:2]
+        self._poll = poll
+        self._secret = secret
+        self._events = queue.Queue()    # (socket, message or None when closed)
+        self._workers = dict()          # socket -> Worker
+        self._nonces = dict()           # socket -> our nonce, until its hello
+        self._pending = list()          # WorkerJobs waiting for a worker
+        self._count = 0
+
+        threading.Thread(target=self._accept, name='BAP-workers', daemon=True).start()
+
+    @property
+    def max_cpu(self):
+        return max(1, sum(w.cpu for w in self._workers.values()))
+
+    @property
+    def max_mem(self):
+        return max(1, sum(w.mem for w in self._workers.values()))
+
+    def wait_for_workers(self, count=1, timeout=None):
+        '''Handle worker registrations until at least count workers are connected,
+           or timeout seconds have passed.  Returns the number connected.'''
+        end = time.time() + timeout if timeout is not None else None
+        while len(self._workers) < count and (end is None or time.time() < end):
+            self._handle_events(min(self._poll, end - time.time()) if end else self._poll)
+        return len(self._workers)
+
+    def schedule_job(self, name, spec, wdir):
+        '''Schedule the job to run in wdir on a worker, returns a WorkerJob.'''
+
+        wdir = os.path.abspath(wdir if wdir else name)
+        os.makedirs(wdir, exist_ok=True)
+
+        self._count += 1
+        job = WorkerJob(name, spec, wdir, '%d' % self._count)
+        self._pending.append(job)
+        self._place_jobs()
+        return job
+
+    def listen(self):
+        '''Wait at most poll seconds for messages from the workers, handle them
+           and place the jobs that are waiting.'''
+        self._handle_events(self._poll)
+        self._place_jobs()
+
+    def stop_job(self, job):
+        '''Stop the job: drop it if it waits for a worker, else have its worker
+           kill it.  It FAILs when it has ended.'''
+        if job in self._pending:
+            self._pending.remove(job)
+            job.state, job.error = Job.State.FAILED, 'cancelled before it started'
+        elif job.worker and job.worker.sock in self._workers:
+            self._send(job.worker, { 'type': 'stop', 'id': job._id })
+
+    def _accept(self):
+        '''Accept worker connections forever, challenge each, and start a reader
+           thread for it.'''
+        while True:
+            sock, _ = self._server.accept()
+            self._nonces[sock] = secrets.token_hex(16)
+            try:
+                send_message(sock, { 'type': 'challenge', 'nonce': self._nonces[sock] })
+            except OSError:
+                pass    # the reader sees the connection is gone
+            threading.Thread(target=self._read, args=(sock,), name='BAP-worker-conn', daemon=True).start()
+
+    def _read(self, sock):
+        '''Put the messages received on sock on the event queue, then None.'''
+        try:
+            for msg in read_messages(sock):
+                self._events.put((sock, msg))
+        except OSError:
+            pass
+        self._events.put((sock, None))
+
+    def _handle_events(self, timeout):
+        '''Handle the events that come in within timeout seconds, or right away.'''
+        try:
+            self._handle(*self._events.get(timeout=max(0, timeout)))
+            while True:
+                self._handle(*self._events.get_nowait())
+        except queue.Empty:
+            pass
+
+    def _handle(self, sock, msg):
+        '''Handle msg from the worker on sock, or its disconnection if msg is None.'''
+
+        worker = self._workers.get(sock)
+
+        if msg is None:
+            self._nonces.pop(sock, None)
+            if worker:
+                del self._workers[sock]
+                print('BAP: worker %s left' % worker.name, file=sys.stderr)
+                for job in worker.jobs.values():
+                    job.state, job.error = Job.State.FAILED, 'lost connection to worker %s' % worker.name
+            sock.close()
+
+        elif not worker:
+            nonce = self._nonces.pop(sock, None)
+            if msg.get('type') != 'hello' or not nonce:
+                self._reject(sock, 'expected hello')
+                return
+            channel = Channel(sock, self._secret, 'bap', 'worker', (nonce, str(msg.get('nonce', ''))))
+            msg = channel.verify(msg)
+            if msg is None:
+                self._reject(sock, 'authentication failed (is %s the same on both sides?)' % SECRET_VAR)
+                return
+            try:
+                worker = Worker(channel, str(msg.get('name', 'worker')), float(msg['cpu']), float(msg['mem']))
+            except (KeyError, TypeError, ValueError):
+                self._reject(sock, 'invalid hello')
+                return
+            self._workers[sock] = worker
+            self._send(worker, { 'type': 'welcome' })
+            print('BAP: worker %s joined with %g CPUs and %g GB' % (worker.name, worker.cpu, worker.mem), file=sys.stderr)
+
+        else:
+            msg = worker.channel.verify(msg)
+            if msg is None:
+                print('BAP: dropping worker %s: message failed authentication' % worker.name, file=sys.stderr)
+                self._drop(worker)
+                return
+            job = worker.jobs.get(str(msg.get('id')))
+            if not job:
+                return
+            if msg.get('type') == 'started':
+                job.state = Job.State.RUNNING
+            elif msg.get('type') == 'exited':
+                del worker.jobs[job._id]
+                rc = msg.get('rc')
+                job.state = Job.State.COMPLETED if rc == 0 and not msg.get('error') else Job.State.FAILED
+                job.error = msg.get('error') or ('backend exited with code %s' % rc if rc != 0 else None)
+
+    def _place_jobs(self):
+        '''Send the waiting jobs, in order, to the worker with the most CPUs free
+           that takes them.'''
+        for job in list(self._pending):
+            workers = list(filter(lambda w: w.takes(job.spec), self._workers.values()))
+            if not workers:
+                continue
+            worker = max(workers, key=lambda w: w.free()[0])
+            self._pending.remove(job)
+            job.worker = worker
+            worker.jobs[job._id] = job
+            self._send(worker, { 'type': 'run', 'id': job._id, 'command': job.spec.command,
+                'args': list(map(str, job.spec.args)), 'wdir': job.file_path(''), 'tim': job.spec.tim })
+
+    def _send(self, worker, msg):
+        '''Send msg to worker.  If this fails, its reader thread reports it gone.'''
+        try:
+            worker.channel.send(msg)
+        except OSError:
+            self._drop(worker)
+
+    def _drop(self, worker):
+        '''Shut down the connection to worker; its reader thread reports it gone.'''
+        try:
+            worker.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _reject(self, sock, error):
+        try:
+            send_message(sock, { 'type': 'reject', 'error': error })
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+### class WorkerDaemon
+#
+#   The worker side: connects to the BAP, and runs the jobs it sends, each on
+#   a thread that waits for the job to end (or kills it when out of time) and
+#   reports its exit code.  When the connection is lost, or the BAP fails to
+#   authenticate, its jobs are killed (the BAP has failed them) and it
+#   connects again.
+
+class WorkerDaemon:
+    '''Worker that runs the jobs a BAP sends it.'''
+
+    def __init__(self, address, name, cpu, mem, secret=None):
+        '''Worker for the BAP at address, offering cpu and mem, and requiring it
+           to hold secret, which is required unless address is a loopback address.
+           Raises UserException if there is no secret when required.'''
+        if not secret and not is_loopback(address[0]):
+            raise UserException("a secret must be set in %s to work for a BAP on %s", SECRET_VAR, address[0])
+        self._address = address
+        self._secret = secret
+        self._hello = { 'type': 'hello', 'name': name, 'cpu': cpu, 'mem': mem }
+        self._procs = dict()    # id -> Popen
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        '''Connect to the BAP and run its jobs, reconnecting when disconnected.
+           Raises UserException if the BAP rejects us.'''
+        while True:
+            try:
+                sock = socket.create_connection(self._address)
+            except OSError:
+                time.sleep(RECONNECT)
+                continue
+
+            try:
+                self._serve(sock)
+            except OSError:
+                pass
+            finally:
+                sock.close()
+                self._kill_all()
+
+            print('BAP-worker: lost connection to %s:%s' % self._address, file=sys.stderr)
+            time.sleep(RECONNECT)
+
+    def _serve(self, sock):
+        '''Answer the BAP's challenge on sock, then handle its messages until it
+           closes or a message fails authentication.'''
+
+        messages = read_messages(sock)
+        challenge = next(messages, {})
+        if challenge.get('type') != 'challenge':
+            return
+
+        nonce = secrets.token_hex(16)
+        channel = Channel(sock, self._secret, 'worker', 'bap', (str(challenge.get('nonce', '')), nonce))
+        channel.send(dict(self._hello, nonce=nonce))
+
+        welcomed = False
+        for msg in messages:
+            if msg.get('type') == 'reject' and not welcomed:
+                raise UserException("rejected by BAP: %s", msg.get('error'))
+
+            msg = channel.verify(msg)
+            if msg is None:
+                print('BAP-worker: message from %s:%s failed authentication (is %s the same on both sides?)'
+                        % (self._address + (SECRET_VAR,)), file=sys.stderr)
+                return
+
+            kind = msg.get('type')
+            if kind == 'welcome':
+                welcomed = True
+                print('BAP-worker: connected to %s:%s' % self._address, file=sys.stderr)
+            elif not welcomed:
+                return
+            elif kind == 'run':
+                threading.Thread(target=self._run, args=(channel, msg), daemon=True).start()
+            elif kind == 'stop':
+                with self._lock:
+                    proc = self._procs.get(msg.get('id'))
+                if proc:
+                    proc.terminate()
+
+    def _run(self, channel, msg):
+        '''Run the job in msg, and report its start and exit on channel.'''
+
+        job_id, wdir, tim = msg['id'], msg['wdir'], msg.get('tim')
+        error = None
+        try:
+            with open(os.path.join(wdir, 'stdout'), 'w') as out, open(os.path.join(wdir, 'stderr'), 'w') as err:
+                proc = subprocess.Popen([ msg['command'] ] + msg['args'], cwd=wdir, stdout=out, stderr=err)
+        except OSError as e:
+            self._report(channel, { 'type': 'exited', 'id': job_id, 'rc': 127, 'error': 'cannot run %s: %s' % (msg['command'], str(e)) })
+            return
+
+        with self._lock:
+            self._procs[job_id] = proc
+        self._report(channel, { 'type': 'started', 'id': job_id })
+
+        try:
+            rc = proc.wait(tim if tim else None)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            rc = proc.wait()
+            error = 'backend exceeded its run time of %s seconds' % tim
+
+        with self._lock:
+            self._procs.pop(job_id, None)
+        self._report(channel, { 'type': 'exited', 'id': job_id, 'rc': rc, 'error': error })
+
+    def _report(self, channel, msg):
+        try:
+            channel.send(msg)
+        except OSError:
+            pass    # the reader sees the connection is gone
+
+    def _kill_all(self):
+        with self._lock:
+            for proc in self._procs.values():
+                proc.kill()
+            self._procs.clear()
+
+
+def parse_address(text, default_host='localhost'):
+    '''Return the (host, port) tuple for text of the form [HOST:]PORT, or raise
+       UserException if it is invalid.'''
+    host, _, port = text.rpartition(':')
+    if not port.isdigit():
+        raise UserException("invalid address, must be [HOST:]PORT: %s", text)
+    return (host if host else default_host, int(port))
+
+
+def main():
+    '''Run a worker daemon for the BAP at the address on the command line.'''
+
+    parser = argparse.ArgumentParser(description="""\
+Worker daemon for the KCRI CGE Bacterial Analysis Pipeline (BAP).  Connects
+to a BAP that was started with --workers [HOST:]PORT, and runs the jobs it
+sends, in their work directories on the filesystem shared with the BAP.
+Both sides must have the same secret in the environment as %s, which
+is required unless the BAP is on localhost.
+""" % SECRET_VAR)
+    parser.add_argument('--cpus', metavar='N', type=float, default=os.cpu_count(), help="number of CPUs to offer (default: all)")
+    parser.add_argument('--mem', metavar='GB', type=float, default=os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30, help="memory to offer (default: all)")
+    parser.add_argument('--name', metavar='NAME', default=socket.gethostname(), help="name to report to the BAP (default: host name)")
+    parser.add_argument('address', metavar='[HOST:]PORT', help="address of the BAP to connect to")
+    args = parser.parse_args()
+
+    try:
+        WorkerDaemon(parse_address(args.address), args.name, args.cpus, args.mem, os.environ.get(SECRET_VAR)).serve_forever()
+    except UserException as e:
+        print('BAP-worker: %s' % str(e), file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
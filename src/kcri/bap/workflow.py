@@ -34,10 +34,14 @@ class Params(pico.workflow.logic.Params):
     CONTIGS = 'contigs'     # Signals that user has provided contigs
     SPECIES = 'species'     # Signals that user has specified the species
     PLASMIDS = 'plasmids'   # Signals that user has specified the plasmids
+    MAXDEPTH = 'maxdepth'   # Signals that user wants reads downsampled to a maximum depth
+    STAGING = 'staging'     # Signals that user wants the reads decompressed to a stage dir
 
 class Checkpoints(pico.workflow.logic.Checkpoints):
     '''Internal targets for other targets to depend on.  Useful when a service
        takes an input that could come either from user or as a service output.'''
+    ILLUREADS = 'illumina'  # Illumina reads are available, downsampled and staged if requested
+    NANOREADS = 'nanopore'  # Nanopore reads are available, staged if requested
     CONTIGS = 'contigs'     # Contigs are available either as inputs or from assembly
     SPECIES = 'species'     # Species is known, either from user input or a service
     PLASMIDS = 'plasmids'   # Plasmids are known, either from user input or a service
@@ -48,6 +52,8 @@ class Services(pico.workflow.logic.Services):
        and invokes the actual backend.'''
     CONTIGSMETRICS = 'ContigsMetrics'
     READSMETRICS = 'ReadsMetrics'
+    DOWNSAMPLER = 'Downsampler'
+    STAGER = 'Stager'
     SKESA = 'SKESA'
     FLYE = 'Flye'
     GFACONNECTOR = 'GFAConnector'
@@ -119,23 +125,30 @@ DEPENDENCIES = {
                                      OPT(UserTargets.REFERENCE), OPT(UserTargets.CGMLST) ),
 
     Services.CONTIGSMETRICS:    OIF( Checkpoints.CONTIGS ),
-    Services.READSMETRICS:      OIF( ONE( Params.ILLUREADS, Params.NANOREADS ) ),
-    Services.SKESA:             Params.ILLUREADS,
-    Services.FLYE:              Params.NANOREADS,
-    Services.GFACONNECTOR:      ALL( Params.ILLUREADS, Checkpoints.CONTIGS ),
-    Services.KMERFINDER:        FST( Params.ILLUREADS, Checkpoints.CONTIGS, Params.NANOREADS ),
+    # Reads the staged reads only if these are not the downsampled ones
+    Services.READSMETRICS:      ALL( OIF( ONE( Params.ILLUREADS, Params.NANOREADS ) ), ONE( Params.MAXDEPTH, OPT( Services.STAGER ) ) ),
+    Services.DOWNSAMPLER:       ALL( Params.ILLUREADS, Params.MAXDEPTH ),
+    Services.STAGER:            ALL( Params.STAGING, ONE( Params.ILLUREADS, Params.NANOREADS ), OPT( Services.DOWNSAMPLER ) ),
+    Services.SKESA:             Checkpoints.ILLUREADS,
+    Services.FLYE:              Checkpoints.NANOREADS,
+    Services.GFACONNECTOR:      ALL( Checkpoints.ILLUREADS, Checkpoints.CONTIGS ),
+    Services.KMERFINDER:        FST( Checkpoints.ILLUREADS, Checkpoints.CONTIGS, Checkpoints.NANOREADS ),
     Services.GETREFERENCE:      OIF( Services.KMERFINDER ),  # Later: also work if species given and no KmerFinder
-    Services.MLSTFINDER:        ALL( Checkpoints.SPECIES, ONE( Params.ILLUREADS, Checkpoints.CONTIGS ) ),
+    Services.MLSTFINDER:        ALL( Checkpoints.SPECIES, ONE( Checkpoints.ILLUREADS, Checkpoints.CONTIGS ) ),
     Services.KCST:              Checkpoints.CONTIGS,
-    Services.RESFINDER:         FST( Params.ILLUREADS, Checkpoints.CONTIGS, Params.NANOREADS ),
-    Services.DISINFINDER:       FST( Params.ILLUREADS, Checkpoints.CONTIGS, Params.NANOREADS ),
-    Services.POINTFINDER:       ALL( Checkpoints.SPECIES, FST( Params.ILLUREADS, Checkpoints.CONTIGS, Params.NANOREADS ) ),
-    Services.VIRULENCEFINDER:   ALL( OPT( UserTargets.SPECIES ), FST( Params.ILLUREADS, Checkpoints.CONTIGS, Params.NANOREADS ) ),
-    Services.PLASMIDFINDER:     ONE( Params.ILLUREADS, Checkpoints.CONTIGS ),
-    Services.PMLSTFINDER:       ALL( Checkpoints.PLASMIDS, ONE( Params.ILLUREADS, Checkpoints.CONTIGS ) ),
-    Services.CGMLSTFINDER:      ALL( Checkpoints.SPECIES, ONE( Params.ILLUREADS, Checkpoints.CONTIGS ) ),
-    Services.CHOLERAEFINDER:    ALL( Checkpoints.SPECIES, ONE( Params.ILLUREADS, Checkpoints.CONTIGS ) ),
-
+    Services.RESFINDER:         FST( Checkpoints.ILLUREADS, Checkpoints.CONTIGS, Checkpoints.NANOREADS ),
+    Services.DISINFINDER:       FST( Checkpoints.ILLUREADS, Checkpoints.CONTIGS, Checkpoints.NANOREADS ),
+    Services.POINTFINDER:       ALL( Checkpoints.SPECIES, FST( Checkpoints.ILLUREADS, Checkpoints.CONTIGS, Checkpoints.NANOREADS ) ),
+    Services.VIRULENCEFINDER:   ALL( OPT( UserTargets.SPECIES ), FST( Checkpoints.ILLUREADS, Checkpoints.CONTIGS, Checkpoints.NANOREADS ) ),
+    Services.PLASMIDFINDER:     ONE( Checkpoints.ILLUREADS, Checkpoints.CONTIGS ),
+    Services.PMLSTFINDER:       ALL( Checkpoints.PLASMIDS, ONE( Checkpoints.ILLUREADS, Checkpoints.CONTIGS ) ),
+    Services.CGMLSTFINDER:      ALL( Checkpoints.SPECIES, ONE( Checkpoints.ILLUREADS, Checkpoints.CONTIGS ) ),
+    Services.CHOLERAEFINDER:    ALL( Checkpoints.SPECIES, ONE( Checkpoints.ILLUREADS, Checkpoints.CONTIGS ) ),
+
+    # Succeed right away unless Downsampler or Stager can run, else when these
+    # have ended; if they failed, the services read the original reads
+    Checkpoints.ILLUREADS:      ALL( Params.ILLUREADS, OPT( Services.DOWNSAMPLER ), OPT( Services.STAGER ) ),
+    Checkpoints.NANOREADS:      ALL( Params.NANOREADS, OPT( Services.STAGER ) ),
     Checkpoints.CONTIGS:        ONE( Params.CONTIGS, Services.SKESA, Services.FLYE ),
     Checkpoints.SPECIES:        ONE( Params.SPECIES, Services.KMERFINDER, Services.KCST ),
     Checkpoints.PLASMIDS:       ONE( Params.PLASMIDS, Services.PLASMIDFINDER ),
@@ -151,6 +164,134 @@ for t in [ Checkpoints, Services, UserTargets ]:
         assert DEPENDENCIES.get(v), "No dependency is defined for %s" % v
 
 
+### Priorities
+#
+#   When there are more runnable services than cores, the ones that others
+#   wait on should go first: KmerFinder, which the species-dependent services
+#   need, should not queue behind ReadsMetrics or DisinFinder.  We rank each
+#   service by the length of the longest chain of services that depend on it
+#   (its remaining critical path), and then by the number of services that
+#   depend on it (its fan-out), in SERVICE_PRIORITIES.
+
+def _references(clause):
+    '''Return the set of targets (enum members) that clause refers to.'''
+    if isinstance(clause, (Params, Checkpoints, Services, UserTargets)):
+        return { clause }
+    elif isinstance(clause, (list, tuple, set)):
+        return set().union(*map(_references, clause))
+    elif hasattr(clause, '__dict__'):
+        return _references(list(vars(clause).values()))
+    return set()
+
+def _service_dependencies(target, seen=None):
+    '''Return the set of services that target depends on directly, that is
+       not through another service, but possibly through checkpoints.'''
+    seen = seen if seen is not None else set()
+    deps = set()
+    for ref in _references(DEPENDENCIES.get(target)) - seen:
+        seen.add(ref)
+        if isinstance(ref, Services):
+            deps.add(ref)
+        else:
+            deps |= _service_dependencies(ref, seen)
+    return deps
+
+def _priorities():
+    '''Return dict of service to its (critical path length, fan-out) priority.'''
+
+    dependants = dict((s, set()) for s in Services)
+    for s in Services:
+        for d in _service_dependencies(s) - { s }:
+            dependants[d].add(s)
+
+    def downstream(s, path):
+        '''Return the longest path length below s, and all services below s.'''
+        length, below = 0, set()
+        for d in dependants[s] - path:
+            l, b = downstream(d, path | { d })
+            length, below = max(length, l + 1), below | b | { d }
+        return length, below
+
+    return dict((s, (lambda l, b: (l, len(b)))(*downstream(s, { s }))) for s in Services)
+
+SERVICE_PRIORITIES = _priorities()
+
+
+### Alternatives
+#
+#   A service that is one of the alternatives in a ONE or FST clause is no
+#   longer needed there once another alternative has completed, e.g. KCST in
+#   ONE( MLSTFINDER, KCST ) after MLSTFinder completed.  SERVICE_ALTERNATIVES
+#   maps each service that only ever appears as such an alternative in the
+#   DEPENDENCIES above to the lists of its alternative services, one for each
+#   clause it appears in.  Keep it in step with DEPENDENCIES: a service that
+#   is needed regardless in any clause must not be in it.  See is_superfluous.
+
+SERVICE_ALTERNATIVES = {
+    # UserTargets.ASSEMBLY, Checkpoints.CONTIGS
+    Services.SKESA:             [ [ Services.FLYE ] ],
+    # UserTargets.ASSEMBLY, Checkpoints.CONTIGS; UserTargets.GRAPH
+    Services.FLYE:              [ [ Services.SKESA ], [ Services.GFACONNECTOR ] ],
+    # UserTargets.GRAPH
+    Services.GFACONNECTOR:      [ [ Services.FLYE ] ],
+    # UserTargets.MLST
+    Services.MLSTFINDER:        [ [ Services.KCST ] ],
+    # UserTargets.MLST; Checkpoints.SPECIES
+    Services.KCST:              [ [ Services.MLSTFINDER ], [ Services.KMERFINDER ] ],
+}
+
+# Consistency check on the SERVICE_ALTERNATIVES definitions
+
+for s, alternatives in SERVICE_ALTERNATIVES.items():
+    for alts in alternatives:
+        assert alts and s not in alts and all(isinstance(a, Services) for a in alts), "Invalid alternatives for %s" % s
+
+def is_superfluous(service, completed):
+    '''Return True if service is in SERVICE_ALTERNATIVES, and for each of its
+       lists of alternatives, one of these is in completed.'''
+    alternatives = SERVICE_ALTERNATIVES.get(service)
+    return bool(alternatives) and all(any(a in completed for a in alts) for alts in alternatives)
+
+
+### Reads in use
+#
+#   The staged reads (see kcri.bap.staging) can go once no service that reads
+#   them can still run.  READ_CONSUMERS are the services that depend on the
+#   reads (not through another service), and READ_SUPPLIERS the services that
+#   those may wait on, and so may still make one of them runnable.
+
+def _param_dependencies(target, seen=None):
+    '''Return the set of params that target depends on directly, that is
+       not through a service, but possibly through checkpoints.'''
+    seen = seen if seen is not None else set()
+    deps = set()
+    for ref in _references(DEPENDENCIES.get(target)) - seen:
+        seen.add(ref)
+        if isinstance(ref, Params):
+            deps.add(ref)
+        elif not isinstance(ref, Services):
+            deps |= _param_dependencies(ref, seen)
+    return deps
+
+def _suppliers(services):
+    '''Return the set of services that any of services depends on, transitively.'''
+    todo, ret = set(services), set()
+    while todo:
+        deps = _service_dependencies(todo.pop()) - ret
+        ret |= deps
+        todo |= deps
+    return ret
+
+READ_CONSUMERS = set(filter(lambda s: _param_dependencies(s) & { Params.ILLUREADS, Params.NANOREADS }, Services))
+READ_SUPPLIERS = _suppliers(READ_CONSUMERS)
+
+def reads_in_use(started, runnable):
+    '''Return True if any service in started or runnable reads the reads, or
+       might yet make a service runnable that does.'''
+    return any(s in READ_CONSUMERS for s in runnable) or \
+           any(s in READ_CONSUMERS or s in READ_SUPPLIERS for s in started)
+
+
 ### Main 
 #
 #   The main() entry point for 'dry testing' the workflow defined above.
@@ -29,7 +29,7 @@ setup(
     python_requires = REQUIRES_PYTHON,
     url = URL,
     packages = find_packages(exclude=["tests"]),
-    entry_points={ 'console_scripts': [ 'BAP = kcri.bap.BAP:main' ] },
+    entry_points={ 'console_scripts': [ 'BAP = kcri.bap.BAP:main', 'BAP-worker = kcri.bap.workers:main' ] },
     install_requires = REQUIRED,
     extras_require = EXTRAS,
     include_package_data = True,
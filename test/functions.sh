@@ -9,6 +9,15 @@ run_bap() {
         tee -a "${OUTPUT_DIR:-$PWD}/run-bap.err"
 }
 
+# Runs "$@" in the container, with this directory as its /workdir, so that it
+# sees OUTPUT_DIR as $CONTAINER_OUT, and the backend stubs in /workdir/stubs
+run_in_container() {
+
+    BAP_WORK_DIR="$BASE_DIR" "$(realpath -e "$BASE_DIR/../bin/bap-container-run")" "$@" \
+        2>&1 > "${OUTPUT_DIR:-$PWD}/run-bap.out" |
+        tee -a "${OUTPUT_DIR:-$PWD}/run-bap.err"
+}
+
 make_output_dir() {
 
     export OUTPUT_DIR="$BASE_DIR/output/$BASE_NAME-$(date '+%Y%m%d%H%M%S')"
@@ -20,14 +29,17 @@ make_output_dir() {
         mv -f "$BASE_DIR/output/latest" "$BASE_DIR/output/previous"
 
     ln -rsfT "$OUTPUT_DIR" "$BASE_DIR/output/latest"
+
+    export CONTAINER_OUT="/workdir/output/$(basename "$OUTPUT_DIR")"
 }
 
+# Compares output file $1 (default bap-summary.tsv) to the one in expect
 check_output() {
 
     cd "$BASE_DIR"
 
-    REF_OUT="expect/$BASE_NAME/bap-summary.tsv"
-    RUN_OUT="output/latest/bap-summary.tsv"
+    REF_OUT="expect/$BASE_NAME/${1:-bap-summary.tsv}"
+    RUN_OUT="output/latest/${1:-bap-summary.tsv}"
 
     if diff "$REF_OUT" "$RUN_OUT"; then
         printf "[OK] Run output matches expected output ($BASE_NAME)\n\n"
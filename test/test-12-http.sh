@@ -0,0 +1,21 @@
+#!/bin/sh
+
+LC_ALL="C"
+
+BASE_NAME="$(basename "$0" .sh)"
+BASE_DIR="$(realpath "$(dirname "$0")")"
+
+export BAP_DB_DIR="$BASE_DIR/databases"
+
+. "$BASE_DIR/functions.sh"
+
+# Serves HTTP and submits the test-03 run, with stub backends
+make_output_dir
+run_in_container sh -c '
+    export PATH="/workdir/stubs:$PATH"
+    BAP -v --serve-http 8642 -o "$1" & BAP_PID=$!
+    bap-submit http://localhost:8642 "$1" test /workdir/data/test.fa.gz targets=metrics
+    RC=$?
+    kill $BAP_PID
+    exit $RC' sh "$CONTAINER_OUT"
+check_output
@@ -0,0 +1,17 @@
+#!/bin/sh
+
+LC_ALL="C"
+
+BASE_NAME="$(basename "$0" .sh)"
+BASE_DIR="$(realpath "$(dirname "$0")")"
+
+export BAP_DB_DIR="$BASE_DIR/databases"
+
+. "$BASE_DIR/functions.sh"
+
+# Runs test-03 with --slurm, on the fake sbatch, squeue and scancel in stubs
+make_output_dir
+run_in_container sh -c '
+    export PATH="/workdir/stubs:$PATH" FAKE_SLURM_DIR="/tmp/fake-slurm"
+    BAP -v --slurm --poll 1 -t metrics -o "$1" /workdir/data/test.fa.gz' sh "$CONTAINER_OUT"
+check_output
@@ -0,0 +1,22 @@
+#!/bin/sh
+
+LC_ALL="C"
+
+BASE_NAME="$(basename "$0" .sh)"
+BASE_DIR="$(realpath "$(dirname "$0")")"
+
+export BAP_DB_DIR="$BASE_DIR/databases"
+
+. "$BASE_DIR/functions.sh"
+
+# Runs test-03 with --workers, on two BAP-worker daemons on localhost
+make_output_dir
+run_in_container sh -c '
+    export PATH="/workdir/stubs:$PATH" BAP_WORKER_SECRET="test-14"
+    BAP-worker --cpus 2 --mem 4 --name worker-1 7071 & W1=$!
+    BAP-worker --cpus 2 --mem 4 --name worker-2 7071 & W2=$!
+    BAP -v --workers 7071 --min-workers 2 --poll 1 -t metrics -o "$1" /workdir/data/test.fa.gz
+    RC=$?
+    kill $W1 $W2
+    exit $RC' sh "$CONTAINER_OUT"
+check_output
@@ -0,0 +1,28 @@
+#!/bin/sh
+
+LC_ALL="C"
+
+BASE_NAME="$(basename "$0" .sh)"
+BASE_DIR="$(realpath "$(dirname "$0")")"
+
+export BAP_DB_DIR="$BASE_DIR/databases"
+
+. "$BASE_DIR/functions.sh"
+
+# Interrupts a --max-depth run once SKESA runs on the downsampled reads, and
+# resumes it: the rerun SKESA must get the downsampled reads again, not the
+# originals, which reads.tsv records (as paths relative to the output dir)
+make_output_dir
+run_in_container sh -c '
+    export PATH="/workdir/stubs:$PATH"
+    OUT="$1"; shift
+    set -- -v --max-depth 5 -t metrics,assembly -x ReadsMetrics -o "$OUT" /workdir/data/reads_1.fq.gz /workdir/data/reads_2.fq.gz
+    SKESA_SLEEP=600 setsid BAP "$@" & BAP_PID=$!
+    until [ "$(bap-json "$OUT/bap-checkpoint.json" services/SKESA/run_info/status)" = STARTED ]; do sleep 1; done
+    kill -- -$BAP_PID; wait
+    BAP --resume "$@" || exit 1
+    { printf "resumed\t%s\n" "$(bap-json "$OUT/bap-results.json" bap/run_info/resumed | paste -sd " ")"
+      for F in $(bap-json "$OUT/bap-results.json" services/SKESA/run_info/job/args | sed -n "/^--reads$/{n;p}" | tr "," " "); do
+          printf "SKESA\t%s\n" "$(realpath --relative-to="$OUT" "$F")"
+      done; } >"$OUT/reads.tsv"' sh "$CONTAINER_OUT"
+check_output && check_output reads.tsv
@@ -0,0 +1,41 @@
+#!/bin/sh
+
+LC_ALL="C"
+
+BASE_NAME="$(basename "$0" .sh)"
+BASE_DIR="$(realpath "$(dirname "$0")")"
+
+export BAP_DB_DIR="$BASE_DIR/databases"
+
+. "$BASE_DIR/functions.sh"
+
+# Runs the downsample module on data/reads_* in a number of ways, each in its
+# own directory, and writes the counts it reports, the reads it kept, whether
+# the mates still pair up, and whether the sample depends on just the seed, to
+# downsample.tsv
+make_output_dir
+run_in_container sh -c '
+    export PATH="/workdir/stubs:$PATH"
+    cd "$1" || exit 1
+    R1=/workdir/data/reads_1.fq.gz R2=/workdir/data/reads_2.fq.gz
+    ds() { mkdir "$1" && cd "$1" && shift && python3 -m kcri.bap.downsample "$@" >report.json; RC=$?; cd ..; return $RC; }
+    ds estimate 5 $R1 $R2 && ds again 5 $R1 $R2 && ds seed -s 7 5 $R1 $R2 &&
+    ds size -g 50000 5 $R1 $R2 && ds single 5 $R1 && ds shallow 100 $R1 $R2 || exit 1
+    names() { [ -f "$1" ] && gzip -dc "$1" | awk "NR % 4 == 1 { print \$1 }"; }
+    reads() { gzip -dc "$1" 2>/dev/null | md5sum | cut -c1-32; }
+    { printf "case\treads\tbases\tgenome_size\tdepth\tdownsampled\tkept_reads\tkept_bases\tout_reads\tmates\n"
+      for D in estimate again seed size single shallow; do
+          printf "%s" $D
+          for K in reads bases genome_size depth downsampled kept_reads kept_bases; do
+              printf "\t%s" "$(bap-json $D/report.json $K)"
+          done
+          if [ ! -f $D/reads_2.fq.gz ]; then MATES="-"
+          elif [ "$(names $D/reads_1.fq.gz)" = "$(names $D/reads_2.fq.gz)" ]; then MATES="paired"
+          else MATES="unpaired"; fi
+          printf "\t%d\t%s\n" "$(names $D/reads_1.fq.gz | wc -l)" $MATES
+      done
+      [ "$(reads estimate/reads_1.fq.gz)" = "$(reads again/reads_1.fq.gz)" ] && SAME="same" || SAME="differ"
+      [ "$(reads estimate/reads_1.fq.gz)" = "$(reads seed/reads_1.fq.gz)" ] && OTHER="same" || OTHER="differ"
+      printf "same seed\t%s\nother seed\t%s\n" $SAME $OTHER
+    } >downsample.tsv' sh "$CONTAINER_OUT"
+check_output downsample.tsv
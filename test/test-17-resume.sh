@@ -0,0 +1,30 @@
+#!/bin/sh
+
+LC_ALL="C"
+
+BASE_NAME="$(basename "$0" .sh)"
+BASE_DIR="$(realpath "$(dirname "$0")")"
+
+export BAP_DB_DIR="$BASE_DIR/databases"
+
+. "$BASE_DIR/functions.sh"
+
+# Interrupts an assembly run once SKESA has completed and ContigsMetrics runs,
+# tries to resume it with other targets, which must be refused, and resumes it
+# as it was: only SKESA is resumed, and the checkpoint is gone when done, which
+# resume.tsv records
+make_output_dir
+run_in_container sh -c '
+    export PATH="/workdir/stubs:$PATH"
+    OUT="$1"; shift
+    set -- -v -t metrics,assembly -x ReadsMetrics -o "$OUT" /workdir/data/reads_1.fq.gz /workdir/data/reads_2.fq.gz
+    UF_STATS_SLEEP=600 setsid BAP "$@" & BAP_PID=$!
+    until [ "$(bap-json "$OUT/bap-checkpoint.json" services/ContigsMetrics/run_info/status)" = STARTED ]; do sleep 1; done
+    kill -- -$BAP_PID; wait
+    BAP --resume "$@" -t metrics && OTHER="accepted" || OTHER="refused"
+    BAP --resume "$@" || exit 1
+    { printf "other targets\t%s\n" $OTHER
+      printf "resumed\t%s\n" "$(bap-json "$OUT/bap-results.json" bap/run_info/resumed | paste -sd " ")"
+      [ -e "$OUT/bap-checkpoint.json" ] && printf "checkpoint\tleft\n" || printf "checkpoint\tremoved\n"
+    } >"$OUT/resume.tsv"' sh "$CONTAINER_OUT"
+check_output && check_output resume.tsv
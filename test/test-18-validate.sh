@@ -0,0 +1,79 @@
+#!/bin/sh
+
+LC_ALL="C"
+
+BASE_NAME="$(basename "$0" .sh)"
+BASE_DIR="$(realpath "$(dirname "$0")")"
+
+export BAP_DB_DIR="$BASE_DIR/databases"
+
+. "$BASE_DIR/functions.sh"
+
+# Checks the files in data (among which a truncated R1, and an R2 that lacks
+# the last read or has two reads swapped) and pairs of these, classifies them
+# and some odd first lines with sniff_file as well as with the three checks it
+# replaced, and runs BAP --validate on a pair that does not pair up, writing
+# all to validate.tsv.  The Python part is run from a file, as the processes
+# that validate_samples spawns import its main module
+make_output_dir
+run_in_container sh -c '
+    export PATH="/workdir/stubs:$PATH"
+    OUT="$1"
+    cd /workdir/data || exit 1
+    cat >"$OUT/validate.py" <<"EOF"
+import sys, os, io, re, gzip
+from kcri.bap.validate import check_file, validate_samples
+from kcri.bap.BAP import sniff_file
+
+# The checks that sniff_file replaced, as they were
+def detect_filetype(fname):
+    with open(fname, "rb") as f:
+        b = f.peek(2)
+        if b[:2] == b"\x1f\x8b":
+            b = gzip.GzipFile(fileobj=f).peek(2)[:2]
+        c = chr(b[0]) if len(b) > 0 else "\x00"
+    return "fasta" if c == ">" else "fastq" if c == "@" else "other"
+
+def first_line_matches(fname, regex):
+    with open(fname, "rb") as f:
+        b = f.peek(2)
+        buf = io.TextIOWrapper(gzip.GzipFile(fileobj=f) if b[:2] == b"\x1f\x8b" else f)
+        return re.match(regex, buf.readline())
+
+def old_filetype(fname):
+    kind = detect_filetype(fname)
+    if kind == "fastq":
+        if first_line_matches(fname, r"^@[^:]+:\d+:[^:]+:\d+:\d+:\d+:\d+ [12]:[YN]:\d+:[^: ]+( .*)?$"):
+            return "illumina"
+        elif first_line_matches(fname, r"^@[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}.*$"):
+            return "nanopore"
+    return kind
+
+if __name__ == "__main__":
+    for fname, kind in [ ("test.fa.gz", "fasta"), ("reads_1.fq.gz", "fastq"), ("reads_2.fq.gz", "fastq"),
+            ("truncated_1.fq.gz", "fastq"), ("short_2.fq.gz", "fastq"), ("swapped_2.fq.gz", "fastq"), ("reads_1.fq.gz", "fasta") ]:
+        check = check_file(fname, kind)
+        print("check\t%s\t%s\t%s\t%s" % (fname, kind, check["records"], check["error"] or "ok"))
+
+    pairs = [ ("reads_1.fq.gz", "reads_2.fq.gz"), ("truncated_1.fq.gz", "reads_2.fq.gz"),
+            ("reads_1.fq.gz", "short_2.fq.gz"), ("reads_1.fq.gz", "swapped_2.fq.gz") ]
+    for pair, errors in zip(pairs, validate_samples([ (None, list(p), None) for p in pairs ], 2)):
+        print("pair\t%s\t%s\t%s" % (pair[0], pair[1], "; ".join(errors) or "ok"))
+
+    sniff_dir = os.path.join(sys.argv[1], "sniff")
+    os.makedirs(sniff_dir)
+    lines = { "crlf.fa": b">c1 x\r\nACGT\r\n", "plain.fq": b"@read1\nACGT\n+\nIIII\n",
+        "srr.fq": b"@SRR1234.1 1/1\nACGT\n+\nIIII\n", "illumina.fq": b"@M1:7:FC:1:1101:1:2 1:N:0:ACGT+TTGA extra\nACGT\n+\nIIII\n",
+        "no-comment.fq": b"@M1:7:FC:1:1101:1:2\nACGT\n+\nIIII\n", "other.txt": b"hello\n", "empty.txt": b"",
+        "nanopore.fq.gz": gzip.compress(b"@3ea0b1a6-309d-4fa6-acf7-81318583eea3 runid=e78b ch=389\nACGT\n+\nIIII\n") }
+    for name, data in lines.items():
+        with open(os.path.join(sniff_dir, name), "wb") as f:
+            f.write(data)
+    for fname in [ "test.fa.gz", "reads_1.fq.gz" ] + [ os.path.join(sniff_dir, n) for n in lines ]:
+        new, old = sniff_file(fname), old_filetype(fname)
+        print("sniff\t%s\t%s\t%s" % (os.path.basename(fname), new, "same" if new == old else "differs from %s" % old))
+EOF
+    python3 "$OUT/validate.py" "$OUT" >"$OUT/validate.tsv" || exit 1
+    BAP --validate -o "$OUT/run" reads_1.fq.gz swapped_2.fq.gz 2>"$OUT/run.err"
+    printf "BAP\t%d\t%s\n" $? "$(grep "^BAP: " "$OUT/run.err" | sed "s|/[^ ]*/||g")" >>"$OUT/validate.tsv"' sh "$CONTAINER_OUT"
+check_output validate.tsv